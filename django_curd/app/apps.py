@@ -3,3 +3,25 @@ from django.apps import AppConfig
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        # 注册维护冗余计数的receivers
+        import app.receivers
+        # 通过 auto_prefetch() 查询的实例，访问外键、多对多字段时自动 prefetch
+        from app import prefetch
+        prefetch.install(*(self.get_model(name) for name in ('Tag', 'Supplier', 'Product', 'Customer')))
+        # Product.tags.bulk_set() 等批量修改多对多关系的方法
+        from app import m2m
+        m2m.install(*(self.get_model(name) for name in ('Tag', 'Product')))
+        # identity_map() 中访问外键时，优先使用已加载的实例
+        from app import identity
+        identity.install(*(self.get_model(name) for name in ('Product', 'Order')))
+        # 数据库连接执行写入的SQL时，让查询结果缓存、Identity Map 失效
+        from django.db.backends.signals import connection_created
+        from app import cache
+        from django.db import connections
+        for receiver in (cache.install, identity.install_wrapper):
+            connection_created.connect(receiver)
+            for connection in connections.all():
+                if connection.connection is not None:
+                    receiver(None, connection)
@@ -0,0 +1,145 @@
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from django.db import models, connections, router, transaction
+
+"""
+软删除数据的归档
+被软删除的数据一直留在原表中，所有的查询和索引都要为这些数据付出代价
+归档任务把删除时间超过一定天数的数据，分批移动到 <table>_archive 表中，
+并沿着 CASCADE 外键（如 Order）和自动创建的多对多中间表（如 Product.tags）一起移动
+归档后的数据可以通过 model 的 archived manager 查询，如 Product.archived.filter(...)
+"""
+
+# 默认归档删除超过30天的数据
+DEFAULT_ARCHIVE_DAYS = 30
+
+
+def archive_model(model, name=None):
+    """
+    为 model 生成对应的归档 model，表名为 <table>_archive
+    归档表保留原数据的主键，外键只保存id，不建立约束，唯一约束和auto_now也会去掉
+    :param model:
+    :param name: 归档 model 的类名，默认为 <model>Archive
+    :return:
+    """
+    attrs = {'__module__': model.__module__}
+    for field in model._meta.local_concrete_fields:
+        if field.primary_key:
+            attrs[field.attname] = models.IntegerField(primary_key=True)
+        elif field.is_relation:
+            attrs[field.attname] = models.IntegerField(null=field.null, db_column=field.column)
+        else:
+            _, path, args, kwargs = field.deconstruct()
+            for key in ('unique', 'db_index', 'auto_now', 'auto_now_add'):
+                kwargs.pop(key, None)
+            attrs[field.attname] = field.__class__(*args, **kwargs)
+    attrs['archive_time'] = models.DateTimeField('归档时间')
+    attrs['Meta'] = type('Meta', (), {'db_table': '{}_archive'.format(model._meta.db_table),
+                                      'app_label': model._meta.app_label})
+    archived = type(name or '{}Archive'.format(model.__name__), (models.Model,), attrs)
+    model._archive_model = archived
+    # 通过 Product.archived 查询归档数据
+    model.archived = archived._default_manager
+    return archived
+
+
+def _auto_through_models(model):
+    """
+    与 model 相关的、由 Django 自动创建的多对多中间表，以及中间表指向 model 的外键名
+    自定义的中间表（如 Order）作为普通的外键处理
+    """
+    for field in model._meta.many_to_many:
+        through = field.remote_field.through
+        if through._meta.auto_created:
+            yield through, field.m2m_field_name()
+    for rel in model._meta.related_objects:
+        if rel.many_to_many and rel.through._meta.auto_created:
+            yield rel.through, rel.field.m2m_reverse_field_name()
+
+
+def _move(model, pks, using, now, moved):
+    """
+    将主键在 pks 中的数据移动到归档表，先移动 CASCADE 的子表和多对多中间表
+    """
+    batch_size = len(pks)
+    children = [(rel.related_model, rel.field.name) for rel in model._meta.related_objects
+                if not rel.many_to_many and rel.on_delete is models.CASCADE]
+    children.extend(_auto_through_models(model))
+    for child, field_name in children:
+        queryset = child._base_manager.using(using).filter(**{'{}__in'.format(field_name): pks})
+        # 每次只取一批子表的主键，避免子表数据过多时占用大量内存
+        while True:
+            child_pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not child_pks:
+                break
+            _move(child, child_pks, using, now, moved)
+
+    # Order 等维护冗余计数的数据移走后，需要重新计算受影响的客户和商品的计数，见 OrderQuerySet
+    queryset = model._default_manager.using(using).filter(pk__in=pks)
+    refresh_counters = getattr(queryset, '_refresh_counters', None)
+    counter_keys = queryset._counter_keys() if refresh_counters else None
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    columns = ', '.join(qn(field.column) for field in model._meta.local_concrete_fields)
+    placeholders = ', '.join(['%s'] * len(pks))
+    pk_column = qn(model._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO {archive} ({columns}, {archive_time}) '
+                       'SELECT {columns}, %s FROM {table} WHERE {pk} IN ({placeholders})'.format(
+                           archive=qn(model._archive_model._meta.db_table), columns=columns,
+                           archive_time=qn('archive_time'), table=qn(table), pk=pk_column,
+                           placeholders=placeholders),
+                       [connection.ops.adapt_datetimefield_value(now)] + list(pks))
+        cursor.execute('DELETE FROM {table} WHERE {pk} IN ({placeholders})'.format(
+            table=qn(table), pk=pk_column, placeholders=placeholders), list(pks))
+        moved[table] = moved.get(table, 0) + cursor.rowcount
+    if refresh_counters:
+        refresh_counters(counter_keys)
+
+
+def archivable(model, days=None):
+    """
+    可以归档的数据：被软删除，并且删除时间超过 days 天
+    没有删除时间的数据（直接通过 update(is_deleted=True) 软删除的）还不能归档，archive 会先补上删除时间
+    仍被未归档数据以 PROTECT 等非 CASCADE 方式引用的数据不能归档，比如仍有商品的供应商
+    """
+    if days is None:
+        days = getattr(settings, 'SOFT_DELETE_ARCHIVE_DAYS', DEFAULT_ARCHIVE_DAYS)
+    cutoff = timezone.now() - timedelta(days=days)
+    queryset = model._base_manager.filter(delete_time__lte=cutoff, is_deleted=True)
+    for rel in model._meta.related_objects:
+        if not rel.many_to_many and rel.on_delete is not models.CASCADE:
+            referenced = rel.related_model._base_manager.filter(
+                **{'{}__isnull'.format(rel.field.attname): False}).values(rel.field.attname)
+            queryset = queryset.exclude(pk__in=referenced)
+    return queryset
+
+
+def archive(model, days=None, batch_size=500):
+    """
+    将 model 中可以归档的数据分批移动到归档表，每一批在单独的事务中完成
+    :param model: BaseModel 的子类
+    :param days: 删除超过多少天的数据才归档，默认使用 settings.SOFT_DELETE_ARCHIVE_DAYS
+    :param batch_size: 每一批的数量，SQLite 单条语句的参数不能超过999个
+    :return: 每张表移动的行数，如 {'product': 10, 'order': 25, 'product_tags': 20}
+    """
+    using = router.db_for_write(model)
+    # 没有删除时间的数据从现在开始计算删除时间，满 days 天后再归档
+    model._base_manager.using(using).filter(is_deleted=True, delete_time__isnull=True).update(
+        delete_time=timezone.now())
+    queryset = archivable(model, days).using(using).order_by('pk').values_list('pk', flat=True)
+    moved = {}
+    while True:
+        with transaction.atomic(using=using):
+            pks = list(queryset[:batch_size])
+            if not pks:
+                break
+            _move(model, pks, using, timezone.now(), moved)
+    return moved
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,226 @@
+import re
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+"""
+查询结果缓存
+Customer.objects.cached().get(id=1)、Product.objects.cached().in_bulk([1, 2])、Tag.objects.cached().get(name='食品')
+以编译后的 SQL 和参数作为 key 缓存查询结果，同时记录 SQL 读取的表
+每张表有一个版本号，写入数据时（包括 update、delete、bulk_create、软删除，以及 archive、bulk_upsert 这样直接执行的 SQL）
+表的版本号加一，缓存的 key 中包含了所读取的表的版本号，旧的缓存不会再被读取
+写入通过数据库连接的 execute_wrapper 捕获，只要经过 Django 的数据库连接都会使缓存失效
+
+缓存分为两级：进程内的 LRU，以及可选的共享缓存（Django cache，如 Redis、Memcached）
+配置了共享缓存时，表的版本号也保存在共享缓存中，其他进程的写入同样会让本进程的缓存失效
+
+QUERYSET_CACHE = {
+    'LOCAL_MAXSIZE': 1024,  # 进程内最多缓存的查询数
+    'BACKEND': None,        # 共享缓存使用的 CACHES 别名，None 为不使用
+    'TIMEOUT': 300,         # 缓存的过期时间（秒）
+}
+"""
+
+DEFAULTS = {
+    'LOCAL_MAXSIZE': 1024,
+    'BACKEND': None,
+    'TIMEOUT': 300,
+}
+
+# 写入数据的SQL，以及写入的表
+WRITE_SQL = re.compile(r'^\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+[`"]?(\w+)[`"]?',
+                       re.IGNORECASE)
+# SQL 读取的表，包括 JOIN 和子查询
+READ_TABLES = re.compile(r'\b(?:FROM|JOIN)\s+[`"]?(\w+)[`"]?', re.IGNORECASE)
+
+
+class LocalLRU:
+    """
+    进程内的 LRU 缓存，线程安全
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class QueryCache:
+
+    def __init__(self, options=None):
+        options = dict(DEFAULTS, **(options or {}))
+        self.timeout = options['TIMEOUT']
+        self.local = LocalLRU(options['LOCAL_MAXSIZE'])
+        self.shared = caches[options['BACKEND']] if options['BACKEND'] else None
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = 0
+
+    def versions(self, tables):
+        """
+        表的当前版本号
+        """
+        if self.shared is not None:
+            keys = {'qc:v:{}'.format(table): table for table in tables}
+            found = self.shared.get_many(keys)
+            return tuple((table, found.get(key, 0)) for key, table in sorted(keys.items()))
+        with self._lock:
+            return tuple((table, self._versions.get(table, 0)) for table in sorted(tables))
+
+    def invalidate(self, table):
+        """
+        表的版本号加一，读取了这张表的缓存全部失效
+        """
+        with self._lock:
+            self.invalidations += 1
+            self._versions[table] = self._versions.get(table, 0) + 1
+        if self.shared is not None:
+            key = 'qc:v:{}'.format(table)
+            self.shared.add(key, 0, None)
+            try:
+                self.shared.incr(key)
+            except ValueError:
+                self.shared.set(key, 1, None)
+
+    def fetch(self, key, tables, loader, timeout=None):
+        """
+        读取缓存，不存在时通过 loader 查询并写入缓存
+        :param key: SQL、参数等组成的 key
+        :param tables: SQL 读取的表
+        :param loader: 查询数据的函数
+        :param timeout: 过期时间
+        :return:
+        """
+        digest = hashlib.sha1(repr((key, self.versions(tables))).encode()).hexdigest()
+        cache_key = 'qc:r:{}'.format(digest)
+        value = self.local.get(cache_key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(cache_key)
+            if value is not None:
+                self.local.set(cache_key, value)
+        if value is not None:
+            self.hits += 1
+            # 缓存的是 pickle 后的数据，每次读取都是新的对象，修改不会影响缓存
+            return pickle.loads(value)
+        self.misses += 1
+        result = loader()
+        try:
+            value = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            # rows() 动态生成的行对象等无法 pickle 的结果不缓存
+            return result
+        self.local.set(cache_key, value)
+        if self.shared is not None:
+            self.shared.set(cache_key, value, self.timeout if timeout is None else timeout)
+        return result
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.local.evictions,
+            'invalidations': self.invalidations,
+            'size': len(self.local),
+        }
+
+    def clear(self):
+        self.local.clear()
+        self.hits = self.misses = self.invalidations = self.local.evictions = 0
+
+
+_query_cache = None
+
+
+def get_query_cache():
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = QueryCache(getattr(settings, 'QUERYSET_CACHE', None))
+    return _query_cache
+
+
+def reset_query_cache():
+    """
+    修改 QUERYSET_CACHE 配置后，重新创建缓存
+    """
+    global _query_cache
+    _query_cache = None
+
+
+def _dirty_tables(connection):
+    """
+    当前事务中写入过的表，这些表在事务结束前不读取缓存，也不写入缓存
+    """
+    if not connection.in_atomic_block:
+        connection.__dict__.pop('_query_cache_dirty', None)
+    return connection.__dict__.setdefault('_query_cache_dirty', set())
+
+
+def invalidation_wrapper(execute, sql, params, many, context):
+    """
+    数据库连接的 execute_wrapper，执行写入的SQL后让对应表的缓存失效
+    事务提交时再失效一次，避免其他连接在提交前把旧数据写入缓存
+    """
+    result = execute(sql, params, many, context)
+    match = WRITE_SQL.match(sql)
+    if match:
+        table = match.group(1)
+        connection = context['connection']
+        query_cache = get_query_cache()
+        query_cache.invalidate(table)
+        if connection.in_atomic_block:
+            _dirty_tables(connection).add(table)
+            transaction.on_commit(lambda: query_cache.invalidate(table), using=connection.alias)
+    return result
+
+
+def install(sender, connection, **kwargs):
+    """
+    connection_created 信号的 receiver，为每个新建的数据库连接增加 execute_wrapper
+    """
+    if invalidation_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(invalidation_wrapper)
+
+
+def fetch(queryset, loader, timeout=None):
+    """
+    SoftDelQuerySet.cached() 的查询，通过缓存读取 queryset 的结果
+    """
+    from django.db import connections
+    connection = connections[queryset.db]
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    tables = set(READ_TABLES.findall(sql))
+    if tables & _dirty_tables(connection):
+        return loader()
+    key = (queryset.db, sql, tuple(params), queryset._iterable_class.__name__, queryset._fields)
+    return get_query_cache().fetch(key, tables, loader, timeout)
+
+
+if __name__ == '__main__':
+    pass
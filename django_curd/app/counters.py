@@ -0,0 +1,107 @@
+import threading
+from contextlib import contextmanager
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+
+"""
+订单相关的冗余计数
+Customer.objects.annotate(count=Sum('order__count')) 每次查询都需要join订单表
+将计数冗余到 Customer.item_count、Customer.product_count 和 Product.sold_count，
+在 Order 新增、修改、删除时（包括 bulk_create 和 queryset 的 update、delete），
+只重新计算受影响的客户和商品，查询时直接读取字段
+settings.ORDER_COUNTERS = False 时不维护计数，需要时通过 rebuild_counters 命令重新计算
+"""
+
+# 每条 UPDATE 语句最多更新的客户或商品数量
+REFRESH_BATCH_SIZE = 500
+
+_local = threading.local()
+
+
+def enabled():
+    return getattr(settings, 'ORDER_COUNTERS', True) and not getattr(_local, 'suspended', False)
+
+
+@contextmanager
+def suspended():
+    """
+    暂停信号中的计数维护，由调用方在批量操作完成后统一刷新
+    """
+    previous = getattr(_local, 'suspended', False)
+    _local.suspended = True
+    try:
+        yield
+    finally:
+        _local.suspended = previous
+
+
+def _counters(connection, model_name):
+    """
+    model 的计数字段，以及重新计算该字段的关联子查询
+    :return: [(字段, 子查询)]
+    """
+    qn = connection.ops.quote_name
+    order = qn(apps.get_model('app', 'Order')._meta.db_table)
+    table = qn(apps.get_model('app', model_name)._meta.db_table)
+    if model_name == 'Customer':
+        where = '{}.{} = {}.{}'.format(order, qn('customer_id'), table, qn('id'))
+        return [
+            (qn('item_count'), 'COALESCE((SELECT SUM({0}.{1}) FROM {0} WHERE {2}), 0)'.format(
+                order, qn('count'), where)),
+            (qn('product_count'), '(SELECT COUNT(DISTINCT {0}.{1}) FROM {0} WHERE {2})'.format(
+                order, qn('product_id'), where)),
+        ]
+    where = '{}.{} = {}.{}'.format(order, qn('product_id'), table, qn('id'))
+    return [
+        (qn('sold_count'), 'COALESCE((SELECT SUM({0}.{1}) FROM {0} WHERE {2}), 0)'.format(
+            order, qn('count'), where)),
+    ]
+
+
+def _assignments(counters):
+    return ', '.join('{} = {}'.format(column, expression) for column, expression in counters)
+
+
+def refresh(customer_ids=(), product_ids=(), using='default'):
+    """
+    重新计算指定客户和商品的计数
+    :param customer_ids: 客户id
+    :param product_ids: 商品id
+    :param using: 数据库别名
+    :return:
+    """
+    if not enabled():
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for model_name, ids in (('Customer', customer_ids), ('Product', product_ids)):
+            table = qn(apps.get_model('app', model_name)._meta.db_table)
+            assignments = _assignments(_counters(connection, model_name))
+            ids = sorted({pk for pk in ids if pk is not None})
+            for start in range(0, len(ids), REFRESH_BATCH_SIZE):
+                batch = ids[start:start + REFRESH_BATCH_SIZE]
+                cursor.execute('UPDATE {} SET {} WHERE {} IN ({})'.format(
+                    table, assignments, qn('id'), ', '.join(['%s'] * len(batch))), batch)
+
+
+def rebuild(model_name, start, end, using='default'):
+    """
+    重新计算主键在 [start, end) 范围内的客户或商品的计数，只更新计数有偏差的数据
+    :param model_name: Customer 或 Product
+    :return: 计数有偏差的行数
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    counters = _counters(connection, model_name)
+    drifted = ' OR '.join('{} <> {}'.format(column, expression) for column, expression in counters)
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE {table} SET {assignments} WHERE {id} >= %s AND {id} < %s AND ({drifted})'.format(
+            table=qn(apps.get_model('app', model_name)._meta.db_table), assignments=_assignments(counters),
+            id=qn('id'), drifted=drifted), [start, end])
+        return cursor.rowcount
+
+
+if __name__ == '__main__':
+    pass
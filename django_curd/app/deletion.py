@@ -0,0 +1,127 @@
+from django.db import models, connections, transaction
+from django.db.models.deletion import ProtectedError
+from .archive import _auto_through_models
+
+"""
+批量级联删除
+queryset.delete() 通过 Collector 处理 CASCADE 和 PROTECT，会把所有关联的数据加载到内存中，
+删除一个有几百万条订单的客户时会耗尽内存，而且遇到 PROTECT 时，要在收集了所有数据之后才会抛出 ProtectedError
+Customer.objects.filter(...).fast_delete() 按主键顺序分批删除，每一批中：
+CASCADE 的子表通过 DELETE ... WHERE customer_id IN (SELECT id FROM customer WHERE ...) 删除，
+SET_NULL 的子表通过 UPDATE 置空，自动创建的多对多中间表同样直接删除，全程不创建任何实例
+删除前通过一条 EXISTS 查询检查 PROTECT，有数据被保护时直接抛出 ProtectedError，不删除任何数据
+与 QuerySet.delete() 的区别：不发送 pre_delete、post_delete 信号，不支持 SET_DEFAULT、SET() 等需要 Python 计算的 on_delete
+Order 这样维护冗余计数的 queryset（有 _counter_keys 方法），删除后会刷新计数，见 counters
+"""
+
+# 每批删除的主键数
+BATCH_SIZE = 1000
+
+
+def _queryset(model, using):
+    """
+    不带默认过滤条件（如软删除）的 queryset，但保留默认 manager 的 queryset 类型
+    """
+    return type(model._default_manager.get_queryset())(model=model, using=using)
+
+
+def _plan(model, queryset, using):
+    """
+    沿着关联关系展开需要处理的 queryset
+    :return: (需要检查的 PROTECT [(rel, queryset)], 按删除顺序排列的操作 [(动作, model, queryset)])
+    """
+    protected, steps = [], []
+    for rel in model._meta.related_objects:
+        if rel.many_to_many:
+            continue
+        field = rel.field
+        child = _queryset(rel.related_model, using).filter(
+            **{'{}__in'.format(field.attname): queryset.values(field.target_field.attname)})
+        if rel.on_delete is models.CASCADE:
+            child_protected, child_steps = _plan(rel.related_model, child, using)
+            protected.extend(child_protected)
+            steps.extend(child_steps)
+        elif rel.on_delete is models.PROTECT:
+            protected.append((rel, child))
+        elif rel.on_delete is models.SET_NULL:
+            steps.append(('set_null', field, child))
+        elif rel.on_delete is not models.DO_NOTHING:
+            raise ValueError('fast_delete 不支持 {}.{} 的 on_delete'.format(
+                rel.related_model.__name__, field.name))
+    for through, field_name in _auto_through_models(model):
+        steps.append(('delete', through, _queryset(through, using).filter(
+            **{'{}__in'.format(field_name): queryset.values('pk')})))
+    steps.append(('delete', model, queryset))
+    return protected, steps
+
+
+def check_protected(protected, using):
+    """
+    通过一条 EXISTS 查询检查是否有 PROTECT 的数据，有则抛出 ProtectedError
+    """
+    if not protected:
+        return
+    connection = connections[using]
+    sqls, params = [], []
+    for _, queryset in protected:
+        sql, sql_params = queryset.values('pk').query.get_compiler(using).as_sql()
+        sqls.append('EXISTS ({})'.format(sql))
+        params.extend(sql_params)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT CASE WHEN {} THEN 1 ELSE 0 END'.format(' OR '.join(sqls)), params)
+        if not cursor.fetchone()[0]:
+            return
+    # 只在出错时逐个检查，找出是哪个关联关系
+    for rel, queryset in protected:
+        if queryset.exists():
+            raise ProtectedError(
+                "Cannot delete some instances of model '{}' because they are referenced through a protected "
+                "foreign key: '{}.{}'".format(rel.model.__name__, rel.related_model.__name__, rel.field.name),
+                queryset)
+
+
+def fast_delete(queryset, batch_size=None):
+    """
+    按主键范围分批删除 queryset 及其级联的数据
+    :param queryset:
+    :param batch_size: 每批删除的主键数
+    :return: 每张表删除的行数，如 {'customer': 1, 'order': 2}，SET_NULL 更新的行数不计入
+    """
+    model = queryset.model
+    using = queryset.db
+    batch_size = batch_size or BATCH_SIZE
+    queryset = queryset.order_by()
+    protected, _ = _plan(model, queryset, using)
+    check_protected(protected, using)
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    deleted = {}
+    last = None
+    while True:
+        # 每批只取一段主键，queryset 的条件可能依赖子表（如按订单筛选客户），删除子表前先确定这一批的主键
+        batch_pks = list((pks if last is None else pks.filter(pk__gt=last))[:batch_size])
+        if not batch_pks:
+            break
+        last = batch_pks[-1]
+        batch = _queryset(model, using).filter(pk__in=batch_pks)
+        with transaction.atomic(using=using):
+            # PROTECT 的数据可能在检查之后新增，每批删除前再检查一次
+            protected, steps = _plan(model, batch, using)
+            check_protected(protected, using)
+            refresh = []
+            for action, target, step_queryset in steps:
+                if action == 'set_null':
+                    step_queryset.update(**{target.name: None})
+                    continue
+                if hasattr(step_queryset, '_counter_keys'):
+                    refresh.append((step_queryset, step_queryset._counter_keys()))
+                rows = step_queryset._raw_delete(using)
+                if rows:
+                    table = target._meta.db_table
+                    deleted[table] = deleted.get(table, 0) + rows
+            for step_queryset, keys in refresh:
+                step_queryset._refresh_counters(keys)
+    return deleted
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,160 @@
+from decimal import Decimal, ROUND_HALF_UP
+from django import forms
+from django.conf import settings
+from django.db import models
+from django.db.models import lookups, Count
+from django.db.models.expressions import Combinable, CombinedExpression, Value
+from django.db.models.sql import Query
+from django.core import exceptions
+
+# 默认精确到分
+DEFAULT_MONEY_SCALE = 2
+
+
+class MoneyField(models.Field):
+    """
+    以整数保存的金额，数据库中保存的是最小货币单位（scale=2 时为分）
+    DecimalField 在 SQLite 中以字符串或浮点数保存，每一行都需要构造 Decimal，Sum、Avg 还需要指定 output_field
+    MoneyField 在数据库中是 bigint，只在写入和读取时与 Decimal 相互转换，聚合函数直接在数据库中对整数求和
+
+    update(price=F('price') + 1)、filter(member_price__gte=F('price') + 1) 中与金额相加减的常量同样以元为单位，
+    写入和比较时转换为最小货币单位，见 scale_literals；乘除的常量是倍数，不转换
+    annotate(F('price') + 1)、aggregate(Sum('price')) 等 SELECT 中的表达式见 MoneyQuery，
+    金额作为其他类型返回时，如 Sum('price', output_field=DecimalField())，数据库返回的是最小货币单位，抛出 FieldError
+    """
+
+    description = 'Money stored as a scaled 64-bit integer'
+
+    def __init__(self, verbose_name=None, name=None, scale=None, **kwargs):
+        self.scale = getattr(settings, 'MONEY_SCALE', DEFAULT_MONEY_SCALE) if scale is None else scale
+        self.quantum = Decimal(1).scaleb(-self.scale)
+        super().__init__(verbose_name, name, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['scale'] = self.scale
+        return name, path, args, kwargs
+
+    def get_internal_type(self):
+        # 数据库中的类型与 BigIntegerField 相同，但不继承 IntegerField，Avg 等聚合函数的结果会转换为 Decimal
+        return 'BigIntegerField'
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Decimal):
+            return value
+        try:
+            return Decimal(str(value))
+        except ArithmeticError:
+            raise exceptions.ValidationError('“%(value)s” value must be a decimal number.',
+                                             code='invalid', params={'value': value})
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None:
+            return None
+        return int(self.to_python(value).scaleb(self.scale).to_integral_value(ROUND_HALF_UP))
+
+    def get_placeholder(self, value, compiler, connection):
+        # UPDATE、INSERT 中的表达式在编译前调用，比如 save() 和 update() 中的 F('price') + 1
+        if isinstance(value, CombinedExpression):
+            scale_literals(value)
+        return '%s'
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        if isinstance(value, int):
+            return Decimal(value).scaleb(-self.scale)
+        # Avg 等返回浮点数
+        return Decimal(str(value)).scaleb(-self.scale).quantize(self.quantum, ROUND_HALF_UP)
+
+    def formfield(self, **kwargs):
+        return super().formfield(**{'form_class': forms.DecimalField, 'decimal_places': self.scale, **kwargs})
+
+
+def scale_literals(expression):
+    """
+    为已经 resolve 的表达式中，与 MoneyField 相加减、没有类型的常量加上 MoneyField 类型，
+    编译时这些常量和字段的值一样转换为最小货币单位
+    """
+    if not isinstance(expression, CombinedExpression):
+        return
+    scale_literals(expression.lhs)
+    scale_literals(expression.rhs)
+    if expression.connector not in (Combinable.ADD, Combinable.SUB):
+        return
+    expression.lhs, expression.rhs = _typed(expression.lhs, expression.rhs), _typed(expression.rhs, expression.lhs)
+
+
+def _typed(literal, other):
+    field = other._output_field_or_none
+    if type(literal) is not Value or literal._output_field_or_none is not None or not isinstance(field, MoneyField):
+        return literal
+    typed = Value(literal.value, output_field=field)
+    typed.for_save = literal.for_save
+    return typed
+
+
+class MoneyLookupMixin:
+    """
+    比较的右侧为表达式时，转换其中的金额常量，如 filter(member_price__gte=F('price') + 1)
+    """
+
+    def get_prep_lookup(self):
+        scale_literals(self.rhs)
+        return super().get_prep_lookup()
+
+
+for _lookup in (lookups.Exact, lookups.GreaterThan, lookups.GreaterThanOrEqual, lookups.LessThan,
+                lookups.LessThanOrEqual):
+    MoneyField.register_lookup(type('Money{}'.format(_lookup.__name__), (MoneyLookupMixin, _lookup), {}))
+
+
+def check_money(expression):
+    """
+    处理已经 resolve 的 SELECT 表达式：
+    1. 与 scale_literals 相同，为与金额相加减的常量加上 MoneyField 类型
+    2. 以金额为参数、但 output_field 不是 MoneyField 的表达式，结果是最小货币单位，无法转换为 Decimal，抛出 FieldError
+       Count 和比较的结果与单位无关，不检查
+    """
+    if not hasattr(expression, 'get_source_expressions'):
+        return
+    scale_literals(expression)
+    sources = [source for source in expression.get_source_expressions() if source is not None]
+    for source in sources:
+        check_money(source)
+    if isinstance(expression, (Count, lookups.Lookup)) or _is_money(expression):
+        return
+    if any(_is_money(source) for source in sources):
+        raise exceptions.FieldError('{!r} 的结果是最小货币单位，output_field 需要是 MoneyField'.format(expression))
+
+
+def _is_money(expression):
+    try:
+        return isinstance(getattr(expression, '_output_field_or_none', None), MoneyField)
+    except exceptions.FieldError:
+        return False
+
+
+class MoneyQuery(Query):
+    """
+    annotate()、aggregate()、values() 中的表达式经过 check_money，
+    Product.objects.annotate(price=F('price') + 1) 中的常量以元为单位，结果为 Decimal
+    """
+
+    def add_annotation(self, annotation, alias, is_summary=False):
+        super().add_annotation(annotation, alias, is_summary)
+        check_money(self.annotations[alias])
+
+
+class Money(models.Value):
+    """
+    明确指定类型的金额常量，如 annotate(price=Money(1))，与 MoneyField 相加减的常量不需要使用 Money
+    """
+
+    def __init__(self, value, scale=None):
+        super().__init__(value, output_field=MoneyField(scale=scale))
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,156 @@
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from .cache import WRITE_SQL
+
+"""
+Identity Map
+同一个请求中，product.supplier 这样的外键访问会反复查询同一个 Supplier，每次都得到一个新的实例
+在 identity_map() 中查询出的实例按主键记录下来，之后
+Product.objects.get(pk=1)、Product.objects.in_bulk([1, 2])、product.supplier
+如果主键已经加载过，直接返回已加载的实例，不再查询数据库
+
+with identity_map() as im:
+    for product in Product.objects.all():
+        print(product.supplier)
+    print(im.stats())
+
+也可以在 MIDDLEWARE 中加入 'app.identity.IdentityMapMiddleware'，每个请求使用一个 Identity Map
+通过数据库连接写入某张表时（update、delete、save 等），这张表的实例会从 Identity Map 中移除
+"""
+
+_local = threading.local()
+
+
+class IdentityMap:
+
+    def __init__(self):
+        # {(model, db, pk): instance}
+        self._instances = {}
+        # 避免的查询数，按 model 统计
+        self.avoided = Counter()
+        self.loaded = 0
+
+    def add(self, instances, db):
+        for instance in instances:
+            # 只查询了部分字段的实例不记录
+            if not instance.get_deferred_fields():
+                key = (type(instance)._meta.concrete_model, db, instance.pk)
+                if key not in self._instances:
+                    self._instances[key] = instance
+                    self.loaded += 1
+
+    def get(self, model, db, pk):
+        return self._instances.get((model._meta.concrete_model, db, pk))
+
+    def hit(self, model, count=1):
+        self.avoided[model.__name__] += count
+
+    def evict(self, table):
+        for key in [key for key in self._instances if key[0]._meta.db_table == table]:
+            del self._instances[key]
+
+    def stats(self):
+        return {
+            'loaded': self.loaded,
+            'size': len(self._instances),
+            'avoided': sum(self.avoided.values()),
+            'avoided_by_model': dict(self.avoided),
+        }
+
+
+def current():
+    """
+    当前线程正在使用的 Identity Map，没有时返回 None
+    """
+    return getattr(_local, 'map', None)
+
+
+@contextmanager
+def identity_map():
+    previous = current()
+    _local.map = IdentityMap()
+    try:
+        yield _local.map
+    finally:
+        _local.map = previous
+
+
+class IdentityMapMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with identity_map():
+            return self.get_response(request)
+
+
+def to_pk(model, value):
+    """
+    将查询参数中的主键转换为实例上主键的类型，无法转换时返回 None
+    """
+    try:
+        return model._meta.pk.to_python(getattr(value, 'pk', value))
+    except Exception:
+        return None
+
+
+class IdentityMapDescriptorMixin:
+    """
+    正向外键的描述符，关联的实例已经在 Identity Map 中时不再查询
+    """
+
+    def get_object(self, instance):
+        im = current()
+        if im is None:
+            return super().get_object(instance)
+        model = self.field.remote_field.model
+        db = instance._state.db or 'default'
+        if self.field.target_field.primary_key:
+            obj = im.get(model, db, instance.__dict__[self.field.attname])
+            if obj is not None:
+                im.hit(model)
+                return obj
+        obj = super().get_object(instance)
+        im.add((obj,), obj._state.db)
+        return obj
+
+
+def invalidation_wrapper(execute, sql, params, many, context):
+    """
+    数据库连接的 execute_wrapper，写入某张表后，从 Identity Map 中移除这张表的实例
+    """
+    result = execute(sql, params, many, context)
+    im = current()
+    if im is not None:
+        match = WRITE_SQL.match(sql)
+        if match:
+            im.evict(match.group(1))
+    return result
+
+
+def install(*models):
+    """
+    替换 model 正向外键的描述符
+    """
+    for model in models:
+        for field in model._meta.concrete_fields:
+            descriptor = model.__dict__.get(field.name)
+            if isinstance(descriptor, ForwardManyToOneDescriptor) \
+                    and not isinstance(descriptor, IdentityMapDescriptorMixin):
+                descriptor.__class__ = type('IdentityMap' + type(descriptor).__name__,
+                                            (IdentityMapDescriptorMixin, type(descriptor)), {})
+
+
+def install_wrapper(sender, connection, **kwargs):
+    """
+    connection_created 信号的 receiver
+    """
+    if invalidation_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(invalidation_wrapper)
+
+
+if __name__ == '__main__':
+    pass
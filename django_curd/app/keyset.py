@@ -0,0 +1,169 @@
+import json
+import base64
+import binascii
+from django.db.models import F, Q
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+
+"""
+keyset 分页（seek 分页）
+Product.objects.filter(...)[offset:offset + size] 使用 OFFSET，数据库需要先扫描并丢弃 offset 行，页数越深越慢
+keyset 分页记住上一页最后一行排序字段的值，下一页通过 WHERE 条件直接定位：
+ordering 为 ('-update_time', 'id') 时，下一页的条件为
+update_time <= t AND (update_time < t OR (update_time = t AND id > i))
+配合 (update_time, id) 的索引，无论第几页都只需要读取 size 行
+排序字段的最后一个必须唯一，没有包含主键时会自动加上主键
+可以为 NULL 的排序字段，NULL 视为比所有值都大：升序时排在最后，倒序时排在最前（NULLS LAST / NULLS FIRST），
+条件中通过 isnull 单独处理，如 update_time 为 NULL 时，倒序的下一页为
+(update_time IS NULL AND id > i) OR update_time IS NOT NULL
+"""
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, fields, has_next, has_previous):
+        self.object_list = object_list
+        self.fields = fields
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def _cursor(self, obj):
+        values = [None if field.value_from_object(obj) is None else field.value_to_string(obj)
+                  for field, _ in self.fields]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    @property
+    def next_cursor(self):
+        """
+        下一页的游标，没有下一页时为None
+        """
+        return self._cursor(self.object_list[-1]) if self.has_next and self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        """
+        上一页的游标，没有上一页时为None
+        """
+        return self._cursor(self.object_list[0]) if self.has_previous and self.object_list else None
+
+
+def _fields(model, ordering):
+    """
+    :return: [(字段, 是否倒序)]
+    """
+    ordering = list(ordering)
+    names = [name.lstrip('-') for name in ordering]
+    if 'pk' not in names and model._meta.pk.name not in names:
+        ordering.append('pk')
+    fields = []
+    for name in ordering:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+        if not field.concrete or field.many_to_many:
+            raise ValueError('Keyset ordering supports concrete fields only, got {!r}'.format(name))
+        fields.append((field, descending))
+    return fields
+
+
+def _decode(fields, cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if not isinstance(values, list) or len(values) != len(fields):
+            raise ValueError
+        return [None if value is None else field.to_python(value) for (field, _), value in zip(fields, values)]
+    except (ValueError, TypeError, ValidationError, binascii.Error, UnicodeDecodeError) as ex:
+        raise InvalidPage('Invalid cursor {!r}'.format(cursor)) from ex
+
+
+def _equal(field, value):
+    if value is None:
+        return Q(**{'{}__isnull'.format(field.attname): True})
+    return Q(**{field.attname: value})
+
+
+def _beyond(field, value, greater, inclusive=False):
+    """
+    比 value 大（greater 为 False 时为小）的条件，NULL 比所有值都大，没有满足条件的数据时返回 None
+    """
+    if value is None:
+        if inclusive:
+            return _equal(field, value) if greater else Q()
+        return None if greater else Q(**{'{}__isnull'.format(field.attname): False})
+    lookup = '{}__{}{}'.format(field.attname, 'gt' if greater else 'lt', 'e' if inclusive else '')
+    condition = Q(**{lookup: value})
+    if greater and field.null:
+        condition |= Q(**{'{}__isnull'.format(field.attname): True})
+    return condition
+
+
+def _seek(fields, values, backward):
+    """
+    定位到游标之后（backward 为 True 时为之前）的数据
+    """
+    def greater(descending):
+        return descending == backward
+
+    condition = None
+    for index, (field, descending) in enumerate(fields):
+        beyond = _beyond(field, values[index], greater(descending))
+        if beyond is None:
+            continue
+        for (previous, _), value in zip(fields[:index], values):
+            beyond &= _equal(previous, value)
+        condition = beyond if condition is None else condition | beyond
+    if condition is None:
+        # 已经是最后一行
+        return Q(pk__in=[])
+    # 冗余的第一个排序字段的范围条件，便于数据库使用索引
+    first, descending = fields[0]
+    return _beyond(first, values[0], greater(descending), inclusive=True) & condition
+
+
+def _order_by(fields, backward):
+    for field, descending in fields:
+        descending = descending != backward
+        if not field.null:
+            yield '{}{}'.format('-' if descending else '', field.attname)
+        elif descending:
+            yield F(field.attname).desc(nulls_first=True)
+        else:
+            yield F(field.attname).asc(nulls_last=True)
+
+
+def keyset_page(queryset, ordering, size=20, after=None, before=None):
+    """
+    keyset 分页
+    :param queryset:
+    :param ordering: 排序字段，如 ('-update_time', 'id')
+    :param size: 每页的数量
+    :param after: 下一页的游标，即上一页的 next_cursor
+    :param before: 上一页的游标，即下一页的 previous_cursor
+    :return: KeysetPage
+    """
+    if after and before:
+        raise ValueError("'after' and 'before' are mutually exclusive")
+    fields = _fields(queryset.model, ordering)
+    backward = bool(before)
+    cursor = before or after
+    # 向前翻页时倒序查询，再将结果翻转
+    queryset = queryset.order_by(*_order_by(fields, backward))
+    if cursor:
+        queryset = queryset.filter(_seek(fields, _decode(fields, cursor), backward))
+    object_list = list(queryset[:size + 1])
+    more = len(object_list) > size
+    object_list = object_list[:size]
+    if backward:
+        object_list.reverse()
+        return KeysetPage(object_list, fields, has_next=True, has_previous=more)
+    return KeysetPage(object_list, fields, has_next=more, has_previous=bool(cursor))
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,161 @@
+from django.db import connections, router, transaction
+from django.db.models.signals import m2m_changed
+from django.db.models.fields.related_descriptors import ManyToManyDescriptor
+
+"""
+批量修改多对多关系
+product.tags.add(tag) 每次调用都会先查询关系是否存在，再插入一条记录，为大量商品设置标签非常慢
+Product.tags.bulk_set({product_id: [tag_id, ...]})  # 商品的标签设置为给定的标签
+Product.tags.bulk_add({product_id: [tag_id, ...]})  # 增加标签
+Product.tags.bulk_remove({product_id: [tag_id, ...]})  # 移除标签
+每一批关系写成 SELECT %s, %s UNION ALL ... 的派生表，与中间表的差异在数据库中计算：
+INSERT ... SELECT ... WHERE NOT EXISTS 增加缺少的关系，DELETE ... WHERE [NOT] EXISTS 移除多余的关系
+每批只执行一条 INSERT 和一条 DELETE，不把现有的关系读到 Python 中
+有 m2m_changed 的 receiver 时，先通过同样的条件查询这一批的差异，并加载这一批的实例，
+与 Django 的 add、remove 相同，每个实例发送一次，instance 为实例，pk_set 为这个实例增加或移除的关联对象的主键
+只支持自动创建的中间表，通过 through 指定中间表时，中间表可能有其他必填字段
+"""
+
+# 每批处理的关系数，SQLite 单条语句的参数不能超过999个，每个关系需要2个参数
+BATCH_SIZE = 300
+
+
+def _batches(mapping, batch_size):
+    """
+    按关系数分批，一个实例的关系不会被拆到两批中
+    """
+    batch, size = {}, 0
+    for pk, pks in mapping.items():
+        pks = set(pks)
+        if batch and size + len(pks) > batch_size:
+            yield batch
+            batch, size = {}, 0
+        batch[pk] = pks
+        size += len(pks)
+    if batch:
+        yield batch
+
+
+class BulkManyToManyMixin:
+    """
+    多对多字段的描述符，增加 bulk_set、bulk_add、bulk_remove
+    """
+
+    def _names(self):
+        # 中间表中指向当前 model 和关联 model 的字段
+        if self.reverse:
+            return self.field.m2m_reverse_field_name(), self.field.m2m_field_name()
+        return self.field.m2m_field_name(), self.field.m2m_reverse_field_name()
+
+    def _sql(self, connection, batch, remove):
+        """
+        :return: (中间表, 指向当前 model 的列, 指向关联 model 的列,
+                  (需要增加的关系的 FROM ... WHERE, 参数), (需要移除的关系的 WHERE, 参数))，没有时为 None
+        """
+        qn = connection.ops.quote_name
+        source, target = (qn(self.through._meta.get_field(name).column) for name in self._names())
+        table = qn(self.through._meta.db_table)
+        pairs = [(pk, target_id) for pk, pks in batch.items() for target_id in pks]
+        params = [value for pair in pairs for value in pair]
+        wanted = ' UNION ALL '.join(['SELECT %s AS {}, %s AS {}'.format(qn('s'), qn('t'))] +
+                                    ['SELECT %s, %s'] * (len(pairs) - 1))
+        match = 'w.{s} = {table}.{source} AND w.{t} = {table}.{target}'.format(
+            s=qn('s'), t=qn('t'), table=table, source=source, target=target)
+        missing = ('FROM ({wanted}) w WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {match})'.format(
+            wanted=wanted, table=table, match=match), params) if pairs else None
+        if remove == 'remove':
+            extra = ('EXISTS (SELECT 1 FROM ({}) w WHERE {})'.format(wanted, match), params) if pairs else None
+        elif pairs:
+            extra = ('{} IN ({}) AND NOT EXISTS (SELECT 1 FROM ({}) w WHERE {})'.format(
+                source, ', '.join(['%s'] * len(batch)), wanted, match), list(batch) + params)
+        else:
+            # 所有实例的关系都清空
+            extra = ('{} IN ({})'.format(source, ', '.join(['%s'] * len(batch))), list(batch))
+        return table, source, target, missing, extra
+
+    def _send(self, action, pairs, instances, using):
+        # 正向时 instance 为 Product，model 为 Tag；反向时相反
+        model = self.field.model if self.reverse else self.field.related_model
+        for pk, pk_set in pairs.items():
+            if pk in instances:
+                m2m_changed.send(sender=self.through, action=action, instance=instances[pk], reverse=self.reverse,
+                                 model=model, pk_set=pk_set, using=using)
+
+    @staticmethod
+    def _pairs(cursor, sql, params):
+        pairs = {}
+        cursor.execute(sql, params)
+        for pk, target_id in cursor.fetchall():
+            pairs.setdefault(pk, set()).add(target_id)
+        return pairs
+
+    def _apply(self, mapping, add, remove, batch_size=None, using=None):
+        """
+        :param add: 是否增加 mapping 中不存在的关系
+        :param remove: 'remove' 移除 mapping 中的关系，'set' 移除 mapping 以外的关系，None 不移除
+        """
+        using = using or router.db_for_write(self.through)
+        connection = connections[using]
+        listening = m2m_changed.has_listeners(self.through)
+        instance_model = self.field.related_model if self.reverse else self.field.model
+        added = removed = 0
+        with transaction.atomic(using=using, savepoint=False), connection.cursor() as cursor:
+            for batch in _batches(mapping, batch_size or BATCH_SIZE):
+                table, source, target, missing, extra = self._sql(connection, batch, remove)
+                instances = instance_model._base_manager.using(using).in_bulk(list(batch)) if listening else {}
+                if remove and extra:
+                    pairs = self._pairs(cursor, 'SELECT {}, {} FROM {} WHERE {}'.format(
+                        source, target, table, extra[0]), extra[1]) if listening else {}
+                    self._send('pre_remove', pairs, instances, using)
+                    cursor.execute('DELETE FROM {} WHERE {}'.format(table, extra[0]), extra[1])
+                    removed += cursor.rowcount
+                    self._send('post_remove', pairs, instances, using)
+                if add and missing:
+                    pairs = self._pairs(cursor, 'SELECT w.{}, w.{} {}'.format(
+                        connection.ops.quote_name('s'), connection.ops.quote_name('t'), missing[0]),
+                        missing[1]) if listening else {}
+                    self._send('pre_add', pairs, instances, using)
+                    cursor.execute('INSERT INTO {table} ({source}, {target}) SELECT w.{s}, w.{t} {missing}'.format(
+                        table=table, source=source, target=target, s=connection.ops.quote_name('s'),
+                        t=connection.ops.quote_name('t'), missing=missing[0]), missing[1])
+                    added += cursor.rowcount
+                    self._send('post_add', pairs, instances, using)
+        return added, removed
+
+    def bulk_add(self, mapping, batch_size=None, using=None):
+        """
+        :param mapping: {主键: [关联对象的主键]}
+        :return: 增加的关系数
+        """
+        return self._apply(mapping, 'add', None, batch_size, using)[0]
+
+    def bulk_remove(self, mapping, batch_size=None, using=None):
+        """
+        :param mapping: {主键: [关联对象的主键]}
+        :return: 移除的关系数
+        """
+        return self._apply(mapping, None, 'remove', batch_size, using)[1]
+
+    def bulk_set(self, mapping, batch_size=None, using=None):
+        """
+        将关系设置为给定的关联对象，mapping 中未出现的实例不受影响
+        :param mapping: {主键: [关联对象的主键]}，空列表表示清空
+        :return: (增加的关系数, 移除的关系数)
+        """
+        return self._apply(mapping, 'add', 'set', batch_size, using)
+
+
+def install(*models):
+    """
+    为 model 中使用自动创建中间表的多对多字段（包括反向）增加批量修改的方法
+    """
+    for model in models:
+        for name, descriptor in list(vars(model).items()):
+            if isinstance(descriptor, ManyToManyDescriptor) and not isinstance(descriptor, BulkManyToManyMixin) \
+                    and descriptor.through._meta.auto_created:
+                descriptor.__class__ = type('BulkManyToMany' + type(descriptor).__name__,
+                                            (BulkManyToManyMixin, type(descriptor)), {})
+
+
+if __name__ == '__main__':
+    pass
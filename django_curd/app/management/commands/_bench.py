@@ -0,0 +1,41 @@
+import time
+from contextlib import contextmanager
+from django.db import transaction
+
+# benchmark 命令共用的工具，下划线开头的模块不会被 Django 识别为命令
+
+
+class _Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rollback(using=None):
+    """
+    在事务中执行 benchmark，结束后回滚，不会在数据库中留下测试数据
+    :param using: 数据库别名
+    :return:
+    """
+    try:
+        with transaction.atomic(using=using):
+            yield
+            raise _Rollback
+    except _Rollback:
+        pass
+
+
+def timeit(func, number):
+    """
+    执行 number 次 func，返回平均每次的耗时（秒）
+    :param func: 不接收参数的函数，或接收当前次数的函数
+    :param number: 执行次数
+    :return:
+    """
+    start = time.perf_counter()
+    for i in range(number):
+        func(i)
+    return (time.perf_counter() - start) / number
+
+
+if __name__ == '__main__':
+    pass
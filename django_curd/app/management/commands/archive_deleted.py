@@ -0,0 +1,37 @@
+import time
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from app.models import BaseModel
+
+
+class Command(BaseCommand):
+    """
+    归档软删除的数据，可以由 crontab 定时执行，也可以通过 --interval 常驻后台循环执行
+    python manage.py archive_deleted --days 30
+    python manage.py archive_deleted --model Product --interval 600
+    """
+
+    help = 'Move soft-deleted rows older than --days into the <table>_archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', dest='models', help='只归档指定的model，可以指定多次')
+        parser.add_argument('--days', type=int, default=None, help='默认使用 settings.SOFT_DELETE_ARCHIVE_DAYS')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--interval', type=int, default=0, help='大于0时，每隔 interval 秒循环执行')
+
+    def handle(self, *args, **options):
+        models = [model for model in apps.get_app_config('app').get_models()
+                  if issubclass(model, BaseModel) and hasattr(model, '_archive_model')]
+        if options['models']:
+            names = {name.lower() for name in options['models']}
+            models = [model for model in models if model._meta.model_name in names]
+            if not models:
+                raise CommandError('No archivable model named {}'.format(', '.join(options['models'])))
+        while True:
+            for model in models:
+                moved = model.archive_deleted(days=options['days'], batch_size=options['batch_size'])
+                for table, count in moved.items():
+                    self.stdout.write('{}: {} -> {}_archive'.format(model.__name__, count, table))
+            if options['interval'] <= 0:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,56 @@
+import random
+from datetime import datetime, timedelta
+from django.db import connection
+from django.core.management.base import BaseCommand
+from app.models import Product
+from app.keyset import KeysetPage, _fields
+from ._bench import rollback, timeit
+
+ORDERING = ('-update_time', 'id')
+
+
+class Command(BaseCommand):
+    """
+    对比 OFFSET 分页和 keyset 分页在不同页数的耗时
+    python manage.py bench_keyset --pages 10000 --size 20
+    测试数据在事务中写入，结束后回滚
+    """
+
+    help = 'Benchmark OFFSET versus keyset pagination latency on deep Product pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=10000, help='最深的页数')
+        parser.add_argument('--size', type=int, default=20, help='每页的数量')
+        parser.add_argument('--deleted', type=float, default=0.1, help='被软删除的数据占比')
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        pages, size, repeat = options['pages'], options['size'], options['repeat']
+        # 保证最深的一页在软删除后仍然存在
+        rows = int(pages * size / (1 - options['deleted'])) + size
+        start = datetime(year=2018, month=1, day=1)
+        with rollback():
+            Product.objects.bulk_insert_stream(
+                Product(name='p{}'.format(i), price=1, is_deleted=random.random() < options['deleted'])
+                for i in range(rows))
+            # auto_now 会覆盖 bulk_create 的 update_time，通过SQL打散更新时间，每3行的更新时间相同
+            ids = Product._base_manager.values_list('id', flat=True)
+            with connection.cursor() as cursor:
+                cursor.executemany('UPDATE product SET update_time = %s WHERE id = %s',
+                                   [(start + timedelta(seconds=pk // 3), pk) for pk in ids.iterator()])
+            queryset = Product.objects.all()
+            fields = _fields(Product, ORDERING)
+            self.stdout.write('{:>8} {:>12} {:>12}'.format('page', 'OFFSET ms', 'keyset ms'))
+            page = 1
+            while page <= pages:
+                offset = (page - 1) * size
+                offset_seconds = timeit(lambda i: list(queryset.order_by(*ORDERING)[offset:offset + size]), repeat)
+                # 上一页的最后一行作为游标，这一步不计入耗时
+                after = None
+                if offset:
+                    last = queryset.order_by(*ORDERING)[offset - 1]
+                    after = KeysetPage([last], fields, True, False).next_cursor
+                keyset_seconds = timeit(lambda i: list(queryset.keyset(ORDERING, size, after=after)), repeat)
+                self.stdout.write('{:>8} {:>12.3f} {:>12.3f}'.format(
+                    page, offset_seconds * 1000, keyset_seconds * 1000))
+                page *= 10
@@ -0,0 +1,61 @@
+import random
+from django.db import connection
+from django.core.management.base import BaseCommand
+from app.models import Product, Customer
+from ._bench import rollback, timeit
+
+
+class Command(BaseCommand):
+    """
+    软删除部分索引的 benchmark
+    python manage.py bench_live_index --rows 10000000
+    测试数据在事务中写入，结束后回滚
+    """
+
+    help = 'Benchmark SoftDelManager lookups on the live (is_deleted=False) partial indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000000, help='每张表写入的行数')
+        parser.add_argument('--deleted', type=float, default=0.5, help='被软删除的数据占比')
+        parser.add_argument('--lookups', type=int, default=1000, help='每种查询执行的次数')
+
+    def handle(self, *args, **options):
+        rows, deleted, lookups = options['rows'], options['deleted'], options['lookups']
+        with rollback():
+            self.stdout.write('写入 {} 行测试数据...'.format(rows))
+            Product.objects.bulk_insert_stream(
+                Product(name='p{}'.format(i), price=i % 1000, is_deleted=random.random() < deleted)
+                for i in range(rows))
+            Customer.objects.bulk_insert_stream(
+                Customer(name='c{}'.format(i), age=i % 100, phone='{:011d}'.format(i),
+                         is_deleted=random.random() < deleted)
+                for i in range(rows))
+
+            cases = (
+                ('Product.objects.filter(name=...)',
+                 lambda: Product.objects.filter(name='p{}'.format(random.randrange(rows)))),
+                ('Customer.objects.filter(phone=...)',
+                 lambda: Customer.objects.filter(phone='{:011d}'.format(random.randrange(rows)))),
+            )
+            for title, make_queryset in cases:
+                # 包含 ORM 生成 SQL 和实例化 model 的耗时
+                seconds = timeit(lambda i: make_queryset().first(), lookups)
+                self.stdout.write('{}: {:.3f} ms/query (ORM) {}'.format(
+                    title, seconds * 1000, 'OK' if seconds < 0.001 else 'SLOW'))
+                # 只统计数据库执行 SQL 的耗时
+                statements = [make_queryset()[:1].query.sql_with_params() for _ in range(lookups)]
+                with connection.cursor() as cursor:
+
+                    def execute(i):
+                        # 只有 SQLite 的 execute 返回 cursor，其他数据库需要单独调用 fetchall
+                        cursor.execute(*statements[i])
+                        cursor.fetchall()
+
+                    seconds = timeit(execute, lookups)
+                self.stdout.write('{}: {:.3f} ms/query (SQL) {}'.format(
+                    title, seconds * 1000, 'OK' if seconds < 0.001 else 'SLOW'))
+
+            # 查询计划，确认 name 使用的是部分索引，phone 使用的是唯一索引
+            for queryset in (Product.objects.filter(name='p1'), Customer.objects.filter(phone='00000000001')):
+                self.stdout.write(str(queryset.query))
+                self.stdout.write(queryset.explain())
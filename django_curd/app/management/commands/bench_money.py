@@ -0,0 +1,66 @@
+import time
+from decimal import Decimal
+from django.db import connection, models
+from django.db.models import Sum
+from django.core.management.base import BaseCommand
+from app.models import Product
+from ._bench import rollback
+
+
+class DecimalProduct(models.Model):
+    """
+    改用 MoneyField 之前的商品价格字段，只在 benchmark 中临时创建
+    """
+
+    class Meta:
+        managed = False
+        app_label = 'app'
+        db_table = 'bench_decimal_product'
+
+    price = models.DecimalField('零售价', max_digits=40, decimal_places=28)
+    member_price = models.DecimalField('会员价', max_digits=40, decimal_places=28, null=True, blank=True)
+
+
+class Command(BaseCommand):
+    """
+    对比 DecimalField 和 MoneyField 读取数据的吞吐量
+    python manage.py bench_money --rows 1000000
+    测试数据在事务中写入，结束后回滚
+    """
+
+    help = 'Benchmark row-fetch throughput of DecimalField versus MoneyField prices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200000)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        # SQLite 不能在事务中使用 schema_editor，临时表在事务外创建，结束后删除
+        with connection.schema_editor() as editor:
+            editor.create_model(DecimalProduct)
+        try:
+            with rollback():
+                self.run(rows)
+        finally:
+            with connection.schema_editor() as editor:
+                editor.delete_model(DecimalProduct)
+
+    def run(self, rows):
+        prices = [(Decimal(i % 10000) + Decimal('0.99'), Decimal(i % 10000)) for i in range(rows)]
+        DecimalProduct.objects.bulk_create(DecimalProduct(price=price, member_price=member_price)
+                                           for price, member_price in prices)
+        Product.objects.bulk_insert_stream(Product(name='p', price=price, member_price=member_price)
+                                           for price, member_price in prices)
+        for title, model in (('DecimalField', DecimalProduct), ('MoneyField', Product)):
+            queryset = model._base_manager.all()
+            cases = (
+                ('instances', lambda: list(queryset.only('price', 'member_price'))),
+                ('values_list', lambda: list(queryset.values_list('price', 'member_price'))),
+                ('Sum', lambda: queryset.aggregate(price=Sum('price', output_field=model._meta.get_field('price')))),
+            )
+            for case, func in cases:
+                start = time.perf_counter()
+                func()
+                seconds = time.perf_counter() - start
+                self.stdout.write('{:<12} {:<12} {:>12.0f} rows/s {:>10.1f} ms'.format(
+                    title, case, rows / seconds, seconds * 1000))
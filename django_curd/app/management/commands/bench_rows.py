@@ -0,0 +1,49 @@
+import gc
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand
+from app.models import Product
+from ._bench import rollback
+
+FIELDS = ('id', 'name', 'price', 'member_price', 'update_time', 'supplier_id')
+
+
+class Command(BaseCommand):
+    """
+    对比 model 实例、values()、values_list()、rows() 读取数据的吞吐量和内存占用
+    python manage.py bench_rows --rows 1000000
+    测试数据在事务中写入，结束后回滚
+    """
+
+    help = 'Benchmark memory and throughput of rows() against instances, values() and values_list()'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        with rollback():
+            Product.objects.bulk_insert_stream(
+                Product(name='p{}'.format(i), price=i % 10000, member_price=i % 1000) for i in range(rows))
+            queryset = Product.objects.all()
+            cases = (
+                ('instances', lambda: list(queryset.only(*FIELDS))),
+                ('values', lambda: list(queryset.values(*FIELDS))),
+                ('values_list', lambda: list(queryset.values_list(*FIELDS))),
+                ('rows', lambda: list(queryset.rows(*FIELDS))),
+            )
+            self.stdout.write('{:<12} {:>12} {:>10} {:>12}'.format('mode', 'rows/s', 'ms', 'peak MB'))
+            for title, func in cases:
+                gc.collect()
+                start = time.perf_counter()
+                func()
+                seconds = time.perf_counter() - start
+                # tracemalloc 会拖慢执行，内存单独测量
+                gc.collect()
+                tracemalloc.start()
+                result = func()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                del result
+                self.stdout.write('{:<12} {:>12.0f} {:>10.1f} {:>12.1f}'.format(
+                    title, rows / seconds, seconds * 1000, peak / 1024 / 1024))
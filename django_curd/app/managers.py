@@ -0,0 +1,264 @@
+import time
+from itertools import islice
+from collections import namedtuple
+from django.db import models, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from . import cache, counters, identity, prefetch
+from .deletion import fast_delete
+from .fields import MoneyQuery
+from .keyset import keyset_page
+from .rows import RowIterable
+from .stream import stream, DEFAULT_CHUNK_SIZE
+from .upsert import bulk_upsert
+
+# 未被软删除的数据
+LIVE = Q(is_deleted=False)
+
+# 数据库没有声明单条语句参数上限时（如PostgreSQL），使用协议允许的最大参数个数
+DEFAULT_MAX_QUERY_PARAMS = 65535
+
+# bulk_insert_stream 每写入一批数据，通过回调报告的进度
+Progress = namedtuple('Progress', ('batches', 'rows', 'seconds', 'rows_per_second'))
+
+
+class SoftDelQuerySet(models.QuerySet):
+
+    _auto_prefetch = False
+    _cached = False
+    # 是否为 manager 直接返回的 queryset，只有这样的 queryset 才能通过 Identity Map 查询
+    _identity_base = False
+    _cache_timeout = None
+
+    def __init__(self, model=None, query=None, using=None, hints=None):
+        # SELECT 中的金额表达式见 fields.MoneyQuery
+        super().__init__(model, query or MoneyQuery(model), using, hints)
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._auto_prefetch = self._auto_prefetch
+        clone._cached = self._cached
+        clone._cache_timeout = self._cache_timeout
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        if self._cached and not fetched:
+            self._result_cache = cache.fetch(self, lambda: list(self._iterable_class(self)), self._cache_timeout)
+        super()._fetch_all()
+        if not fetched and self._iterable_class is models.query.ModelIterable:
+            if self._auto_prefetch:
+                prefetch.attach(self._result_cache)
+            im = identity.current()
+            if im is not None:
+                im.add(self._result_cache, self.db)
+
+    def _identity_lookup(self, pk):
+        im = identity.current()
+        if im is None or not self._identity_base:
+            return None
+        obj = im.get(self.model, self.db, identity.to_pk(self.model, pk))
+        # Identity Map 中可能有通过外键加载的已软删除的实例
+        return None if obj is None or obj.is_deleted else obj
+
+    def get(self, *args, **kwargs):
+        if not args and len(kwargs) == 1:
+            (lookup, value), = kwargs.items()
+            if lookup in ('pk', self.model._meta.pk.name, self.model._meta.pk.attname):
+                obj = self._identity_lookup(value)
+                if obj is not None:
+                    identity.current().hit(self.model)
+                    return obj
+        return super().get(*args, **kwargs)
+
+    def in_bulk(self, id_list=None, *, field_name='pk'):
+        im = identity.current()
+        if im is None or not self._identity_base or id_list is None \
+                or field_name not in ('pk', self.model._meta.pk.name):
+            return super().in_bulk(id_list, field_name=field_name)
+        found, missing = {}, []
+        for pk in id_list:
+            obj = self._identity_lookup(pk)
+            if obj is None:
+                missing.append(pk)
+            else:
+                found[obj.pk] = obj
+        if not missing:
+            im.hit(self.model)
+            return found
+        found.update(super().in_bulk(missing, field_name=field_name))
+        return found
+
+    def auto_prefetch(self):
+        """
+        自动 prefetch，查询结果中的任一实例访问外键或多对多字段时，一次性为所有实例加载该字段，详见 prefetch
+        """
+        clone = self._chain()
+        clone._auto_prefetch = True
+        return clone
+
+    def cached(self, timeout=None):
+        """
+        通过缓存读取查询结果，数据写入时自动失效，详见 cache
+        customer = Customer.objects.cached().get(id=1)
+        :param timeout: 共享缓存的过期时间，默认为 QUERYSET_CACHE['TIMEOUT']
+        """
+        clone = self._chain()
+        clone._cached = True
+        clone._cache_timeout = timeout
+        return clone
+
+    def keyset(self, ordering, size=20, after=None, before=None):
+        """
+        keyset 分页，通过游标翻页，不使用 OFFSET，详见 keyset.keyset_page
+        page = Product.objects.keyset(('-update_time', 'id'))
+        page = Product.objects.keyset(('-update_time', 'id'), after=page.next_cursor)
+        :return: KeysetPage
+        """
+        return keyset_page(self, ordering, size, after, before)
+
+    def rows(self, *fields):
+        """
+        与 values_list 相同，但每一行为可以通过属性访问字段的只读行对象，详见 rows
+        for product in Product.objects.rows('id', 'name', 'price'):
+            print(product.name, product.price)
+        :param fields: 需要查询的字段，可以跨外键，默认为model的所有字段
+        """
+        fields = fields or [field.attname for field in self.model._meta.concrete_fields]
+        clone = self.values_list(*fields)
+        clone._iterable_class = RowIterable
+        return clone
+
+    def stream(self, *fields, chunk_size=DEFAULT_CHUNK_SIZE, server_side=None):
+        """
+        流式读取，每一行为只包含 fields 的行对象，内存占用与数据总量无关，详见 stream.stream
+        for row in Order.objects.stream('id', 'count', 'customer__name', 'product__name'):
+            ...
+        """
+        return stream(self, fields, chunk_size, server_side)
+
+    def soft_delete(self):
+        """
+        软删除，同时记录删除时间，归档时根据删除时间判断数据是否可以移入归档表
+        :return: 受影响的行数
+        """
+        return self.update(is_deleted=True, delete_time=timezone.now())
+
+    def fast_delete(self, batch_size=None):
+        """
+        分批级联删除，不加载关联数据，删除前一次性检查 PROTECT，详见 deletion
+        :return: 每张表删除的行数
+        """
+        return fast_delete(self, batch_size)
+    fast_delete.alters_data = True
+    fast_delete.queryset_only = True
+
+    def insert_batch_size(self):
+        """
+        根据数据库单条语句的参数上限和model的字段数，计算每批insert的行数
+        SQLite 为 999 个参数，Product 有9个字段，每批 111 行
+        """
+        connection = connections[self.db]
+        max_params = getattr(connection.features, 'max_query_params', None) or DEFAULT_MAX_QUERY_PARAMS
+        return max(1, max_params // len(self.model._meta.concrete_fields))
+
+    def bulk_insert_stream(self, iterable, batch_size=None, callback=None):
+        """
+        流式的 bulk_create，按批次惰性消费 iterable（通常是生成器），每一批在单独的事务中写入
+        同一时间内存中只有一批数据，无论 iterable 有多大，占用的内存都是固定的
+        与 bulk_create 不同，不会返回创建的对象
+        :param iterable: model 实例或 dict
+        :param batch_size: 每批的行数，默认根据数据库参数上限自动计算
+        :param callback: 每写入一批后调用，参数为 Progress
+        :return: 写入的总行数
+        """
+        self._for_write = True
+        batch_size = batch_size or self.insert_batch_size()
+        iterator = (obj if isinstance(obj, models.Model) else self.model(**obj) for obj in iterable)
+        batches = rows = 0
+        start = time.perf_counter()
+        while True:
+            chunk = list(islice(iterator, batch_size))
+            if not chunk:
+                break
+            with transaction.atomic(using=self.db, savepoint=False):
+                self.bulk_create(chunk, batch_size)
+            batches += 1
+            rows += len(chunk)
+            if callback is not None:
+                seconds = time.perf_counter() - start
+                callback(Progress(batches, rows, seconds, rows / seconds if seconds else 0))
+        return rows
+
+    def bulk_upsert(self, rows, conflict_fields, update_fields, batch_size=None):
+        """
+        批量的 update_or_create，conflict_fields 相同的数据已存在时更新 update_fields，否则新增
+        已被软删除的数据会被恢复，详见 upsert.bulk_upsert
+        :return: (created, updated)
+        """
+        return bulk_upsert(self, rows, conflict_fields, update_fields, batch_size)
+
+
+class SoftDelManager(models.Manager.from_queryset(SoftDelQuerySet)):
+
+    def get_queryset(self):
+        queryset = super().get_queryset().filter(LIVE)
+        queryset._identity_base = True
+        return queryset
+
+
+class OrderQuerySet(SoftDelQuerySet):
+    """
+    bulk_create、update、delete 不会发送信号，在这里维护客户和商品的冗余计数，见 counters
+    """
+
+    # 修改这些字段时，需要重新计算计数
+    counter_fields = {'count', 'customer', 'customer_id', 'product', 'product_id'}
+
+    def _counter_keys(self):
+        return set(self.values_list('customer_id', 'product_id').distinct())
+
+    def _refresh_counters(self, keys):
+        counters.refresh({customer_id for customer_id, _ in keys}, {product_id for _, product_id in keys}, self.db)
+
+    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False):
+        self._for_write = True
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = super().bulk_create(objs, batch_size, ignore_conflicts)
+            self._refresh_counters({(obj.customer_id, obj.product_id) for obj in objs})
+        return objs
+
+    def update(self, **kwargs):
+        if not counters.enabled() or not self.counter_fields & set(kwargs):
+            return super().update(**kwargs)
+        self._for_write = True
+        with transaction.atomic(using=self.db, savepoint=False):
+            keys = self._counter_keys()
+            pks = []
+            if {'customer', 'customer_id', 'product', 'product_id'} & set(kwargs):
+                # 修改了订单的客户或商品，更新后还需要重新计算新的客户和商品
+                pks = list(self.values_list('pk', flat=True))
+            rows = super().update(**kwargs)
+            base = self.model._base_manager.using(self.db)
+            for start in range(0, len(pks), counters.REFRESH_BATCH_SIZE):
+                keys |= set(base.filter(pk__in=pks[start:start + counters.REFRESH_BATCH_SIZE]).values_list(
+                    'customer_id', 'product_id'))
+            self._refresh_counters(keys)
+        return rows
+    update.alters_data = True
+
+    def delete(self):
+        self._for_write = True
+        with transaction.atomic(using=self.db, savepoint=False):
+            keys = self._counter_keys()
+            # 删除后统一刷新，不需要在每条订单的post_delete中刷新
+            with counters.suspended():
+                result = super().delete()
+            self._refresh_counters(keys)
+        return result
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(condition=models.Q(is_deleted=False), fields=['phone'], name='customer_phone_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(is_deleted=False), fields=['id'], name='product_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(is_deleted=False), fields=['name'], name='product_name_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(is_deleted=False), fields=['supplier'], name='product_supplier_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='supplier',
+            index=models.Index(condition=models.Q(is_deleted=False), fields=['name'], name='supplier_name_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(condition=models.Q(is_deleted=False), fields=['name'], name='tag_name_live_idx'),
+        ),
+    ]
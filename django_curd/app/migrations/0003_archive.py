@@ -0,0 +1,124 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_live_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SupplierArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('is_deleted', models.BooleanField(default=False, verbose_name='是否删除')),
+                ('delete_time', models.DateTimeField(blank=True, null=True, verbose_name='删除时间')),
+                ('name', models.CharField(max_length=120, verbose_name='供应商')),
+                ('address', models.CharField(max_length=512, verbose_name='地址')),
+                ('archive_time', models.DateTimeField(verbose_name='归档时间')),
+            ],
+            options={
+                'db_table': 'supplier_archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('is_deleted', models.BooleanField(default=False, verbose_name='是否删除')),
+                ('delete_time', models.DateTimeField(blank=True, null=True, verbose_name='删除时间')),
+                ('customer_id', models.IntegerField(db_column='customer_id')),
+                ('product_id', models.IntegerField(db_column='product_id')),
+                ('count', models.IntegerField(verbose_name='总数')),
+                ('archive_time', models.DateTimeField(verbose_name='归档时间')),
+            ],
+            options={
+                'db_table': 'order_archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='TagArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('is_deleted', models.BooleanField(default=False, verbose_name='是否删除')),
+                ('delete_time', models.DateTimeField(blank=True, null=True, verbose_name='删除时间')),
+                ('name', models.CharField(max_length=24, verbose_name='标签')),
+                ('archive_time', models.DateTimeField(verbose_name='归档时间')),
+            ],
+            options={
+                'db_table': 'tag_archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='CustomerArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('is_deleted', models.BooleanField(default=False, verbose_name='是否删除')),
+                ('delete_time', models.DateTimeField(blank=True, null=True, verbose_name='删除时间')),
+                ('name', models.CharField(max_length=24, verbose_name='姓名')),
+                ('age', models.IntegerField(verbose_name='年龄')),
+                ('phone', models.CharField(max_length=11, verbose_name='手机')),
+                ('archive_time', models.DateTimeField(verbose_name='归档时间')),
+            ],
+            options={
+                'db_table': 'customer_archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductTagsArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('product_id', models.IntegerField(db_column='product_id')),
+                ('tag_id', models.IntegerField(db_column='tag_id')),
+                ('archive_time', models.DateTimeField(verbose_name='归档时间')),
+            ],
+            options={
+                'db_table': 'product_tags_archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('is_deleted', models.BooleanField(default=False, verbose_name='是否删除')),
+                ('delete_time', models.DateTimeField(blank=True, null=True, verbose_name='删除时间')),
+                ('name', models.CharField(max_length=24, verbose_name='商品名称')),
+                ('price', models.DecimalField(decimal_places=28, max_digits=40, verbose_name='零售价')),
+                ('member_price', models.DecimalField(blank=True, decimal_places=28, max_digits=40, null=True, verbose_name='会员价')),
+                ('update_time', models.DateTimeField(null=True, verbose_name='更新时间')),
+                ('supplier_id', models.IntegerField(db_column='supplier_id', null=True)),
+                ('archive_time', models.DateTimeField(verbose_name='归档时间')),
+            ],
+            options={
+                'db_table': 'product_archive',
+            },
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='delete_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='删除时间'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='delete_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='删除时间'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='delete_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='删除时间'),
+        ),
+        migrations.AddField(
+            model_name='supplier',
+            name='delete_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='删除时间'),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='delete_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='删除时间'),
+        ),
+    ]
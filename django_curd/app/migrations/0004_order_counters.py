@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='item_count',
+            field=models.IntegerField(default=0, verbose_name='购买商品总数'),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='product_count',
+            field=models.IntegerField(default=0, verbose_name='购买商品种类'),
+        ),
+        migrations.AddField(
+            model_name='customerarchive',
+            name='item_count',
+            field=models.IntegerField(default=0, verbose_name='购买商品总数'),
+        ),
+        migrations.AddField(
+            model_name='customerarchive',
+            name='product_count',
+            field=models.IntegerField(default=0, verbose_name='购买商品种类'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='sold_count',
+            field=models.IntegerField(default=0, verbose_name='销量'),
+        ),
+        migrations.AddField(
+            model_name='productarchive',
+            name='sold_count',
+            field=models.IntegerField(default=0, verbose_name='销量'),
+        ),
+    ]
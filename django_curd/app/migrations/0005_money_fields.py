@@ -0,0 +1,52 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:15
+
+import app.fields
+from django.conf import settings
+from django.db import migrations
+
+# 原来的 DecimalField 保存的是元，MoneyField 保存的是 1/10 ** MONEY_SCALE 元
+# MoneyField 的 scale 与 settings.MONEY_SCALE 一致，执行迁移后再修改 MONEY_SCALE 需要另外迁移已有的数据
+MONEY_SCALE = getattr(settings, 'MONEY_SCALE', app.fields.DEFAULT_MONEY_SCALE)
+SCALE = 10 ** MONEY_SCALE
+TABLES = ('product', 'product_archive')
+COLUMNS = ('price', 'member_price')
+
+
+def _update(expression):
+    return ['UPDATE {table} SET {column} = {expression}'.format(
+        table=table, column=column, expression=expression.format(column=column))
+        for table in TABLES for column in COLUMNS]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_order_counters'),
+    ]
+
+    operations = [
+        # 在原来的 decimal 列上先放大，再修改列类型，最后取整
+        migrations.RunSQL(_update('{{column}} * {}'.format(SCALE)),
+                          reverse_sql=_update('{{column}} / {}.0'.format(SCALE))),
+        migrations.AlterField(
+            model_name='product',
+            name='member_price',
+            field=app.fields.MoneyField(blank=True, null=True, scale=MONEY_SCALE, verbose_name='会员价'),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='price',
+            field=app.fields.MoneyField(scale=MONEY_SCALE, verbose_name='零售价'),
+        ),
+        migrations.AlterField(
+            model_name='productarchive',
+            name='member_price',
+            field=app.fields.MoneyField(blank=True, null=True, scale=MONEY_SCALE, verbose_name='会员价'),
+        ),
+        migrations.AlterField(
+            model_name='productarchive',
+            name='price',
+            field=app.fields.MoneyField(scale=MONEY_SCALE, verbose_name='零售价'),
+        ),
+        migrations.RunSQL(_update('CAST(ROUND({column}) AS BIGINT)'), reverse_sql=migrations.RunSQL.noop),
+    ]
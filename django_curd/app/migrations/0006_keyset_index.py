@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_money_fields'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(is_deleted=False), fields=['-update_time', 'id'], name='product_update_live_idx'),
+        ),
+    ]
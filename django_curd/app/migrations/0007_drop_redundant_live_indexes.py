@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:02
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_keyset_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='customer',
+            name='customer_phone_live_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_live_idx',
+        ),
+    ]
@@ -1,20 +1,38 @@
 from django.db import models
+from .managers import LIVE, SoftDelManager, OrderQuerySet
+from .archive import archive, archive_model
+from .fields import MoneyField
 
 # Create your models here.
 
 
+def live_index(*fields, name):
+    """
+    只包含未被软删除数据的部分索引（Partial Index）
+    SoftDelManager 的所有查询都会带上 is_deleted=False，部分索引只存放这部分数据，
+    在大量数据被软删除的表中，索引更小，查询时也不需要再回表过滤 is_deleted
+    部分索引需要 Django 2.2 及以上，MySQL 不支持部分索引，Django 会忽略这类索引
+    :param fields: 索引字段
+    :param name: 索引名称，不能超过30个字符
+    :return:
+    """
+    return models.Index(fields=list(fields), name=name, condition=LIVE)
+
+
 class BaseModel(models.Model):
 
     class Meta:
         abstract = True
 
     is_deleted = models.BooleanField('是否删除', default=False)
+    delete_time = models.DateTimeField('删除时间', null=True, blank=True)
 
-
-class SoftDelManager(models.Manager):
-
-    def get_queryset(self):
-        return super().get_queryset().filter(is_deleted=False)
+    @classmethod
+    def archive_deleted(cls, days=None, batch_size=500):
+        """
+        将软删除超过 days 天的数据移动到归档表，详见 archive.archive
+        """
+        return archive(cls, days=days, batch_size=batch_size)
 
 
 class Tag(BaseModel):
@@ -23,6 +41,9 @@ class Tag(BaseModel):
 
     class Meta:
         db_table = 'tag'
+        indexes = [
+            live_index('name', name='tag_name_live_idx'),
+        ]
 
     name = models.CharField('标签', max_length=24)
 
@@ -33,6 +54,9 @@ class Supplier(BaseModel):
 
     class Meta:
         db_table = 'supplier'
+        indexes = [
+            live_index('name', name='supplier_name_live_idx'),
+        ]
 
     name = models.CharField('供应商', max_length=120)
     address = models.CharField('地址', max_length=512)
@@ -44,13 +68,21 @@ class Product(BaseModel):
 
     class Meta:
         db_table = 'product'
+        indexes = [
+            live_index('name', name='product_name_live_idx'),
+            live_index('supplier', name='product_supplier_live_idx'),
+            # keyset 分页，Product.objects.keyset(('-update_time', 'id'))
+            live_index('-update_time', 'id', name='product_update_live_idx'),
+        ]
 
     name = models.CharField('商品名称', max_length=24)
-    price = models.DecimalField('零售价', max_digits=40, decimal_places=28)
-    member_price = models.DecimalField('会员价', max_digits=40, decimal_places=28, null=True, blank=True)
+    price = MoneyField('零售价')
+    member_price = MoneyField('会员价', null=True, blank=True)
     update_time = models.DateTimeField('更新时间', auto_now=True, null=True, blank=True)
     supplier = models.ForeignKey('Supplier', on_delete=models.PROTECT, verbose_name='供应商', null=True, blank=True)
     tags = models.ManyToManyField('Tag')
+    # 冗余计数，由Order维护，见counters
+    sold_count = models.IntegerField('销量', default=0)
 
 
 class Customer(BaseModel):
@@ -64,6 +96,9 @@ class Customer(BaseModel):
     age = models.IntegerField('年龄')
     products = models.ManyToManyField(Product, through='Order', through_fields=('customer', 'product'))
     phone = models.CharField('手机', max_length=11, unique=True)
+    # 冗余计数，由Order维护，见counters
+    item_count = models.IntegerField('购买商品总数', default=0)
+    product_count = models.IntegerField('购买商品种类', default=0)
 
     def __str__(self):
         return self.name
@@ -74,6 +109,8 @@ class Customer(BaseModel):
 
 class Order(BaseModel):
 
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         db_table = 'order'
 
@@ -82,4 +119,10 @@ class Order(BaseModel):
     count = models.IntegerField('总数')
 
 
-
+# 归档表，归档的数据通过 Product.archived 等 manager 查询
+TagArchive = archive_model(Tag)
+SupplierArchive = archive_model(Supplier)
+ProductArchive = archive_model(Product)
+ProductTagsArchive = archive_model(Product.tags.through, name='ProductTagsArchive')
+CustomerArchive = archive_model(Customer)
+OrderArchive = archive_model(Order)
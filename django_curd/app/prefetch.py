@@ -0,0 +1,118 @@
+import os
+import threading
+import traceback
+from collections import Counter
+import django
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+
+"""
+自动 prefetch
+遍历查询结果并访问外键或多对多字段时，忘记 select_related / prefetch_related 会导致 N+1 查询
+通过 Product.objects.auto_prefetch() 查询出的实例会记住同一批查询结果，
+当其中一个实例第一次访问某个关联字段时，一次性为同一批的所有实例 prefetch 这个关联字段
+settings.AUTO_PREFETCH_REPORT 为 True 时（默认与 DEBUG 相同），会记录触发自动 prefetch 的代码位置，
+这些位置在没有 auto_prefetch 时都会产生 N+1 查询，通过 report() 查看
+"""
+
+_local = threading.local()
+_report_lock = threading.Lock()
+# {(代码位置, model, 关联字段): 次数}
+_report = Counter()
+
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_DJANGO_DIR = os.path.dirname(os.path.abspath(django.__file__))
+
+
+def _call_site():
+    """
+    访问关联字段的代码位置，跳过 Django 和当前模块的调用栈
+    """
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame.filename)
+        if filename == os.path.abspath(__file__) or filename.startswith(_DJANGO_DIR):
+            continue
+        return '{}:{} in {}'.format(os.path.relpath(filename, _PROJECT_DIR), frame.lineno, frame.name)
+    return '<unknown>'
+
+
+def report():
+    """
+    可能产生 N+1 查询的代码位置
+    :return: [(代码位置, model, 关联字段, 次数)]，按次数倒序
+    """
+    with _report_lock:
+        return [(site, model, name, count) for (site, model, name), count in _report.most_common()]
+
+
+def clear_report():
+    with _report_lock:
+        _report.clear()
+
+
+def attach(instances):
+    """
+    让同一批查询结果的实例互相知道对方的存在
+    """
+    if len(instances) > 1:
+        for instance in instances:
+            instance._auto_prefetch_peers = instances
+
+
+class AutoPrefetchMixin:
+    """
+    关联字段的描述符，在第一次访问时为同一批的所有实例 prefetch
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is not None and not getattr(_local, 'active', False):
+            peers = instance.__dict__.get('_auto_prefetch_peers')
+            if peers is not None and not self._is_fetched(instance):
+                self._prefetch(instance, peers)
+        return super().__get__(instance, cls)
+
+    def _is_fetched(self, instance):
+        if isinstance(self, ForwardManyToOneDescriptor):
+            return self.field.is_cached(instance) or None in self.field.get_local_related_value(instance)
+        # 多对多和反向外键的 manager，已 prefetch 的数据在 _prefetched_objects_cache 中
+        manager = super().__get__(instance)
+        cache_name = getattr(manager, 'prefetch_cache_name', None) or manager.field.remote_field.get_cache_name()
+        return cache_name in getattr(instance, '_prefetched_objects_cache', {})
+
+    def _prefetch(self, instance, peers):
+        # 正向外键和多对多使用字段名，反向关联使用 product_set 这样的名称
+        if isinstance(self, ForwardManyToOneDescriptor) or not getattr(self, 'reverse', True):
+            name = self.field.name
+        else:
+            name = self.rel.get_accessor_name()
+        if getattr(settings, 'AUTO_PREFETCH_REPORT', settings.DEBUG):
+            with _report_lock:
+                _report[(_call_site(), type(instance).__name__, name)] += 1
+        # prefetch_related_objects 内部也会访问描述符，此时不再自动 prefetch
+        _local.active = True
+        try:
+            prefetch_related_objects([peer for peer in peers if not self._is_fetched(peer)], name)
+        finally:
+            _local.active = False
+
+
+def install(*models):
+    """
+    将 model 的外键、多对多、反向外键的描述符替换为支持自动 prefetch 的描述符
+    只有通过 auto_prefetch() 查询出的实例才会自动 prefetch，其他实例的行为不变
+    """
+    for model in models:
+        for field in model._meta.get_fields():
+            if not field.is_relation or field.one_to_one:
+                continue
+            name = field.name if field.concrete else field.get_accessor_name()
+            descriptor = model.__dict__.get(name)
+            if descriptor is None or isinstance(descriptor, AutoPrefetchMixin):
+                continue
+            descriptor.__class__ = type('AutoPrefetch' + type(descriptor).__name__,
+                                        (AutoPrefetchMixin, type(descriptor)), {})
+
+
+if __name__ == '__main__':
+    pass
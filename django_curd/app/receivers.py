@@ -0,0 +1,33 @@
+from django.dispatch import receiver
+from django.db.models.signals import pre_save, post_save, post_delete
+from . import counters
+from .models import Order
+
+
+# 通过save()和delete()修改单条订单时，维护客户和商品的冗余计数
+# bulk_create和queryset的update、delete不会发送信号，由OrderQuerySet维护
+@receiver(pre_save, sender=Order, dispatch_uid='order_counters_pre_save')
+def remember_order_keys(sender, instance, raw, using, **kwargs):
+    # 修改订单的客户或商品时，原来的客户和商品也需要重新计算
+    if instance.pk is not None and not raw and counters.enabled():
+        instance._counter_keys = list(sender._base_manager.using(using).filter(
+            pk=instance.pk).values_list('customer_id', 'product_id'))
+
+
+@receiver(post_save, sender=Order, dispatch_uid='order_counters_post_save')
+def refresh_order_counters(sender, instance, raw, using, **kwargs):
+    if raw:
+        return
+    keys = getattr(instance, '_counter_keys', [])
+    keys.append((instance.customer_id, instance.product_id))
+    counters.refresh({customer_id for customer_id, _ in keys}, {product_id for _, product_id in keys}, using)
+    instance._counter_keys = []
+
+
+@receiver(post_delete, sender=Order, dispatch_uid='order_counters_post_delete')
+def refresh_deleted_order_counters(sender, instance, using, **kwargs):
+    counters.refresh([instance.customer_id], [instance.product_id], using)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,70 @@
+from functools import lru_cache
+from itertools import chain
+from collections import namedtuple
+from django.db.models.query import BaseIterable
+from django.db.models.sql.constants import MULTI
+
+"""
+只读的轻量行对象
+实例化 model 的开销很大，values() 每一行的 dict 同样占用不少内存
+Product.objects.rows('id', 'name', 'price') 每一行为一个自动生成的 namedtuple（ProductRow），
+与 values_list 一样只是一个 tuple，但可以通过属性访问字段
+values_list 对每一行的每个字段都要遍历一次转换函数（如 Decimal、datetime 的转换）的列表，
+rows() 在每次查询开始时，根据需要转换的字段生成一个构造行对象的函数，每一行只需要调用一次这个函数
+"""
+
+
+@lru_cache(maxsize=None)
+def row_class(model, names):
+    """
+    生成行对象的类，如 Product 的 ProductRow，同样的字段只生成一次
+    :param model:
+    :param names: 字段名称的 tuple，可以跨外键，如 ('id', 'customer__name')
+    :return:
+    """
+    return namedtuple('{}Row'.format(model.__name__), names)
+
+
+def row_factory(row_class, converters, connection):
+    """
+    生成将数据库返回的一行数据转换为行对象的函数，例如：
+    lambda row: new(cls, (row[0], c2_0(c2_1(row[2], e2, connection), e2, connection)))
+    不需要转换的字段直接取值，需要转换的字段把转换函数嵌套调用
+    :param row_class:
+    :param converters: compiler.get_converters 的结果，{列序号: ([转换函数], 表达式)}
+    :param connection:
+    :return:
+    """
+    namespace = {'new': tuple.__new__, 'cls': row_class, 'connection': connection}
+    values = []
+    for index in range(len(row_class._fields)):
+        value = 'row[{}]'.format(index)
+        if index in converters:
+            functions, expression = converters[index]
+            namespace['e{}'.format(index)] = expression
+            for number, function in enumerate(functions):
+                name = 'c{}_{}'.format(index, number)
+                namespace[name] = function
+                value = '{}({}, e{}, connection)'.format(name, value, index)
+        values.append(value)
+    return eval('lambda row: new(cls, ({},))'.format(', '.join(values)), namespace)
+
+
+class RowIterable(BaseIterable):
+    """
+    QuerySet.rows() 使用的 iterable，每一行为 row_class 生成的行对象
+    """
+
+    def __iter__(self):
+        queryset = self.queryset
+        query = queryset.query
+        compiler = query.get_compiler(queryset.db)
+        results = compiler.execute_sql(MULTI, chunked_fetch=self.chunked_fetch, chunk_size=self.chunk_size)
+        names = (*query.extra_select, *query.values_select, *query.annotation_select)
+        converters = compiler.get_converters([select[0] for select in compiler.select[0:compiler.col_count]])
+        factory = row_factory(row_class(queryset.model, names), converters, compiler.connection)
+        return map(factory, chain.from_iterable(results))
+
+
+if __name__ == '__main__':
+    pass
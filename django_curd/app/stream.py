@@ -0,0 +1,62 @@
+from django.db import connections
+from .rows import row_class
+
+"""
+大数据量的流式读取
+list(Order.objects.all()) 会把所有数据加载到内存中，并为每一行创建model实例
+stream() 只查询需要的字段，每一行为 rows() 的行对象，数据分块读取，内存占用与数据总量无关：
+PostgreSQL 使用服务端游标（settings 中没有设置 DISABLE_SERVER_SIDE_CURSORS 时），
+SQLite 逐行读取查询结果，其他数据库（如MySQL会把查询结果全部缓存在客户端）按主键分块查询
+字段可以跨外键，如 Order.objects.stream('id', 'count', 'customer__name', 'product__name')，
+相当于 select_related 后只查询这些字段
+"""
+
+# 每次从数据库读取的行数
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def supports_streaming(connection):
+    """
+    数据库是否可以在不缓存全部结果的情况下逐块读取
+    """
+    if connection.vendor == 'postgresql':
+        return not connection.settings_dict.get('DISABLE_SERVER_SIDE_CURSORS')
+    return connection.vendor == 'sqlite'
+
+
+def _keyset_chunks(queryset, fields, chunk_size):
+    """
+    按主键分块查询，每一块都是一条独立的SQL，通过 pk > 上一块最后的主键 定位
+    """
+    row = row_class(queryset.model, tuple(fields))
+    queryset = queryset.order_by('pk').values_list('pk', *fields)
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        last = chunk[-1][0]
+        for values in chunk:
+            yield row._make(values[1:])
+
+
+def stream(queryset, fields=(), chunk_size=DEFAULT_CHUNK_SIZE, server_side=None):
+    """
+    流式读取查询结果
+    :param queryset:
+    :param fields: 需要查询的字段，可以跨外键，默认为model的所有字段
+    :param chunk_size: 每次从数据库读取的行数
+    :param server_side: 是否使用数据库的流式读取，默认根据数据库判断，为False时按主键分块查询
+    :return: 行对象的迭代器
+    """
+    fields = list(fields) or [field.attname for field in queryset.model._meta.concrete_fields]
+    if server_side is None:
+        server_side = supports_streaming(connections[queryset.db])
+    if server_side:
+        return queryset.rows(*fields).iterator(chunk_size)
+    return _keyset_chunks(queryset, fields, chunk_size)
+
+
+if __name__ == '__main__':
+    pass
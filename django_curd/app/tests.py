@@ -1,11 +1,18 @@
+import base64
 import decimal
 from decimal import Decimal
 from datetime import datetime
-from django.test import TestCase
+from io import StringIO
+from django.test import TestCase, TransactionTestCase
+from django.core.management import call_command
 from django.db import transaction
 from django.core.exceptions import *
 from django.db.models.deletion import ProtectedError
+from django.db.models.signals import m2m_changed
 from django.db.models import DecimalField, F, Q, Sum, Max, Min, Avg, Count
+from . import cache, keyset
+from .identity import identity_map
+from .fields import Money, MoneyField
 from .models import BaseModel, SoftDelManager, Customer, Product, Tag, Supplier, Order
 
 
@@ -142,6 +149,28 @@ class CURDTestCase(TestCase):
         # .count()获取总行数
         self.assertEqual(Product.objects.filter(name__endswith='水笔').count(), 3)
 
+    def test_bulk_insert_stream(self):
+        """
+        流式批量新增，数据量很大时，不需要一次性把所有的model放入list
+        :return:
+        """
+        # 批次大小根据数据库参数上限和字段数自动计算，SQLite为999个参数
+        batch_size = Product.objects.insert_batch_size()
+        self.assertEqual(batch_size, 999 // len(Product._meta.concrete_fields))
+        # 传入生成器，数据按批次被消费，不会一次性全部加载到内存
+        products = (Product(name='水笔{}'.format(i), price=i) for i in range(batch_size * 2 + 1))
+        progress = []
+        rows = Product.objects.bulk_insert_stream(products, callback=progress.append)
+        self.assertEqual(rows, batch_size * 2 + 1)
+        self.assertEqual(Product.objects.filter(name__startswith='水笔').count(), rows)
+        # 每写入一批数据回调一次
+        self.assertEqual([item.rows for item in progress], [batch_size, batch_size * 2, rows])
+        self.assertEqual(progress[-1].batches, 3)
+        # 也可以传入dict
+        rows = Customer.objects.bulk_insert_stream(
+            {'name': '客户{}'.format(i), 'age': 30, 'phone': '1880000000{}'.format(i)} for i in range(5))
+        self.assertEqual(rows, 5)
+
     def test_update(self):
         """
         对queryset查询出来的数据进行update
@@ -217,6 +246,60 @@ class CURDTestCase(TestCase):
             product = Product.objects.get(id=1)
             self.assertIsNone(product)
 
+    def test_live_index(self):
+        """
+        软删除的部分索引，索引中只包含is_deleted=False的数据
+        :return:
+        """
+        # SoftDelManager的查询条件包含了is_deleted=False，所以可以使用部分索引
+        plan = Product.objects.filter(name='手机').explain()
+        self.assertIn('product_name_live_idx', plan)
+        plan = Tag.objects.filter(name='食品').explain()
+        self.assertIn('tag_name_live_idx', plan)
+        # 不经过SoftDelManager的查询，没有is_deleted=False的条件，无法使用部分索引
+        plan = Product._base_manager.filter(name='手机').explain()
+        self.assertNotIn('product_name_live_idx', plan)
+
+    def test_archive(self):
+        """
+        归档软删除的数据
+        :return:
+        """
+        # 软删除矿泉水，矿泉水有购买记录，也有"食品"和"饮料"两个标签
+        Product.objects.filter(id=4).soft_delete()
+        # 刚删除的数据还不到归档的时间
+        self.assertEqual(Product.archive_deleted(), {})
+        self.assertTrue(Product._base_manager.filter(id=4).exists())
+        # days=0，立即归档
+        moved = Product.archive_deleted(days=0)
+        self.assertEqual(moved, {'product': 1, 'order': 2, 'product_tags': 2})
+        # 原表中已经没有矿泉水和相关的购买记录
+        self.assertFalse(Product._base_manager.filter(id=4).exists())
+        self.assertFalse(Order.objects.filter(product_id=4).exists())
+        # 通过archived查询归档的数据
+        product = Product.archived.get(id=4)
+        self.assertEqual(product.name, '矿泉水')
+        self.assertTrue(product.is_deleted)
+        self.assertEqual(Order.archived.filter(product_id=4).count(), 2)
+        # 归档的订单不再计入客户的冗余计数
+        for customer in Customer.objects.all():
+            orders = Order.objects.filter(customer=customer)
+            self.assertEqual((customer.item_count, customer.product_count),
+                             (sum(orders.values_list('count', flat=True)),
+                              orders.values('product_id').distinct().count()))
+        self.assertEqual(Product.tags.through.archived.filter(product_id=4).count(), 2)
+        # 直接通过update软删除的数据没有删除时间，归档时补上删除时间，满days天后才会归档
+        Tag.objects.filter(name='饮料').update(is_deleted=True)
+        self.assertEqual(Tag.archive_deleted(), {})
+        self.assertIsNotNone(Tag._base_manager.get(name='饮料').delete_time)
+        # 供应商仍被商品引用(PROTECT)时，不会被归档
+        Supplier.objects.filter(name='桶一食品').update(is_deleted=True)
+        self.assertEqual(Supplier.archive_deleted(days=0), {})
+        # 商品归档后，供应商也可以归档了
+        Product.objects.filter(supplier__name='桶一食品').soft_delete()
+        Product.archive_deleted(days=0)
+        self.assertEqual(Supplier.archive_deleted(days=0), {'supplier': 1})
+
     def test_update_or_create(self):
         """
         update_or_create 返回tuple
@@ -234,6 +317,80 @@ class CURDTestCase(TestCase):
         self.assertTrue(created)  # 创建新的数据，所以created为True
         self.assertEqual(product.id, len(self.product_list) + 1)  # create, id 应该自增
 
+    def test_bulk_upsert(self):
+        """
+        批量的 update_or_create，每一批数据只需要执行一条SQL
+        :return:
+        """
+        # 手机号有唯一约束，使用数据库的 INSERT ... ON CONFLICT
+        Customer.objects.filter(phone='13252034306').soft_delete()
+        created, updated = Customer.objects.bulk_upsert([
+            {'name': '王一一', 'age': 22, 'phone': '15689776542'},
+            # 已被软删除的李四，会被恢复
+            {'name': '李四', 'age': 14, 'phone': '13252034306'},
+            {'name': '赵五', 'age': 30, 'phone': '13900000000'},
+        ], conflict_fields=['phone'], update_fields=['name', 'age'])
+        self.assertEqual((created, updated), (1, 2))
+        self.assertEqual(Customer.objects.get(phone='15689776542').name, '王一一')
+        lisi = Customer.objects.get(phone='13252034306')
+        self.assertEqual((lisi.id, lisi.age, lisi.delete_time), (4, 14, None))
+        self.assertEqual(Customer.objects.get(phone='13900000000').age, 30)
+        # 再执行一次，全部为更新
+        created, updated = Customer.objects.bulk_upsert([
+            {'name': '王一一', 'age': 23, 'phone': '15689776542'},
+            {'name': '赵五', 'age': 31, 'phone': '13900000000'},
+        ], conflict_fields=['phone'], update_fields=['age'])
+        self.assertEqual((created, updated), (0, 2))
+        # 商品名称没有唯一约束，通过临时表合并
+        created, updated = Product.objects.bulk_upsert([
+            Product(name='耳机', price=399, member_price=388),
+            Product(name='电视', price=3999, member_price=2999),
+        ], conflict_fields=['name'], update_fields=['member_price'])
+        self.assertEqual((created, updated), (1, 1))
+        self.assertEqual(Product.objects.get(name='耳机').member_price, 388)
+        self.assertEqual(Product.objects.get(name='电视').id, len(self.product_list) + 1)
+
+    def test_order_counters(self):
+        """
+        冗余计数，不需要每次查询时join订单表
+        :return:
+        """
+        def counters(customer_id):
+            customer = Customer.objects.get(id=customer_id)
+            return customer.item_count, customer.product_count
+
+        # bulk_create 新增的订单，王一买了手机2件、矿泉水5件、饼干10件
+        self.assertEqual(counters(1), (17, 3))
+        self.assertEqual(Customer.objects.get(id=1).item_count,
+                         Customer.objects.annotate(count=Sum('order__count')).get(id=1).count)
+        # 饼干被王一、周二、张三分别买了10、3、1件
+        self.assertEqual(Product.objects.get(id=5).sold_count, 14)
+        # queryset update
+        Order.objects.filter(customer_id=1, product_id=5).update(count=F('count') + 1)
+        self.assertEqual(counters(1), (18, 3))
+        self.assertEqual(Product.objects.get(id=5).sold_count, 15)
+        # 修改订单的商品，原来的商品和新的商品都会重新计算
+        Order.objects.filter(customer_id=1, product_id=5).update(product_id=1)
+        self.assertEqual(counters(1), (18, 2))
+        self.assertEqual(Product.objects.get(id=5).sold_count, 4)
+        # save和delete，通过信号维护
+        order = Order.objects.create(customer_id=5, product_id=2, count=3)
+        self.assertEqual(counters(5), (3, 1))
+        order.count = 4
+        order.save()
+        self.assertEqual(counters(5), (4, 1))
+        order.delete()
+        self.assertEqual(counters(5), (0, 0))
+        # queryset delete
+        Order.objects.filter(customer_id=2).delete()
+        self.assertEqual(counters(2), (0, 0))
+        # 修正有偏差的计数
+        Customer.objects.filter(id=3).update(item_count=0)
+        out = StringIO()
+        call_command('rebuild_counters', workers=1, stdout=out)
+        self.assertIn('Customer: 1 drifted rows rebuilt', out.getvalue())
+        self.assertEqual(counters(3), (12, 3))
+
     def test_order_by(self):
         """
         排序
@@ -246,6 +403,65 @@ class CURDTestCase(TestCase):
         customers = Customer.objects.order_by('-age').first()
         self.assertEqual(customers.name, '周二')
 
+    def test_keyset(self):
+        """
+        keyset分页，通过游标翻页，页数再深也不需要OFFSET
+        :return:
+        """
+        from django.core.paginator import InvalidPage
+        Product.objects.bulk_create(Product(name='商品{}'.format(i), price=i) for i in range(10))
+        # auto_now 对 update 无效，通过 update 设置不同的更新时间
+        for day in range(3):
+            Product.objects.filter(name__in=['商品{}'.format(i) for i in range(day, 10, 3)]).update(
+                update_time=datetime(year=2018, month=6, day=day + 1))
+        ordering = ('-update_time', 'id')
+        expected = list(Product.objects.order_by(*ordering).values_list('id', flat=True))
+        # 向后翻页
+        pages = []
+        page = Product.objects.keyset(ordering, size=4)
+        self.assertFalse(page.has_previous)
+        while True:
+            pages.append([product.id for product in page])
+            if not page.has_next:
+                break
+            page = Product.objects.keyset(ordering, size=4, after=page.next_cursor)
+        self.assertEqual([pk for ids in pages for pk in ids], expected)
+        self.assertEqual([len(ids) for ids in pages], [4, 4, 4, 4])
+        # 向前翻页
+        page = Product.objects.keyset(ordering, size=4, before=page.previous_cursor)
+        self.assertEqual([product.id for product in page], pages[-2])
+        self.assertTrue(page.has_previous)
+        # 同样会过滤软删除的数据
+        Product.objects.filter(id=pages[0][1]).soft_delete()
+        page = Product.objects.keyset(ordering, size=4)
+        self.assertEqual([product.id for product in page], [pages[0][0]] + pages[0][2:] + [pages[1][0]])
+        # 第一个排序字段的范围条件，便于使用(update_time, id)的索引
+        queryset = Product.objects.order_by(*ordering)
+        self.assertIn('product_update_live_idx', queryset.filter(
+            keyset._seek(keyset._fields(Product, ordering), [datetime(2018, 6, 2), 3], False)).explain())
+        with self.assertRaises(InvalidPage):
+            Product.objects.keyset(ordering, after='not a cursor')
+        # 游标中的值无法转换为字段的类型
+        with self.assertRaises(InvalidPage):
+            Product.objects.keyset(ordering, after=base64.urlsafe_b64encode(b'["garbage", "1"]').decode())
+        # update_time 为 NULL 的数据，倒序时排在最前面，不会被跳过
+        Product.objects.filter(name__in=['商品1', '商品5', '商品8']).update(update_time=None)
+        live = list(Product.objects.values_list('update_time', 'id'))
+        expected = [pk for _, pk in sorted(live, key=lambda row: (row[0] is None, row[0] or datetime.min, -row[1]),
+                                            reverse=True)]
+        for size in (1, 2, 4):
+            pages = [Product.objects.keyset(ordering, size=size)]
+            while pages[-1].has_next:
+                pages.append(Product.objects.keyset(ordering, size=size, after=pages[-1].next_cursor))
+            self.assertEqual([product.id for page in pages for product in page], expected)
+            # 向前翻页同样可以回到第一页
+            page = pages[-1]
+            ids = [product.id for product in page]
+            while page.has_previous:
+                page = Product.objects.keyset(ordering, size=size, before=page.previous_cursor)
+                ids = [product.id for product in page] + ids
+            self.assertEqual(ids, expected)
+
     def test_filter_exculde(self):
         """
         filter and exculde
@@ -316,11 +532,58 @@ class CURDTestCase(TestCase):
         customer = Customer.objects.values_list('name').first()
         self.assertIsInstance(customer, tuple)
 
+    def test_stream(self):
+        """
+        流式读取，适合导出大量数据
+        :return:
+        """
+        expected = [(order.id, order.count, order.customer.name, order.product.name)
+                    for order in Order.objects.select_related('customer', 'product').order_by('id')]
+        # SQLite 逐行读取查询结果
+        rows = Order.objects.stream('id', 'count', 'customer__name', 'product__name', chunk_size=5)
+        rows = sorted(rows)
+        self.assertEqual(rows, expected)
+        # 每一行是namedtuple，而不是model实例
+        self.assertEqual(rows[0].customer__name, '王一')
+        # 不支持流式读取的数据库，按主键分块查询
+        with self.assertNumQueries(4):
+            rows = list(Order.objects.stream('id', 'count', 'customer__name', 'product__name',
+                                             chunk_size=5, server_side=False))
+        self.assertEqual(rows, expected)
+        # 默认查询所有字段，同样会过滤软删除的数据
+        Product.objects.filter(id=1).soft_delete()
+        rows = list(Product.objects.stream(server_side=False))
+        self.assertEqual(len(rows), len(self.product_list) - 1)
+        self.assertEqual(rows[0].supplier_id, 2)
+
+    def test_rows(self):
+        """
+        只读的轻量行对象，比values()的dict更轻，又可以通过属性访问
+        :return:
+        """
+        product_list = list(Product.objects.order_by('id').rows('id', 'name', 'price', 'update_time'))
+        # 与values_list的结果相同，包括Decimal、datetime的转换
+        self.assertEqual(product_list, list(Product.objects.order_by('id').values_list(
+            'id', 'name', 'price', 'update_time')))
+        phone = product_list[0]
+        self.assertEqual(type(phone).__name__, 'ProductRow')
+        self.assertEqual((phone.name, phone.price), ('手机', Decimal(3999)))
+        self.assertIsInstance(phone.update_time, datetime)
+        # 只读
+        with self.assertRaises(AttributeError):
+            phone.name = '电话'
+        # 默认查询所有字段
+        customer = Customer.objects.filter(phone='13034451353').rows().get()
+        self.assertEqual((customer.name, customer.age), ('周二', 72))
+        # 跨外键
+        order = Order.objects.filter(customer__name='张三').order_by('id').rows('count', 'product__price').first()
+        self.assertEqual((order.count, order.product__price), (3, Decimal(3999)))
+
     def test_f_object(self):
         with transaction.atomic():
             # F对象，使用查询条件中字段的值，参与比较
             # 查询会员价大于零售价的商品，可能是大数据杀熟
-            product_list = Product.objects.filter(member_price__gte=F('price')).all()
+            product_list = Product.objects.filter(member_price__gte=F('price')).order_by('id').all()
             assert product_list[0].name
             self.assertEqual(product_list[0].name, '电脑')
             # 电脑涨价
@@ -411,6 +674,7 @@ class CURDTestCase(TestCase):
             price = models.DecimalField('零售价', max_digits=10, decimal_places=6)
             member_price = models.DecimalField('会员价', max_digits=10, decimal_places=6, null=True, blank=True)
             supplier = models.ForeignKey('Supplier', on_delete=models.PROTECT, verbose_name='供应商', null=True, blank=True)
+            sold_count = models.IntegerField('销量', default=0)
 
             class Meta:
                 managed = False
@@ -460,16 +724,17 @@ class CURDTestCase(TestCase):
         :return:
         """
         # Sum等对象的output_field参数可以设置输出的字段类型
-        data = Product.objects.aggregate(price=Sum('price', output_field=DecimalField()))
+        # price 为 MoneyField，数据库中保存的是最小货币单位，output_field 需要为 MoneyField，见 test_money_field
+        data = Product.objects.aggregate(price=Sum('price', output_field=MoneyField()))
         self.assertEqual(data['price'], Decimal(sum((item[2] for item in self.product_list))))
         # Max
-        data = Product.objects.aggregate(price=Max('price', output_field=DecimalField()))
+        data = Product.objects.aggregate(price=Max('price', output_field=MoneyField()))
         self.assertEqual(data['price'], Decimal(max((item[2] for item in self.product_list))))
         # Min
-        data = Product.objects.aggregate(price=Min('price', output_field=DecimalField()))
+        data = Product.objects.aggregate(price=Min('price', output_field=MoneyField()))
         self.assertEqual(data['price'], Decimal(min((item[2] for item in self.product_list))))
         # Avg
-        data = Product.objects.aggregate(price=Avg('price', output_field=DecimalField()))
+        data = Product.objects.aggregate(price=Avg('price', output_field=MoneyField()))
         self.assertEqual(data['price'], Decimal(sum((item[2] for item in self.product_list)) / len(self.product_list)))
         # Count
         # Count还有个参数为distinct，默认为False，当为True时，只统计不重复的数据
@@ -490,6 +755,45 @@ class CURDTestCase(TestCase):
             if customer.count is not None:
                 self.assertTrue(customer.count > 0)
 
+    def test_money_field(self):
+        """
+        MoneyField 在数据库中以整数保存金额
+        :return:
+        """
+        from django.db import connection
+        Product.objects.filter(id=3).update(member_price=Decimal('299.12345'))
+        # 数据库中保存的是 1/10000 元，超出精度的部分四舍五入
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT price, member_price FROM product WHERE id = 3')
+            self.assertEqual(cursor.fetchone(), (3990000, 2991235))
+        # 读取时转换为Decimal
+        product = Product.objects.get(id=3)
+        self.assertEqual((product.price, product.member_price), (Decimal('399'), Decimal('299.1235')))
+        self.assertEqual(Product.objects.filter(id=3).values_list('member_price', flat=True)[0], Decimal('299.1235'))
+        # 查询条件同样会转换
+        self.assertTrue(Product.objects.filter(member_price=Decimal('299.1235')).exists())
+        # 与金额相加减的常量以元为单位，包括查询条件和save()
+        self.assertTrue(Product.objects.filter(id=3, price__gt=F('member_price') + 99).exists())
+        self.assertFalse(Product.objects.filter(id=3, price__gt=F('member_price') + 100).exists())
+        product.price = F('price') * 2 - Decimal('0.5')
+        product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.price, Decimal('797.5'))
+        # 不指定output_field时，聚合函数的结果同样会转换为Decimal
+        self.assertEqual(Product.objects.filter(id=3).aggregate(price=Sum('price'))['price'], Decimal('797.5'))
+        # SELECT 中与金额相加减的常量同样以元为单位
+        product = Product.objects.annotate(plus=F('price') + Money(1), raw=F('price') + 1).get(id=3)
+        self.assertEqual((product.plus, product.raw), (Decimal('798.5'), Decimal('798.5')))
+        self.assertEqual(Product.objects.filter(id=3).aggregate(price=Sum(F('price') - 1))['price'], Decimal('796.5'))
+        self.assertEqual(Product.objects.filter(id=3).aggregate(price=Sum('price', output_field=MoneyField()))['price'],
+                         Decimal('797.5'))
+        # 金额作为其他类型返回时，数据库返回的是最小货币单位，无法转换
+        with self.assertRaises(FieldError):
+            Product.objects.aggregate(price=Sum('price', output_field=DecimalField()))
+        with self.assertRaises(FieldError):
+            Customer.objects.annotate(total=Sum('order__product__price', output_field=DecimalField()))
+        self.assertEqual(Product.objects.aggregate(count=Count('price'))['count'], len(self.product_list))
+
     def test_contains(self):
         """
         等价于SQL的like "%xxxx%"
@@ -631,3 +935,224 @@ class CURDTestCase(TestCase):
         # 再遍历商品数据时，访问商品的供应商数据，不会再触发数据库访问
         for product in product_list.all():
             self.assertIsNotNone(product.tags.all())
+
+    def test_auto_prefetch(self):
+        """
+        自动prefetch，不需要手动选择select_related或prefetch_related
+        :return:
+        """
+        from . import prefetch
+        prefetch.clear_report()
+        # 没有自动prefetch时，每个商品访问供应商都需要查询一次，即N+1查询
+        product_list = list(Product.objects.all())
+        with self.assertNumQueries(len(product_list)):
+            for product in product_list:
+                self.assertIsNotNone(product.supplier)
+        # 自动prefetch，第一个商品访问供应商时，一次查询出所有商品的供应商
+        product_list = list(Product.objects.auto_prefetch())
+        with self.assertNumQueries(1):
+            for product in product_list:
+                self.assertIsNotNone(product.supplier)
+        # 多对多同样有效
+        with self.assertNumQueries(1):
+            for product in product_list:
+                self.assertTrue(len(product.tags.all()) > 0)
+        # 通过Order关联的多对多
+        customer_list = list(Customer.objects.auto_prefetch().order_by('id'))
+        with self.assertNumQueries(1):
+            counts = [len(customer.products.all()) for customer in customer_list]
+        self.assertEqual(counts, [3, 3, 3, 3, 0])
+        # 反向外键
+        supplier_list = list(Supplier.objects.auto_prefetch())
+        with self.assertNumQueries(1):
+            for supplier in supplier_list:
+                list(supplier.product_set.all())
+        # 记录了可能产生N+1查询的代码位置
+        with self.settings(AUTO_PREFETCH_REPORT=True):
+            product_list = list(Product.objects.auto_prefetch())
+            self.assertIsNotNone(product_list[0].supplier)
+        site, model, name, count = prefetch.report()[0]
+        self.assertIn('tests.py', site)
+        self.assertEqual((model, name), ('Product', 'supplier'))
+
+    def test_identity_map(self):
+        """
+        Identity Map，同一个请求中相同主键的数据只查询一次
+        :return:
+        """
+        with identity_map() as im:
+            with self.assertNumQueries(1):
+                product_list = [product for product in Product.objects.all() if product.supplier_id]
+            # 每个供应商只查询一次，之后直接使用已加载的实例
+            supplier_ids = {product.supplier_id for product in product_list}
+            with self.assertNumQueries(len(supplier_ids)):
+                supplier_list = [product.supplier for product in product_list]
+            for product, supplier in zip(product_list, supplier_list):
+                self.assertIs(supplier, Supplier.objects.get(id=product.supplier_id))
+            with self.assertNumQueries(0):
+                product = product_list[0]
+                self.assertIs(Product.objects.get(pk=product.pk), product)
+                self.assertIs(Product.objects.in_bulk([product.pk])[product.pk], product)
+            # 部分主键未加载时，只查询未加载的部分
+            with self.assertNumQueries(1):
+                self.assertEqual(len(Product.objects.in_bulk([product.pk, 999])), 1)
+            # 带有其他查询条件时仍然查询数据库
+            with self.assertNumQueries(1):
+                Product.objects.filter(price__gt=0).get(pk=product.pk)
+            # 写入后，这张表的实例从 Identity Map 中移除
+            Product.objects.filter(pk=product.pk).update(name='新名称')
+            with self.assertNumQueries(1):
+                self.assertEqual(Product.objects.get(pk=product.pk).name, '新名称')
+            avoided = len(product_list) - len(supplier_ids) + len(product_list) + 2
+            self.assertEqual(im.stats()['avoided'], avoided)
+            self.assertEqual(im.stats()['avoided_by_model']['Product'], 2)
+        # identity_map() 之外不生效
+        with self.assertNumQueries(1):
+            Product.objects.get(pk=product.pk)
+
+    def test_bulk_m2m(self):
+        """
+        批量修改多对多关系，与中间表的差异在数据库中计算
+        :return:
+        """
+        phone, computer, water = (Product.objects.get(id=id_) for id_ in (1, 2, 4))
+        # 没有m2m_changed的receiver时，每批只执行一条INSERT
+        with self.assertNumQueries(1):
+            added = Product.tags.bulk_add({phone.id: [1, 2], computer.id: [1, 3]})
+        self.assertEqual(added, 2)
+        self.assertEqual(set(phone.tags.values_list('id', flat=True)), {1, 2})
+        # bulk_set 同时增加和移除，mapping中没有的商品不受影响
+        added, removed = Product.tags.bulk_set({phone.id: [3], water.id: []})
+        self.assertEqual((added, removed), (1, 4))
+        self.assertEqual(set(phone.tags.values_list('id', flat=True)), {3})
+        self.assertFalse(water.tags.exists())
+        self.assertEqual(set(computer.tags.values_list('id', flat=True)), {1, 3})
+        self.assertEqual(Product.tags.bulk_remove({computer.id: [1, 2]}), 1)
+        self.assertEqual(set(computer.tags.values_list('id', flat=True)), {3})
+        # 分批处理，已有的关系不会重复插入
+        self.assertEqual(Product.tags.bulk_add({phone.id: [1, 3], computer.id: [1], water.id: [1]}, batch_size=2), 3)
+        # 反向
+        self.assertEqual(Tag.product_set.bulk_remove({1: [phone.id, computer.id, water.id]}), 3)
+        self.assertFalse(Product.tags.through.objects.filter(tag_id=1, product_id=computer.id).exists())
+
+    def test_bulk_m2m_signal(self):
+        """
+        批量修改多对多关系时，与Django的add、remove相同，每个实例发送一次m2m_changed
+        :return:
+        """
+        received = []
+
+        def receiver(sender, action, instance, pk_set, **kwargs):
+            received.append((action, instance, pk_set))
+
+        m2m_changed.connect(receiver, sender=Product.tags.through)
+        try:
+            phone, computer = (Product.objects.get(id=id_) for id_ in (1, 2))
+            Product.tags.bulk_add({phone.id: [1, 2], computer.id: [1, 3]})
+            self.assertEqual(received, [('pre_add', phone, {2}), ('pre_add', computer, {3}),
+                                        ('post_add', phone, {2}), ('post_add', computer, {3})])
+            received.clear()
+            Product.tags.bulk_set({phone.id: [3]})
+            self.assertEqual(received, [('pre_remove', phone, {1, 2}), ('post_remove', phone, {1, 2}),
+                                        ('pre_add', phone, {3}), ('post_add', phone, {3})])
+            # 反向时 instance 为标签
+            received.clear()
+            Tag.product_set.bulk_remove({3: [phone.id, computer.id]})
+            self.assertEqual([(action, instance.pk, pk_set) for action, instance, pk_set in received],
+                             [('pre_remove', 3, {phone.id, computer.id}), ('post_remove', 3, {phone.id, computer.id})])
+        finally:
+            m2m_changed.disconnect(receiver, sender=Product.tags.through)
+
+    def test_fast_delete(self):
+        """
+        批量级联删除，不创建任何实例
+        :return:
+        """
+        # 与 delete() 相同会级联删除订单，但不加载任何订单，返回每张表删除的行数
+        self.assertEqual(Product.objects.get(id=1).sold_count, 10)
+        deleted = Customer.objects.filter(name='李四').fast_delete()
+        self.assertEqual(deleted, {'order': 3, 'customer': 1})
+        self.assertFalse(Order.objects.filter(customer__name='李四').exists())
+        self.assertFalse(Customer._base_manager.filter(name='李四').exists())
+        # 删除订单后刷新冗余计数
+        self.assertEqual(Product.objects.get(id=1).sold_count, 5)
+        # 分批删除，同时删除多对多中间表
+        deleted = Product.objects.filter(id__in=[1, 2]).fast_delete(batch_size=1)
+        self.assertEqual(deleted, {'order': 3, 'product_tags': 2, 'product': 2})
+        # 删除前检查 PROTECT，不会删除任何数据
+        with self.assertRaises(ProtectedError):
+            Supplier.objects.filter(name='桶一食品').fast_delete()
+        self.assertTrue(Supplier.objects.filter(name='桶一食品').exists())
+        # 供应商的商品删除后可以删除
+        Product.objects.filter(supplier__name='桶一食品').fast_delete()
+        self.assertEqual(Supplier.objects.filter(name='桶一食品').fast_delete(), {'supplier': 1})
+
+
+class QueryCacheTestCase(TransactionTestCase):
+    """
+    查询结果缓存，TestCase 的数据在事务中，写入过的表不会缓存，所以使用 TransactionTestCase
+    """
+
+    def setUp(self):
+        cache.reset_query_cache()
+        Customer.objects.bulk_create(Customer(id=id_, name=name, age=20, phone=phone)
+                                     for id_, name, phone in ((1, 'Tom', '13500000001'),
+                                                              (2, 'Jerry', '13500000002')))
+
+    def tearDown(self):
+        cache.reset_query_cache()
+
+    def test_cached(self):
+        """
+        cached() 的查询结果缓存，写入后失效
+        :return:
+        """
+        query_cache = cache.get_query_cache()
+        with self.assertNumQueries(1):
+            Customer.objects.cached().get(id=1)
+        # 第二次从缓存读取，每次得到的是新的实例
+        with self.assertNumQueries(0):
+            tom = Customer.objects.cached().get(id=1)
+            tom.name = 'Tommy'
+            self.assertEqual(Customer.objects.cached().get(id=1).name, 'Tom')
+        self.assertEqual(query_cache.stats()['hits'], 2)
+        # update 后缓存失效
+        Customer.objects.filter(id=1).update(age=21)
+        with self.assertNumQueries(1):
+            self.assertEqual(Customer.objects.cached().get(id=1).age, 21)
+        # in_bulk
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(Customer.objects.cached().in_bulk([1, 2])), [1, 2])
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(Customer.objects.cached().in_bulk([1, 2])), [1, 2])
+        # 软删除、save 同样会让缓存失效
+        Customer.objects.filter(id=2).soft_delete()
+        self.assertEqual(list(Customer.objects.cached().in_bulk([1, 2])), [1])
+        tom = Customer.objects.get(id=1)
+        tom.name = 'Tommy'
+        tom.save()
+        self.assertEqual(Customer.objects.cached().get(id=1).name, 'Tommy')
+        # 事务中写入过的表不读取缓存
+        with transaction.atomic():
+            Customer.objects.filter(id=1).update(age=22)
+            with self.assertNumQueries(2):
+                Customer.objects.cached().get(id=1)
+                Customer.objects.cached().get(id=1)
+        self.assertEqual(Customer.objects.cached().get(id=1).age, 22)
+        stats = query_cache.stats()
+        self.assertGreater(stats['misses'], 0)
+        self.assertGreater(stats['invalidations'], 0)
+
+    def test_eviction(self):
+        """
+        超过 LOCAL_MAXSIZE 时淘汰最久未使用的缓存
+        :return:
+        """
+        with self.settings(QUERYSET_CACHE={'LOCAL_MAXSIZE': 1}):
+            cache.reset_query_cache()
+            Customer.objects.cached().get(id=1)
+            Customer.objects.cached().get(id=2)
+            self.assertEqual(cache.get_query_cache().stats()['evictions'], 1)
+            # 被淘汰的查询重新查询数据库
+            with self.assertNumQueries(1):
+                Customer.objects.cached().get(id=1)
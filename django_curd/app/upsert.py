@@ -0,0 +1,155 @@
+from itertools import islice
+from django.db import models, connections, transaction
+
+"""
+批量的 update_or_create
+update_or_create 每一行都需要一次 SELECT 和一次 UPDATE 或 INSERT
+bulk_upsert 每一批数据使用 INSERT ... ON CONFLICT (SQLite 3.24+ / PostgreSQL 9.5+)
+冲突字段没有唯一约束，或者数据库不支持时，通过临时表 + UPDATE/INSERT 合并
+新增和更新的行数由写入的语句本身得到，不会受到并发写入的影响
+与已被软删除的数据冲突时，会恢复这行数据（is_deleted=False）
+
+MySQL 的 ON DUPLICATE KEY UPDATE 与任意一个唯一索引冲突都会更新，不只是 conflict_fields，
+并且 Django 连接 MySQL 时使用 CLIENT_FOUND_ROWS，无法从影响行数区分新增和值没有变化的更新，所以 MySQL 总是通过临时表合并
+"""
+
+
+def _supports_native_upsert(connection):
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 24, 0)
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    return False
+
+
+def _is_unique(model, fields):
+    """
+    冲突字段必须有唯一约束，才能使用数据库原生的upsert
+    """
+    opts = model._meta
+    if len(fields) == 1 and (fields[0].unique or fields[0].primary_key):
+        return True
+    names = {field.name for field in fields}
+    unique_sets = [set(together) for together in opts.unique_together]
+    unique_sets.extend(set(constraint.fields) for constraint in opts.constraints
+                       if isinstance(constraint, models.UniqueConstraint) and constraint.condition is None)
+    return names in unique_sets
+
+
+def _native_sql(connection, table, columns, conflict_columns, update_columns, rows):
+    """
+    update_columns 为空时生成 ON CONFLICT DO NOTHING
+    """
+    qn = connection.ops.quote_name
+    values = ', '.join(['({})'.format(', '.join(['%s'] * len(columns)))] * rows)
+    sql = 'INSERT INTO {} ({}) VALUES {} ON CONFLICT ({})'.format(
+        qn(table), ', '.join(qn(column) for column in columns), values,
+        ', '.join(qn(column) for column in conflict_columns))
+    if not update_columns:
+        return sql + ' DO NOTHING'
+    return sql + ' DO UPDATE SET {}'.format(
+        ', '.join('{0} = excluded.{0}'.format(qn(column)) for column in update_columns))
+
+
+def _native(cursor, connection, table, columns, conflict_columns, update_columns, params, rows):
+    """
+    :return: (created, updated)
+    """
+    sql = _native_sql(connection, table, columns, conflict_columns, update_columns, rows)
+    if connection.vendor == 'postgresql':
+        # 新插入的行 xmax 为 0
+        cursor.execute(sql + ' RETURNING (xmax = 0)', params)
+        created = sum(1 for inserted, in cursor.fetchall() if inserted)
+    else:
+        # SQLite 无法区分 upsert 插入和更新的行，先插入不存在的数据，影响的行数就是新增的行数，
+        # 这条语句之后当前事务持有写锁，其他连接不能写入，剩下的行都是已存在的
+        cursor.execute(_native_sql(connection, table, columns, conflict_columns, (), rows), params)
+        created = cursor.rowcount
+        cursor.execute(sql, params)
+    return created, rows - created
+
+
+def _merge(cursor, connection, table, columns, conflict_columns, update_columns, params, rows):
+    """
+    通过临时表合并数据，先 UPDATE 已存在的数据，再 INSERT 不存在的数据
+    :return: (created, updated)
+    """
+    qn = connection.ops.quote_name
+    temp = qn('{}_upsert'.format(table))
+    table = qn(table)
+    column_list = ', '.join(qn(column) for column in columns)
+    match = ' AND '.join('{0}.{1} = {2}.{1}'.format(temp, qn(column), table) for column in conflict_columns)
+    cursor.execute('CREATE TEMPORARY TABLE {} AS SELECT {} FROM {} WHERE 1 = 0'.format(temp, column_list, table))
+    try:
+        values = ', '.join(['({})'.format(', '.join(['%s'] * len(columns)))] * rows)
+        cursor.execute('INSERT INTO {} ({}) VALUES {}'.format(temp, column_list, values), params)
+        # MySQL 的一条语句中只能引用临时表一次
+        if connection.vendor == 'mysql':
+            sql = 'UPDATE {table} INNER JOIN {temp} ON {match} SET {assignments}'
+            assignment = '{table}.{column} = {temp}.{column}'
+        elif connection.vendor == 'postgresql' or connection.Database.sqlite_version_info >= (3, 33, 0):
+            sql = 'UPDATE {table} SET {assignments} FROM {temp} WHERE {match}'
+            assignment = '{column} = {temp}.{column}'
+        else:
+            sql = 'UPDATE {table} SET {assignments} WHERE EXISTS (SELECT 1 FROM {temp} WHERE {match})'
+            assignment = '{column} = (SELECT {temp}.{column} FROM {temp} WHERE {match})'
+        cursor.execute(sql.format(table=table, temp=temp, match=match, assignments=', '.join(
+            assignment.format(table=table, temp=temp, column=qn(column), match=match) for column in update_columns)))
+        updated = cursor.rowcount
+        cursor.execute('INSERT INTO {table} ({columns}) SELECT {columns} FROM {temp} '
+                       'WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {match})'.format(
+                           table=table, temp=temp, columns=column_list, match=match))
+        created = cursor.rowcount
+    finally:
+        cursor.execute('DROP TABLE {}'.format(temp))
+    return created, updated
+
+
+def bulk_upsert(queryset, rows, conflict_fields, update_fields, batch_size=None):
+    """
+    批量新增或更新
+    :param queryset: SoftDelQuerySet
+    :param rows: model 实例或 dict
+    :param conflict_fields: 判断数据是否已存在的字段，如 ['phone']
+    :param update_fields: 数据已存在时需要更新的字段
+    :param batch_size: 每批的行数，默认根据数据库参数上限自动计算
+    :return: (created, updated)
+    """
+    model = queryset.model
+    opts = model._meta
+    queryset._for_write = True
+    connection = connections[queryset.db]
+    conflict_fields = [opts.get_field(name) for name in conflict_fields]
+    # 插入时写入除自增主键外的所有字段，更新时除了 update_fields，还需要恢复软删除的数据，并刷新 auto_now 的字段
+    fields = [field for field in opts.local_concrete_fields if not isinstance(field, models.AutoField)]
+    update_names = set(update_fields) | {'is_deleted', 'delete_time'}
+    update_names.update(field.name for field in fields if getattr(field, 'auto_now', False))
+    update_fields = [field for field in fields if field.name in update_names]
+
+    columns = [field.column for field in fields]
+    conflict_columns = [field.column for field in conflict_fields]
+    update_columns = [field.column for field in update_fields]
+    native = _supports_native_upsert(connection) and _is_unique(model, conflict_fields)
+    batch_size = batch_size or queryset.insert_batch_size()
+
+    created = updated = 0
+    iterator = (row if isinstance(row, models.Model) else model(**row) for row in rows)
+    while True:
+        # 同一批中冲突字段相同的数据，只保留最后一条
+        objs = {}
+        for obj in islice(iterator, batch_size):
+            objs[tuple(field.value_from_object(obj) for field in conflict_fields)] = obj
+        if not objs:
+            break
+        params = [field.get_db_prep_save(field.pre_save(obj, True), connection)
+                  for obj in objs.values() for field in fields]
+        with transaction.atomic(using=queryset.db, savepoint=False), connection.cursor() as cursor:
+            batch_created, batch_updated = (_native if native else _merge)(
+                cursor, connection, opts.db_table, columns, conflict_columns, update_columns, params, len(objs))
+            created += batch_created
+            updated += batch_updated
+    return created, updated
+
+
+if __name__ == '__main__':
+    pass
@@ -118,3 +118,19 @@ TIME_ZONE = 'Asia/Shanghai'
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# 软删除超过多少天的数据会被归档到 <table>_archive 表
+SOFT_DELETE_ARCHIVE_DAYS = 30
+
+# MoneyField 保存金额的精度，数据库中保存的是 1/10000 元
+MONEY_SCALE = 4
+
+# 是否维护 Customer、Product 中订单相关的冗余计数
+ORDER_COUNTERS = True
+
+# 查询结果缓存，BACKEND 为共享缓存使用的 CACHES 别名，None 时只使用进程内的 LRU
+QUERYSET_CACHE = {
+    'LOCAL_MAXSIZE': 1024,
+    'BACKEND': None,
+    'TIMEOUT': 300,
+}
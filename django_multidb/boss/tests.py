@@ -1,3 +1,328 @@
-from django.test import TestCase
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+from unittest import mock
+from django.core.management import call_command
+from django.db import connections, router, OperationalError
+from django.contrib.auth.models import User
+from django.test import TestCase, SimpleTestCase, override_settings
+from proj import app_move, database_router, ingest, instrumentation, sharding, sqlite_profile
+from proj.database_router import ReplicaSet
+from proj.pool import ConnectionPool, POOLS, ping
+from proj.pool.sqlite3.base import DatabaseWrapper as PooledDatabaseWrapper
+from .models import Boss
+
 
 # Create your tests here.
+class StubReplicaSet(ReplicaSet):
+    """不执行真正的健康检查，down 中的副本检查失败"""
+
+    down = ()
+
+    def check(self, alias):
+        return alias not in self.down
+
+
+class DefaultRouter:
+
+    def db_for_read(self, model, **hints):
+        return 'driver'
+
+
+class ReplicaSetTestCase(SimpleTestCase):
+
+    def test_weighted(self):
+        replica_set = StubReplicaSet('boss', {'a': 2, 'b': 1})
+        self.assertEqual([replica_set.choose() for _ in range(6)], ['a', 'b', 'a', 'a', 'b', 'a'])
+
+    def test_least_outstanding(self):
+        replica_set = StubReplicaSet('boss', {'a': 1, 'b': 1}, balance='least_outstanding')
+        database_router._outstanding.update(a=3, b=1)
+        try:
+            self.assertEqual(replica_set.choose(), 'b')
+        finally:
+            database_router._outstanding.update(a=0, b=0)
+
+    def test_eject(self):
+        replica_set = StubReplicaSet('boss', {'a': 1, 'b': 1})
+        replica_set.down = ('b',)
+        replica_set.check_all()
+        self.assertEqual({replica_set.choose() for _ in range(4)}, {'a'})
+        # 所有副本都不可用时使用主库
+        replica_set.down = ('a', 'b')
+        replica_set.check_all()
+        self.assertEqual(replica_set.choose(), 'boss')
+        # 检查通过后重新加入
+        replica_set.down = ()
+        self.assertEqual(replica_set.choose(), 'boss')
+        replica_set.check_all()
+        self.assertEqual({replica_set.choose() for _ in range(4)}, {'a', 'b'})
+
+    def test_connection_error(self):
+        """
+        查询本身的错误不剔除副本，无法连接数据库时剔除
+        :return:
+        """
+        connection = connections['boss']
+        for message, expected in (('no such table: boss_boss', False), ('near "SELEC": syntax error', False),
+                                  ('unable to open database file', True)):
+            error = OperationalError(message)
+            error.__cause__ = sqlite3.OperationalError(message)
+            self.assertEqual(database_router.is_connection_error(connection, error), expected)
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def pool(self, **kwargs):
+        pool = ConnectionPool(lambda: sqlite3.connect(self.path, check_same_thread=False),
+                              lambda raw: raw.close(), ping, error_class=OperationalError, name='test', **kwargs)
+        self.addCleanup(pool.close_all)
+        return pool
+
+    def test_reuse(self):
+        pool = self.pool(min_size=2)
+        pool.fill_async().join()
+        self.assertIsNone(pool.fill_async())
+        self.assertEqual(pool.stats()['idle'], 2)
+        raw = pool.checkout()
+        pool.checkin(raw)
+        self.assertIs(pool.checkout(), raw)
+        stats = pool.stats()
+        self.assertEqual((stats['created'], stats['checkouts'], stats['in_use'], stats['idle']), (2, 2, 1, 1))
+
+    def test_health_check(self):
+        pool = self.pool()
+        raw = pool.checkout()
+        pool.checkin(raw)
+        # 连接在空闲期间失效，取出时被丢弃并重新连接
+        raw.close()
+        self.assertIsNot(pool.checkout(), raw)
+        self.assertEqual(pool.stats()['health_check_failures'], 1)
+
+    def test_max_size(self):
+        pool = self.pool(max_size=1, timeout=0.05)
+        raw = pool.checkout()
+        with self.assertRaises(OperationalError):
+            pool.checkout()
+        # 其他线程放回连接后，等待的线程取得连接
+        threading.Timer(0.01, pool.checkin, (raw,)).start()
+        pool.timeout = 1
+        self.assertIs(pool.checkout(), raw)
+        stats = pool.stats()
+        self.assertEqual((stats['timeouts'], stats['waits'], stats['created']), (1, 1, 1))
+
+    def test_reap(self):
+        pool = self.pool(min_size=1, max_idle=0)
+        connections = [pool.checkout() for _ in range(3)]
+        for raw in connections:
+            pool.checkin(raw)
+        self.assertEqual(pool.reap(), 2)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def wrapper(self, **settings_dict):
+        settings_dict = dict({'ENGINE': 'proj.pool.sqlite3', 'NAME': self.path, 'POOL': {'MIN_SIZE': 0},
+                              'OPTIONS': {}, 'TIME_ZONE': None, 'CONN_MAX_AGE': 0, 'AUTOCOMMIT': True,
+                              'ATOMIC_REQUESTS': False, 'USER': '', 'PASSWORD': '', 'HOST': '', 'PORT': ''},
+                             **settings_dict)
+        wrapper = PooledDatabaseWrapper(settings_dict, alias='pool_test')
+        self.addCleanup(lambda: POOLS.pop(('pool_test', self.path)).close_all())
+        return wrapper
+
+    def test_wrapper(self):
+        wrapper = self.wrapper()
+        wrapper.ensure_connection()
+        raw = wrapper.connection
+        wrapper.close()
+        wrapper.ensure_connection()
+        self.assertIs(wrapper.connection, raw)
+        # 在事务中关闭的连接不放回连接池
+        wrapper.set_autocommit(False)
+        wrapper.in_atomic_block = True
+        wrapper.close()
+        wrapper.in_atomic_block = False
+        wrapper.closed_in_transaction = False
+        wrapper.connection = None
+        stats = POOLS[('pool_test', self.path)].stats()
+        self.assertEqual((stats['created'], stats['closed'], stats['idle']), (1, 1, 0))
+        # 出现过错误的连接同样不放回连接池
+        wrapper.ensure_connection()
+        wrapper.errors_occurred = True
+        wrapper.close()
+        stats = POOLS[('pool_test', self.path)].stats()
+        self.assertEqual((stats['created'], stats['closed'], stats['idle']), (2, 2, 0))
+
+    def test_sqlite_profile(self):
+        wrapper = self.wrapper(SQLITE={'JOURNAL_MODE': 'WAL', 'SYNCHRONOUS': 'NORMAL', 'BUSY_TIMEOUT': 1234,
+                                       'CHECKPOINT_INTERVAL': 0, 'ANALYZE_INTERVAL': 0})
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            pragmas = [cursor.execute('PRAGMA {}'.format(pragma)).fetchone()[0]
+                       for pragma in ('journal_mode', 'synchronous', 'busy_timeout')]
+        # synchronous 的 NORMAL 为 1
+        self.assertEqual(pragmas, ['wal', 1, 1234])
+        self.assertNotIn(self.path, sqlite_profile.MAINTENANCE)
+        maintenance = sqlite_profile.Maintenance(self.path, sqlite_profile.get_profile({}))
+        raw = maintenance._connect()
+        maintenance.checkpoint(raw)
+        maintenance.analyze(raw)
+        raw.close()
+        self.assertEqual((maintenance.stats['checkpoints'], maintenance.stats['analyzes']), (1, 1))
+
+
+class RouterTestCase(TestCase):
+
+    databases = '__all__'
+
+    def tearDown(self):
+        database_router.clear_pins()
+
+    def test_read_your_writes(self):
+        self.assertEqual(router.db_for_read(Boss), 'boss_replica')
+        Boss.objects.create(name='jack', age=47)
+        # 写入后读主库
+        self.assertEqual(router.db_for_read(Boss), 'boss')
+        self.assertEqual(Boss.objects.get(name='jack').age, 47)
+        database_router.clear_pins()
+        self.assertEqual(router.db_for_read(Boss), 'boss_replica')
+        self.assertEqual(router.db_for_write(Boss), 'boss')
+        # 副本只迁移所属App的表
+        self.assertFalse(router.allow_migrate('boss_replica', 'client'))
+        self.assertTrue(router.allow_migrate('boss_replica', 'boss'))
+
+    def test_routing_table(self):
+        # 修改配置后重新生成路由表
+        with override_settings(DATABASE_APPS_REPLICAS={}):
+            self.assertEqual(database_router.STATIC_ROUTES[Boss], 'boss')
+            self.assertEqual(router.db_for_read(Boss), 'boss')
+        self.assertNotIn(Boss, database_router.STATIC_ROUTES)
+        self.assertEqual(router.db_for_read(Boss), 'boss_replica')
+        # 不替换 django.db.router 的方法，不在映射中的 model 遍历其他 router
+        self.assertNotIn('db_for_read', router.__dict__)
+        self.assertIsNone(database_router.ROUTES[User])
+        with override_settings(DATABASE_ROUTERS=['proj.database_router.DatabaseAppsRouter',
+                                                 'boss.tests.DefaultRouter']):
+            self.assertEqual(router.db_for_read(User), 'driver')
+            self.assertEqual(router.db_for_write(Boss), 'boss')
+        self.assertEqual(router.db_for_read(User), 'default')
+
+
+class IngestTestCase(TestCase):
+    """测试数据库的副本与主库共享同一个内存数据库，主库的事务没有提交时不能从副本读取，直接读主库"""
+
+    databases = '__all__'
+
+    def tearDown(self):
+        ingest.GATES.clear()
+
+    def test_ndjson(self):
+        body = '\n'.join(['{"name": "jack", "age": 47}', '{"name": "rose", "age": "abc"}', 'not json', '',
+                          '{"name": "tom", "age": 30}', '{"age": 30}'])
+        response = self.client.post('/bulk_add_boss/?batch_size=2', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result['created'], 2)
+        self.assertIsNone(result['next_row'])
+        self.assertEqual([(batch['first_row'], batch['created']) for batch in result['batches']],
+                         [(0, 1), (2, 1), (5, 0)])
+        self.assertEqual([error['row'] for batch in result['batches'] for error in batch['errors']], [1, 2, 5])
+        self.assertEqual(sorted(Boss.objects.using('boss').values_list('name', flat=True)), ['jack', 'tom'])
+
+    def test_csv(self):
+        body = 'name,age\njack,47\nrose,43\n'
+        response = self.client.post('/bulk_add_boss/', body, content_type='text/csv')
+        self.assertEqual(response.json()['created'], 2)
+        self.assertEqual(Boss.objects.using('boss').count(), 2)
+
+    @override_settings(INGEST={'MAX_BATCH_SECONDS': 0})
+    def test_backpressure(self):
+        body = 'name,age\njack,47\nrose,43\ntom,30\n'
+        response = self.client.post('/bulk_add_boss/?batch_size=1', body, content_type='text/csv')
+        # 第一批写入后数据库被认为跟不上，停止读取，返回下一行的行号
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response.json()['next_row'], 1)
+        self.assertEqual(Boss.objects.using('boss').count(), 1)
+
+    def test_batch_size(self):
+        body = 'name,age\njack,47\nrose,43\n'
+        for batch_size in ('0', '-1'):
+            response = self.client.post('/bulk_add_boss/?batch_size=' + batch_size, body, content_type='text/csv')
+            self.assertEqual(response.status_code, 400)
+        # 超过 MAX_BATCH_SIZE 时按 MAX_BATCH_SIZE 分批
+        with override_settings(INGEST={'MAX_BATCH_SIZE': 1}):
+            response = self.client.post('/bulk_add_boss/?batch_size=1000', body, content_type='text/csv')
+        self.assertEqual([batch['rows'] for batch in response.json()['batches']], [1, 1])
+
+    def test_moving(self):
+        """
+        reshard、move_app 切换期间禁止写入时返回 503，客户端从没有写入的这一批重新提交
+        :return:
+        """
+        body = 'name,age\njack,47\nrose,43\n'
+        for error in (sharding.ReshardInProgress('boss'), app_move.AppMoveInProgress('boss')):
+            with mock.patch.object(type(Boss.objects), 'bulk_create', side_effect=error):
+                response = self.client.post('/bulk_add_boss/?batch_size=1', body, content_type='text/csv')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertEqual(response.json(), {'created': 0, 'batches': [], 'next_row': 0})
+        self.assertEqual(Boss.objects.using('boss').count(), 0)
+
+
+class InstrumentationTestCase(TestCase):
+
+    databases = '__all__'
+
+    def setUp(self):
+        instrumentation.STATS.reset()
+
+    def test_stats(self):
+        Boss.objects.using('boss').bulk_create([Boss(name='jack', age=47), Boss(name='rose', age=43)])
+        self.assertEqual(len(Boss.objects.using('boss').all()), 2)
+        entry = next(item for item in instrumentation.STATS.snapshot()['entries']
+                     if (item['alias'], item['model']) == ('boss', 'boss.Boss'))
+        # 写入 2 行，读取 2 行
+        self.assertEqual((entry['count'], entry['rows'], sum(entry['histogram'])), (2, 4, 2))
+
+    def test_reused_cursor(self):
+        """
+        同一个 cursor 多次执行时只替换一次 fetch 方法，行数不重复累加
+        :return:
+        """
+        Boss.objects.using('boss').bulk_create([Boss(name='jack', age=47), Boss(name='rose', age=43)])
+        instrumentation.STATS.reset()
+        with connections['boss'].cursor() as cursor:
+            for _ in range(3):
+                cursor.execute('SELECT name FROM Boss')
+                cursor.fetchall()
+            cursor.execute('UPDATE Boss SET age = age + 1')
+            fetchall = cursor.fetchall
+            cursor.execute('SELECT name FROM Boss')
+            self.assertIs(cursor.fetchall, fetchall)
+            cursor.fetchone()
+        entry = next(item for item in instrumentation.STATS.snapshot()['entries']
+                     if (item['alias'], item['model']) == ('boss', 'boss.Boss'))
+        self.assertEqual((entry['count'], entry['rows']), (5, 9))
+
+    def test_slow_query(self):
+        with override_settings(QUERY_INSTRUMENTATION={'SLOW_QUERY_MS': 0}), \
+                self.assertLogs('django', 'WARNING') as logs:
+            list(Boss.objects.using('boss').filter(age__gt=40))
+        self.assertIn('SCAN', logs.output[0])
+
+    def test_command(self):
+        list(Boss.objects.using('boss').all())
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(QUERY_INSTRUMENTATION={'STATS_DIR': directory}):
+            instrumentation.save()
+            output = os.path.join(directory, 'stats.out')
+            call_command('query_stats', format='json', output=output, alias='boss')
+            with open(output, encoding='utf-8') as f:
+                stats = json.load(f)['stats']
+        self.assertEqual([(row['model'], row['count']) for row in stats], [('boss.Boss', 1)])
@@ -1,8 +1,18 @@
 from .models import Boss
 from django.shortcuts import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from proj import ingest, writebehind
 
 
 # Create your views here.
 def add_boss(request):
-    Boss(name=request.GET['name'], age=request.GET['age']).save()
+    boss = Boss(name=request.GET['name'], age=request.GET['age'])
+    if writebehind.enabled():
+        return writebehind.respond(boss)
+    boss.save()
     return HttpResponse('success')
+
+
+@csrf_exempt
+def bulk_add_boss(request):
+    return ingest.respond(request, Boss)
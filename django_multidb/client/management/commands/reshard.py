@@ -0,0 +1,140 @@
+import time
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from proj import sharding
+
+"""
+在线移动分片
+python manage.py reshard client 512 1024 client_shard1
+将 client 中桶 [512, 1024) 的数据移动到 client_shard1：
+1. 复制：按主键分批扫描源分片，复制桶在范围内的数据，这期间源分片照常读写
+2. 追赶：再扫描一遍，复制新增的数据，更新复制之后被修改的数据，删除复制之后在源分片被删除的数据
+3. 冻结：这段桶禁止写入（写入时抛出 ReshardInProgress），等待其他进程重新加载分片表、完成进行中的写入
+4. 最后追赶：与追赶相同，此时源分片不再变化，复制完成后两边的数据一致
+5. 切换：修改分片表、解除冻结并写入 SHARD_MAP_FILE，等待其他进程重新加载，之后的读写都发往新的分片
+6. 清理：从源分片删除已经移走的数据
+冻结到切换之间这段桶只能读取，通常只有几秒；失败时解除冻结，分片表保持不变
+"""
+
+# 冻结之后，除了等待其他进程重新加载分片表，再等待进行中的写入完成的时间（秒）
+FREEZE_GRACE = 1
+
+
+class Command(BaseCommand):
+    help = '在线移动分片的一段桶到另一个数据库'
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label')
+        parser.add_argument('start', type=int, help='起始的桶（包含）')
+        parser.add_argument('end', type=int, help='结束的桶（不包含）')
+        parser.add_argument('target', help='目标数据库')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, app_label, start, end, target, batch_size, **options):
+        if app_label not in sharding.SHARD_MAP.apps():
+            raise CommandError('{} 没有分片'.format(app_label))
+        if target not in sharding.SHARD_MAP.databases(app_label):
+            raise CommandError('{} 不是 {} 的分片数据库'.format(target, app_label))
+        if not 0 <= start < end <= sharding.SHARD_BUCKETS:
+            raise CommandError('桶的范围应在 [0, {}) 之间'.format(sharding.SHARD_BUCKETS))
+        models = [model for model in apps.get_app_config(app_label).get_models() if sharding.is_sharded(model)]
+        # 需要移动的每一段桶及其所在的源分片，目标数据库已经拥有的桶不需要移动
+        moving = [(max(range_start, start), min(range_end, end), alias)
+                  for range_start, range_end, alias in sharding.SHARD_MAP.ranges(app_label)
+                  if range_start < end and range_end > start and alias != target]
+        for model in models:
+            self.sync(model, moving, target, batch_size, '复制')
+            self.sync(model, moving, target, batch_size, '追赶')
+        sharding.SHARD_MAP.freeze(app_label, start, end)
+        self.stdout.write('桶 [{}, {}) 已冻结'.format(start, end))
+        try:
+            if sharding.SHARD_MAP.path is not None:
+                time.sleep(sharding.RELOAD_INTERVAL + FREEZE_GRACE)
+            for model in models:
+                self.sync(model, moving, target, batch_size, '最后追赶')
+            sharding.SHARD_MAP.move(app_label, start, end, target)
+        except BaseException:
+            sharding.SHARD_MAP.thaw(app_label, start, end)
+            self.stderr.write('移动失败，桶 [{}, {}) 已解除冻结'.format(start, end))
+            raise
+        self.stdout.write('分片表已切换：{}'.format(sharding.SHARD_MAP.ranges(app_label)))
+        if sharding.SHARD_MAP.path is not None:
+            time.sleep(sharding.RELOAD_INTERVAL)
+        for model in models:
+            for range_start, range_end, source in moving:
+                deleted = self.purge(model, source, range_start, range_end, batch_size)
+                self.stdout.write('{} {}: 删除 {} 行'.format(model.__name__, source, deleted))
+
+    def sync(self, model, moving, target, batch_size, step):
+        for range_start, range_end, source in moving:
+            copied = self.copy(model, source, target, range_start, range_end, batch_size)
+            pruned = self.prune(model, source, target, range_start, range_end, batch_size)
+            self.stdout.write('{} {} -> {}: {} {} 行，删除 {} 行'.format(
+                model.__name__, source, target, step, copied, pruned))
+
+    @staticmethod
+    def _scan(model, source, start, end, batch_size):
+        """
+        按主键分批扫描源分片，返回桶在范围内的数据
+        """
+        fields = [field.attname for field in model._meta.concrete_fields]
+        queryset = model._base_manager.using(source).order_by('pk').values(*fields)
+        pk_name = model._meta.pk.attname
+        last = None
+        while True:
+            rows = list((queryset if last is None else queryset.filter(pk__gt=last))[:batch_size])
+            if not rows:
+                return
+            last = rows[-1][pk_name]
+            yield [row for row in rows if start <= sharding.bucket(row[model.shard_key]) < end]
+
+    def copy(self, model, source, target, start, end, batch_size):
+        """
+        将源分片中桶在范围内的数据复制到目标数据库，保留主键，目标数据库中已存在但内容不同的数据以源分片为准
+        :return: 新增和更新的行数
+        """
+        pk_name = model._meta.pk.attname
+        fields = [field.attname for field in model._meta.concrete_fields]
+        manager = model._base_manager.db_manager(target)
+        count = 0
+        for rows in self._scan(model, source, start, end, batch_size):
+            if not rows:
+                continue
+            existing = {row[pk_name]: row for row in manager.filter(
+                pk__in=[row[pk_name] for row in rows]).values(*fields)}
+            created = [model(**row) for row in rows if row[pk_name] not in existing]
+            updated = [model(**row) for row in rows if row[pk_name] in existing and existing[row[pk_name]] != row]
+            with transaction.atomic(using=target):
+                manager.bulk_create(created)
+                if updated:
+                    manager.bulk_update(updated, [name for name in fields if name != pk_name])
+            count += len(created) + len(updated)
+        return count
+
+    def prune(self, model, source, target, start, end, batch_size):
+        """
+        删除目标数据库中桶在范围内、源分片已经不存在的数据，复制之后被删除的行不会在切换后重新出现
+        :return: 删除的行数
+        """
+        pk_name = model._meta.pk.attname
+        manager = model._base_manager.db_manager(target)
+        count = 0
+        for rows in self._scan(model, target, start, end, batch_size):
+            if not rows:
+                continue
+            pks = [row[pk_name] for row in rows]
+            alive = set(model._base_manager.using(source).filter(pk__in=pks).values_list('pk', flat=True))
+            deleted = [pk for pk in pks if pk not in alive]
+            if deleted:
+                count += manager.filter(pk__in=deleted)._raw_delete(target)
+        return count
+
+    def purge(self, model, source, start, end, batch_size):
+        manager = model._base_manager.db_manager(source)
+        pk_name = model._meta.pk.attname
+        count = 0
+        for rows in self._scan(model, source, start, end, batch_size):
+            if rows:
+                count += manager.filter(pk__in=[row[pk_name] for row in rows])._raw_delete(source)
+        return count
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0002_auto_20180516_1505'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='client',
+            name='id',
+            field=models.BigAutoField(primary_key=True, serialize=False),
+        ),
+    ]
@@ -1,11 +1,18 @@
 from django.db import models
+from proj.sharding import ShardedManager, ShardedModelMixin
 
 
 # Create your models here.
-class Client(models.Model):
+class Client(ShardedModelMixin, models.Model):
 
     class Meta:
         db_table = 'Client'
 
+    # 按乘客姓名分片，见 proj.sharding
+    shard_key = 'name'
+    objects = ShardedManager()
+
+    # 分片之间的主键需要全局唯一，由 proj.sharding.next_id 分配
+    id = models.BigAutoField(primary_key=True)
     name = models.CharField('乘客姓名', max_length=12)
     age = models.IntegerField('乘客年龄')
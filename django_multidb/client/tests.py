@@ -1,3 +1,142 @@
-from django.test import TestCase
+import heapq
+import functools
+from io import StringIO
+from django.core.management import call_command
+from django.db.models import Avg, Max, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from proj import sharding
+from proj.models import IdNode
+from .models import Client
+
 
 # Create your tests here.
+class ShardingMixin:
+
+    databases = '__all__'
+
+    def setUp(self):
+        self._ranges, self._path = dict(sharding.SHARD_MAP._ranges), sharding.SHARD_MAP.path
+        sharding.SHARD_MAP.path = None
+        sharding.SHARD_MAP._ranges['client'] = [(0, 512, 'client'), (512, 1024, 'client_shard1')]
+        for name, age in (('Park', 76), ('Ace', 43), ('Jack', 47), ('Rose', 18), ('Tom', 23), ('Lucy', 31)):
+            Client(name=name, age=age).save()
+
+    def tearDown(self):
+        sharding.SHARD_MAP._ranges, sharding.SHARD_MAP.path = self._ranges, self._path
+
+
+class ShardingTestCase(ShardingMixin, TestCase):
+
+    def test_route(self):
+        aliases = set()
+        for client in Client.objects.all_shards():
+            alias = sharding.shard_for(Client, client.name)
+            aliases.add(alias)
+            self.assertEqual(client._state.db, alias)
+            self.assertEqual(Client.objects.shard(client.name).get(name=client.name).age, client.age)
+        self.assertEqual(aliases, {'client', 'client_shard1'})
+
+    def test_all_shards(self):
+        queryset = Client.objects.all_shards()
+        self.assertEqual(queryset.count(), 6)
+        self.assertTrue(queryset.filter(name='Rose').exists())
+        # 有序合并
+        self.assertEqual(list(queryset.order_by('-age').values_list('name', 'age')[:3]),
+                         [('Park', 76), ('Jack', 47), ('Ace', 43)])
+        self.assertEqual([client.age for client in queryset.order_by('age')[1:3]], [23, 31])
+        self.assertEqual(queryset.aggregate(Sum('age'), oldest=Max('age')), {'age__sum': 238, 'oldest': 76})
+        with self.assertRaises(ValueError):
+            queryset.aggregate(Avg('age'))
+        self.assertEqual(queryset.filter(age__lt=30).update(age=30), 2)
+        self.assertEqual(queryset.filter(age=30).count(), 2)
+
+    def test_no_shard_key(self):
+        """
+        没有指定分片键的查询在所有分片上执行，不经过 ShardedQuerySet 时抛出异常
+        :return:
+        """
+        self.assertEqual(Client.objects.filter(age__gt=40).count(), 3)
+        self.assertEqual(Client.objects.get(name='Rose').age, 18)
+        self.assertEqual(Client.objects.filter(name='Tom').update(age=24), 1)
+        self.assertEqual(Client.objects.shard('Tom').get(name='Tom').age, 24)
+        with self.assertRaises(sharding.ShardKeyRequired):
+            Client._base_manager.count()
+
+    def test_iterator(self):
+        """
+        iterator() 和 in_bulk() 同样在所有分片上查询
+        :return:
+        """
+        self.assertEqual([client.age for client in Client.objects.order_by('age').iterator(chunk_size=2)],
+                         [18, 23, 31, 43, 47, 76])
+        self.assertEqual(list(Client.objects.order_by('-age').values_list('name', 'age')[1:3].iterator()),
+                         [('Jack', 47), ('Ace', 43)])
+        pks = {client.name: client.pk for client in Client.objects.all()}
+        found = Client.objects.in_bulk([pks['Rose'], pks['Park']])
+        self.assertEqual({client.name for client in found.values()}, {'Rose', 'Park'})
+        self.assertEqual(set(Client.objects.in_bulk()), set(pks.values()))
+
+    def test_null_ordering(self):
+        """
+        合并时 NULL 的位置与分片的数据库相同
+        :return:
+        """
+        keys = [(lambda value: value, False)]
+        for nulls_largest, expected in ((False, [None, 1, 2, 3]), (True, [1, 2, 3, None])):
+            key = functools.cmp_to_key(functools.partial(sharding._compare, keys, nulls_largest))
+            self.assertEqual(list(heapq.merge([1, 3] if nulls_largest else [None, 1, 3],
+                                              [2, None] if nulls_largest else [2], key=key)), expected)
+
+    def test_next_id(self):
+        """
+        新增时只执行一次 INSERT，主键中的节点号来自配置或 IdNode 表的租约
+        :return:
+        """
+        client = Client(name='Kate', age=20)
+        with self.assertNumQueries(1, using=sharding.shard_for_instance(client)):
+            client.save()
+        node = sharding.node_id()
+        self.assertTrue(IdNode.objects.filter(node=node, expires__gt=timezone.now()).exists())
+        self.assertEqual(client.pk >> 12 & 0x3ff, node)
+        with override_settings(SHARD_NODE_ID=7):
+            self.assertEqual(sharding.next_id() >> 12 & 0x3ff, 7)
+
+    def test_freeze(self):
+        """
+        冻结的桶不能写入
+        :return:
+        """
+        name = next(name for name in ('Park', 'Ace', 'Jack', 'Rose', 'Tom', 'Lucy')
+                    if sharding.bucket(name) >= 512)
+        sharding.SHARD_MAP.freeze('client', 512, 1024)
+        try:
+            with self.assertRaises(sharding.ReshardInProgress):
+                Client(name=name, age=1).save()
+            with self.assertRaises(sharding.ReshardInProgress):
+                Client.objects.shard(name).update(age=1)
+            self.assertEqual(Client.objects.shard(name).filter(name=name).count(), 1)
+        finally:
+            sharding.SHARD_MAP.thaw('client', 512, 1024)
+        self.assertEqual(sharding.SHARD_MAP.frozen('client'), [])
+
+    def test_reshard(self):
+        # 复制之后在源分片被删除的行，不会在切换后重新出现
+        deleted = Client(pk=sharding.next_id(), name=next(
+            name for name in ('a', 'b', 'c', 'd', 'e') if sharding.bucket(name) >= 512), age=1)
+        Client._base_manager.using('client').bulk_create([deleted])
+        call_command('reshard', 'client', '512', '1024', 'client', stdout=StringIO())
+        self.assertEqual(sharding.SHARD_MAP.ranges('client'), [(0, 1024, 'client')])
+        self.assertEqual(sharding.SHARD_MAP.frozen('client'), [])
+        self.assertEqual(Client.objects.using('client').count(), 6)
+        self.assertEqual(Client.objects.using('client_shard1').count(), 0)
+        self.assertEqual(Client.objects.all_shards().aggregate(Sum('age'))['age__sum'], 238)
+
+
+class ParallelShardingTestCase(ShardingMixin, TransactionTestCase):
+
+    def test_parallel(self):
+        # 不在事务中时，通过线程池并行查询所有分片
+        self.assertEqual(Client.objects.all_shards().count(), 6)
+        self.assertEqual(list(Client.objects.all_shards().order_by('name').values_list('name', flat=True)),
+                         ['Ace', 'Jack', 'Lucy', 'Park', 'Rose', 'Tom'])
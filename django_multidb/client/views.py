@@ -1,8 +1,18 @@
 from .models import Client
 from django.shortcuts import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from proj import ingest, writebehind
 
 
 # Create your views here.
 def add_client(request):
-    Client(name=request.GET['name'], age=request.GET['age']).save()
+    client = Client(name=request.GET['name'], age=request.GET['age'])
+    if writebehind.enabled():
+        return writebehind.respond(client)
+    client.save()
     return HttpResponse('success')
+
+
+@csrf_exempt
+def bulk_add_client(request):
+    return ingest.respond(request, Client)
@@ -1,3 +1,323 @@
-from django.test import TestCase
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+from io import StringIO
+from unittest import mock
+from django.core import serializers
+from django.core.management import call_command
+from django.db import connections, router, DatabaseError, IntegrityError
+from django.test import TestCase, TransactionTestCase, override_settings
+from boss.models import Boss
+from proj import app_move, sharding, writebehind
+from proj.management.commands.move_app import Command
+from proj.coordinator import coordinated, recover, _ensure_marker, _mark
+from proj.fanout import fan_out, run, FanOutTimeout
+from proj.models import WriteIntent
+from .models import Driver
+
 
 # Create your tests here.
+def slow_query(alias):
+    # 递归 CTE 计数，用来模拟执行时间很长的查询
+    with connections[alias].cursor() as cursor:
+        cursor.execute('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+                       'SELECT COUNT(*) FROM c')
+        return cursor.fetchone()[0]
+
+
+class FanOutTestCase(TestCase):
+
+    databases = '__all__'
+
+    def setUp(self):
+        Boss.objects.bulk_create([Boss(name='jack', age=47), Boss(name='rose', age=43)])
+        Driver.objects.bulk_create([Driver(name='Ace', age=43)])
+
+    def test_merge(self):
+        result = fan_out({'boss': Boss.objects.using('boss'), 'driver': Driver.objects.using('driver')},
+                         func=lambda queryset: queryset.count())
+        self.assertTrue(result.ok)
+        self.assertEqual(result.results, {'boss': 2, 'driver': 1})
+        self.assertEqual(result.merge(), 3)
+        result = fan_out([Boss.objects.using('boss').order_by('age'), Driver.objects.using('driver')],
+                         func=lambda queryset: list(queryset.values_list('age', flat=True)))
+        self.assertEqual(result.merge(), [43, 47, 43])
+
+    def test_partial_failure(self):
+        def fail():
+            raise ValueError('driver 不可用')
+
+        result = run({'boss': ('boss', lambda: Boss.objects.using('boss').count()), 'driver': ('driver', fail)})
+        self.assertEqual(result.results, {'boss': 2})
+        self.assertIsInstance(result.errors['driver'], ValueError)
+        with self.assertRaises(ValueError):
+            result.raise_for_errors()
+
+
+class ParallelFanOutTestCase(TransactionTestCase):
+
+    databases = '__all__'
+
+    def test_timeout(self):
+        Boss.objects.create(name='jack', age=47)
+        result = run({'boss': ('boss', lambda: Boss.objects.using('boss').count()),
+                      'driver': ('driver', lambda: slow_query('driver'))}, timeout={'driver': 0.2})
+        self.assertEqual(result.results, {'boss': 1})
+        self.assertIsInstance(result.errors['driver'], FanOutTimeout)
+
+    def test_cancel(self):
+        """
+        超时后还在排队的任务被取消，不再执行
+        :return:
+        """
+        release, ran = threading.Event(), []
+        self.addCleanup(release.set)
+        result = run({'first': ('driver', lambda: release.wait(5)), 'second': ('boss', lambda: ran.append(1))},
+                     timeout=0.1, max_workers=1)
+        release.set()
+        self.assertEqual(set(result.errors), {'first', 'second'})
+        self.assertIsInstance(result.errors['second'], FanOutTimeout)
+        time.sleep(0.1)
+        self.assertEqual(ran, [])
+
+
+class CoordinatorTestCase(TestCase):
+
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        # 测试数据库是共享缓存的内存数据库，副本的连接开启事务后无法执行 DDL，预先创建 WriteMarker
+        for alias in ('boss', 'driver'):
+            _ensure_marker(alias)
+        super().setUpClass()
+
+    def test_commit(self):
+        with coordinated() as group:
+            boss = group.save(Boss(name='jack', age=47))
+            group.save(Driver(name='Ace', age=43))
+        self.assertEqual(group.aliases(), ['boss', 'driver'])
+        self.assertIsNotNone(boss.pk)
+        self.assertEqual((Boss.objects.count(), Driver.objects.count()), (1, 1))
+        self.assertFalse(WriteIntent.objects.exists())
+
+    def test_rollback(self):
+        # Driver 写入失败时，Boss 也不会写入
+        with self.assertRaises(IntegrityError):
+            with coordinated() as group:
+                group.save(Boss(name='jack', age=47))
+                group.save(Driver(name='Ace', age=None))
+        self.assertEqual((Boss.objects.count(), Driver.objects.count()), (0, 0))
+        self.assertFalse(WriteIntent.objects.exists())
+
+    def test_log_commit_failed(self):
+        """
+        意图日志提交失败时，其他数据库回滚，连接不会停留在事务中
+        :return:
+        """
+        depth = {alias: len(connections[alias].savepoint_ids) for alias in ('boss', 'driver')}
+        log_db = connections[router.db_for_write(WriteIntent)]
+        with mock.patch.object(log_db, 'savepoint_commit', side_effect=DatabaseError('commit failed')):
+            with self.assertRaises(DatabaseError):
+                with coordinated() as group:
+                    group.save(Boss(name='jack', age=47))
+                    group.save(Driver(name='Ace', age=43))
+        self.assertEqual({alias: len(connections[alias].savepoint_ids) for alias in depth}, depth)
+        self.assertEqual((Boss.objects.count(), Driver.objects.count()), (0, 0))
+
+    def test_recover(self):
+        # 意图日志已提交，boss 已提交，driver 提交前进程退出
+        boss, driver = Boss(pk=100, name='jack', age=47), Driver(pk=200, name='Ace', age=43)
+        operations = [{'alias': 'boss', 'action': 'save', 'object': serializers.serialize('json', [boss])},
+                      {'alias': 'driver', 'action': 'save', 'object': serializers.serialize('json', [driver])}]
+        WriteIntent.objects.create(gid='g1', operations=json.dumps(operations))
+        boss.save()
+        _ensure_marker('boss')
+        _mark('boss', 'g1')
+        Boss.objects.filter(pk=100).update(name='rose')
+        self.assertEqual(recover(older_than=0), 1)
+        # 已提交的数据库不再重复写入
+        self.assertEqual(list(Boss.objects.values_list('name', flat=True)), ['rose'])
+        self.assertEqual(Driver.objects.get().pk, 200)
+        self.assertFalse(WriteIntent.objects.exists())
+        self.assertEqual(recover(older_than=0), 0)
+
+
+class WriteBehindTestCase(TransactionTestCase):
+
+    databases = '__all__'
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spill_dir)
+        override = override_settings(WRITE_BEHIND={'ENABLED': True, 'SPILL_DIR': self.spill_dir, 'BATCH_SIZE': 2})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(writebehind.shutdown)
+
+    def test_write_behind(self):
+        for name in ('Ace', 'Bob', 'Cat'):
+            self.assertEqual(self.client.get('/add_driver/', {'name': name, 'age': 30}).status_code, 202)
+        self.client.get('/add_boss/', {'name': 'jack', 'age': 47})
+        self.assertTrue(writebehind.flush(5))
+        self.assertEqual(Driver.objects.using('driver').count(), 3)
+        self.assertEqual(Boss.objects.using('boss').count(), 1)
+        self.assertEqual(writebehind.stats()['driver']['flushed'], 3)
+        # 全部写入后清空溢出文件，停止时删除
+        spill_path = writebehind.BUFFERS['driver']._spill_path
+        self.assertEqual(os.path.getsize(spill_path), 0)
+        with open(writebehind.BUFFERS['driver']._offset_path) as f:
+            self.assertEqual(f.read(), '0')
+        writebehind.shutdown()
+        self.assertFalse(os.path.exists(spill_path))
+
+    def test_bad_row(self):
+        for age in (30, 'abc', 31):
+            writebehind.save(Driver(name='Ace', age=age))
+        self.assertTrue(writebehind.flush(5))
+        self.assertEqual(Driver.objects.using('driver').count(), 2)
+        self.assertEqual(writebehind.stats()['driver']['errors'], 1)
+
+    def test_queue_full(self):
+        buffer = writebehind.WriteBehindBuffer('driver', dict(writebehind.get_options(), MAX_QUEUE=1),
+                                               autostart=False)
+        writebehind.BUFFERS['driver'] = buffer
+        self.assertEqual(self.client.get('/add_driver/', {'name': 'Ace', 'age': 30}).status_code, 202)
+        self.assertEqual(self.client.get('/add_driver/', {'name': 'Bob', 'age': 30}).status_code, 503)
+
+    def test_moving(self):
+        """
+        reshard、move_app 切换期间禁止写入时返回 503，已经进入队列的实例稍后重试
+        :return:
+        """
+        for error in (sharding.ReshardInProgress('driver'), app_move.AppMoveInProgress('driver')):
+            with mock.patch.object(writebehind.router, 'db_for_write', side_effect=error):
+                response = self.client.get('/add_driver/', {'name': 'Ace', 'age': 30})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+        buffer = writebehind.get_buffer('driver')
+        write, calls = buffer._write, []
+
+        def moving_once(instances):
+            calls.append(len(instances))
+            if len(calls) == 1:
+                raise app_move.AppMoveInProgress('driver')
+            write(instances)
+
+        with mock.patch.object(writebehind, 'RETRY_INTERVAL', 0), mock.patch.object(buffer, '_write', moving_once):
+            writebehind.save(Driver(name='Ace', age=30))
+            self.assertTrue(writebehind.flush(5))
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(Driver.objects.using('driver').count(), 1)
+
+    def test_recover(self):
+        # 进程退出前没有写入数据库的实例，下次启动时重新写入
+        buffer = writebehind.WriteBehindBuffer('driver', writebehind.get_options(), autostart=False)
+        buffer.put(Driver(name='Ace', age=30))
+        buffer.put(Driver(name='Bob', age=31))
+        buffer._spill.close()
+        writebehind.save(Driver(name='Cat', age=32))
+        self.assertTrue(writebehind.flush(5))
+        self.assertEqual(sorted(Driver.objects.using('driver').values_list('name', flat=True)), ['Ace', 'Bob', 'Cat'])
+        self.assertEqual(writebehind.stats()['driver']['recovered'], 2)
+        self.assertEqual(len(writebehind.orphans(self.spill_dir, 'driver')), 1)
+
+    def test_live_spill(self):
+        """
+        其他进程仍在使用的溢出文件不被恢复
+        :return:
+        """
+        other = writebehind.WriteBehindBuffer('driver', writebehind.get_options(), autostart=False)
+        self.addCleanup(other._spill.close)
+        other.put(Driver(name='Ace', age=30))
+        buffer = writebehind.WriteBehindBuffer('driver', writebehind.get_options(), autostart=False)
+        self.addCleanup(buffer._spill.close)
+        self.assertEqual(buffer.stats()['recovered'], 0)
+        self.assertEqual(len(writebehind.orphans(self.spill_dir, 'driver')), 2)
+
+
+class MoveAppTestCase(TransactionTestCase):
+
+    databases = '__all__'
+
+    def setUp(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(path)
+        self.addCleanup(lambda: os.path.exists(path) and os.remove(path))
+        override = override_settings(DATABASE_MAPPING_FILE=path)
+        override.enable()
+        self.addCleanup(override.disable)
+        patcher = mock.patch.object(app_move, 'RELOAD_INTERVAL', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.drop_table)
+        Driver.objects.bulk_create([Driver(name='Ace', age=43), Driver(name='Bob', age=30), Driver(name='Cat', age=25)])
+
+    @staticmethod
+    def drop_table():
+        if 'Driver' in connections['spare'].introspection.table_names():
+            with connections['spare'].schema_editor() as editor:
+                editor.delete_model(Driver)
+
+    def test_dual_writes(self):
+        Command.create_tables([Driver], 'spare')
+        app_move.OVERLAY.start_dual_writes('driver', 'spare')
+        driver = Driver.objects.create(name='Dan', age=50)
+        driver.age = 51
+        driver.save()
+        self.assertEqual(Driver.objects.using('spare').get(pk=driver.pk).age, 51)
+        driver.delete()
+        self.assertFalse(Driver.objects.using('spare').exists())
+        app_move.OVERLAY.stop_dual_writes('driver')
+
+    def test_mirror_queryset_writes(self):
+        """
+        bulk_create、QuerySet.update、_raw_delete 不发送信号，同样重放到目标数据库
+        :return:
+        """
+        Command.create_tables([Driver], 'spare')
+        app_move.OVERLAY.start_dual_writes('driver', 'spare')
+        self.addCleanup(app_move.OVERLAY.stop_dual_writes, 'driver')
+        Driver.objects.bulk_create([Driver(name='Dan', age=50), Driver(name='Eve', age=20)])
+        Driver.objects.filter(name='Dan').update(age=51)
+        Driver.objects.filter(name='Eve')._raw_delete('driver')
+        self.assertEqual(list(Driver.objects.using('spare').values_list('name', 'age')), [('Dan', 51)])
+        self.assertEqual(Driver.objects.using('spare').get().pk, Driver.objects.using('driver').get(name='Dan').pk)
+
+    def test_freeze(self):
+        """
+        冻结期间写入源数据库抛出异常，读取不受影响
+        :return:
+        """
+        Command.create_tables([Driver], 'spare')
+        app_move.OVERLAY.start_dual_writes('driver', 'spare')
+        app_move.OVERLAY.freeze('driver')
+        self.addCleanup(app_move.OVERLAY.stop_dual_writes, 'driver')
+        with self.assertRaises(app_move.AppMoveInProgress):
+            Driver.objects.create(name='Dan', age=50)
+        with self.assertRaises(app_move.AppMoveInProgress):
+            Driver.objects.update(age=1)
+        self.assertEqual(Driver.objects.count(), 3)
+        app_move.OVERLAY.stop_dual_writes('driver')
+        self.assertEqual(app_move.OVERLAY.frozen, set())
+        Driver.objects.create(name='Dan', age=50)
+
+    def test_move(self):
+        # allow_migrate 返回 False 时迁移记录为已执行但没有建表，move_app 补建
+        call_command('migrate', 'driver', database='spare', verbosity=0)
+        self.assertNotIn('Driver', connections['spare'].introspection.table_names())
+        Command.create_tables([Driver], 'spare')
+        # 目标数据库中多余的行在校验后删除，已有的行不被复制覆盖
+        Driver.objects.using('spare').bulk_create([Driver(pk=100, name='Old', age=1)])
+        out = StringIO()
+        call_command('move_app', 'driver', 'spare', batch_size=2, stdout=out)
+        self.assertIn('修复 1 行', out.getvalue())
+        self.assertEqual(router.db_for_write(Driver), 'spare')
+        self.assertEqual(router.db_for_read(Driver), 'spare')
+        self.assertEqual(sorted(Driver.objects.values_list('name', flat=True)), ['Ace', 'Bob', 'Cat'])
+        with open(app_move.OVERLAY.path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), {'mapping': {'driver': 'spare'}, 'dual_writes': {}, 'frozen': []})
@@ -1,8 +1,18 @@
 from .models import Driver
 from django.shortcuts import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from proj import ingest, writebehind
 
 
 # Create your views here.
 def add_driver(request):
-    Driver(name=request.GET['name'], age=request.GET['age']).save()
+    driver = Driver(name=request.GET['name'], age=request.GET['age'])
+    if writebehind.enabled():
+        return writebehind.respond(driver)
+    driver.save()
     return HttpResponse('success')
+
+
+@csrf_exempt
+def bulk_add_driver(request):
+    return ingest.respond(request, Driver)
@@ -0,0 +1,229 @@
+import os
+import re
+import json
+import time
+import logging
+import functools
+import threading
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, transaction
+
+"""
+在线迁移App到另一个数据库
+move_app 命令移动App期间，以及移动之后修改的 DATABASE_APPS_MAPPING 保存在 DATABASE_MAPPING_FILE 中，
+所有进程在 1 秒内重新加载，DatabaseAppsRouter 使用 settings 中的配置与这个文件合并后的结果：
+
+{
+    "mapping": {"boss": "spare"},           # 已经迁移的App
+    "dual_writes": {"driver": "spare"},     # 正在迁移的App，写入主库后同时写入目标数据库
+    "frozen": ["driver"]                    # 最后校验和切换期间禁止写入的App
+}
+
+双写通过 execute_wrapper 完成，save、delete、bulk_create、QuerySet.update、_raw_delete 等所有写入App的表的 SQL，
+在源数据库的事务提交后在目标数据库重放：UPDATE、DELETE 和指定了主键的 INSERT 原样执行，
+由数据库分配主键的 INSERT 按新增的主键从源数据库复制这些行
+重放要求两个数据库的 SQL 方言相同，重放失败只记录日志，move_app 在切换前校验并修复这些差异
+冻结的App写入时抛出 AppMoveInProgress
+"""
+
+logger = logging.getLogger('django')
+
+# 检查 DATABASE_MAPPING_FILE 是否修改的间隔（秒）
+RELOAD_INTERVAL = 1
+
+# 写入语句及其第一个表名
+WRITE = re.compile(r'^\s*(INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+["`]?(\w+)["`]?\s*(?:\(([^)]*)\))?', re.IGNORECASE)
+
+
+class AppMoveInProgress(Exception):
+    """
+    App 正在切换到另一个数据库，稍后重试
+    """
+
+
+class MappingOverlay:
+
+    def __init__(self, path=None):
+        self.path = path
+        self.mapping = {}
+        self.dual_writes = {}
+        self.frozen = set()
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if self.path is None:
+            return False
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        data = {}
+        if mtime is not None:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        with self._lock:
+            self.mapping = data.get('mapping', {})
+            self.dual_writes = data.get('dual_writes', {})
+            self.frozen = set(data.get('frozen', ()))
+            self._mtime = mtime
+        return True
+
+    def changed(self):
+        """
+        每 RELOAD_INTERVAL 秒检查一次文件，文件修改时重新加载并返回 True
+        """
+        if self.path is None or time.monotonic() - self._checked < RELOAD_INTERVAL:
+            return False
+        self._checked = time.monotonic()
+        return self._load()
+
+    def _write(self, mapping, dual_writes, frozen=()):
+        if self.path is None:
+            raise ValueError('没有配置 DATABASE_MAPPING_FILE')
+        with self._lock:
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'mapping': mapping, 'dual_writes': dual_writes, 'frozen': sorted(frozen)}, f, indent=4)
+            # 其他进程只会看到修改前或修改后的文件
+            os.replace(tmp, self.path)
+            self.mapping, self.dual_writes, self.frozen = mapping, dual_writes, set(frozen)
+            self._mtime = os.path.getmtime(self.path)
+
+    def start_dual_writes(self, app_label, target):
+        self._write(dict(self.mapping), dict(self.dual_writes, **{app_label: target}), self.frozen)
+
+    def freeze(self, app_label):
+        """
+        禁止写入App，flip 或 stop_dual_writes 时解除
+        """
+        self._write(dict(self.mapping), dict(self.dual_writes), self.frozen | {app_label})
+
+    def stop_dual_writes(self, app_label):
+        dual_writes = dict(self.dual_writes)
+        dual_writes.pop(app_label, None)
+        self._write(dict(self.mapping), dual_writes, self.frozen - {app_label})
+
+    def flip(self, app_label, target):
+        """
+        把App映射到 target，同时结束双写和冻结
+        """
+        dual_writes = dict(self.dual_writes)
+        dual_writes.pop(app_label, None)
+        self._write(dict(self.mapping, **{app_label: target}), dual_writes, self.frozen - {app_label})
+
+
+OVERLAY = MappingOverlay(getattr(settings, 'DATABASE_MAPPING_FILE', None))
+
+
+def reload():
+    """
+    修改 DATABASE_MAPPING_FILE 后重新创建
+    """
+    global OVERLAY
+    path = getattr(settings, 'DATABASE_MAPPING_FILE', None)
+    if path != OVERLAY.path:
+        OVERLAY = MappingOverlay(path)
+
+
+def effective_mapping():
+    return dict(settings.DATABASE_APPS_MAPPING, **OVERLAY.mapping)
+
+
+def dual_write_target(app_label):
+    return OVERLAY.dual_writes.get(app_label)
+
+
+_tables = {}
+
+
+def model_for_table(table):
+    if not _tables:
+        _tables.update({model._meta.db_table: model for model in apps.get_models(include_auto_created=True)})
+    return _tables.get(table)
+
+
+def _inserted_pks(connection, cursor, count):
+    """
+    由数据库分配主键的 INSERT 新增的主键，无法确定时返回 None
+    """
+    if count <= 0:
+        return []
+    if connection.vendor == 'sqlite' and cursor.lastrowid:
+        # 同一条语句新增的行的 rowid 连续，lastrowid 为最后一行
+        return list(range(cursor.lastrowid - count + 1, cursor.lastrowid + 1))
+    if connection.vendor == 'mysql' and cursor.lastrowid:
+        # lastrowid 为第一行
+        return list(range(cursor.lastrowid, cursor.lastrowid + count))
+    if connection.vendor == 'postgresql' and cursor.description:
+        # RETURNING 的结果由 Django 随后读取，读取后把游标移回开头
+        raw = cursor.cursor
+        rows = raw.fetchall()
+        raw.scroll(0, mode='absolute')
+        return [row[0] for row in rows]
+    return None
+
+
+def _replay(model, target, sql, params, many):
+    with connections[target].cursor() as cursor:
+        if many:
+            cursor.executemany(sql, params)
+        else:
+            cursor.execute(sql, params)
+
+
+def _copy_rows(model, target, source, pks):
+    fields = [field.attname for field in model._meta.concrete_fields]
+    rows = list(model._base_manager.using(source).filter(pk__in=pks).values_list(*fields))
+    manager = model._base_manager.db_manager(target)
+    with transaction.atomic(using=target):
+        manager.filter(pk__in=pks)._raw_delete(target)
+        manager.bulk_create([model(**dict(zip(fields, row))) for row in rows])
+
+
+def _mirror(func, model, target, *args):
+    try:
+        func(model, target, *args)
+    except Exception:
+        logger.exception('双写 %s 到 %s 失败，切换前由校验修复', model.__name__, target)
+
+
+def mirror_writes(execute, sql, params, many, context):
+    """
+    execute_wrapper：冻结的App禁止写入；正在迁移的App在源数据库的写入，在事务提交后在目标数据库重放
+    """
+    overlay = OVERLAY
+    if not overlay.dual_writes and not overlay.frozen:
+        return execute(sql, params, many, context)
+    match = WRITE.match(sql)
+    model = model_for_table(match.group(2)) if match else None
+    if model is None:
+        return execute(sql, params, many, context)
+    app_label, connection = model._meta.app_label, context['connection']
+    target = overlay.dual_writes.get(app_label)
+    if app_label in overlay.frozen and connection.alias != target:
+        raise AppMoveInProgress('{} 正在切换到 {}'.format(app_label, target))
+    if target is None or connection.alias != effective_mapping().get(app_label):
+        return execute(sql, params, many, context)
+    result = execute(sql, params, many, context)
+    columns = [column.strip().strip('"`') for column in (match.group(3) or '').split(',')]
+    if match.group(1).upper().startswith('INSERT') and model._meta.pk.column not in columns:
+        cursor = context['cursor']
+        pks = None if many else _inserted_pks(connection, cursor, cursor.rowcount)
+        if pks is None:
+            logger.warning('无法确定 %s 新增的主键，切换前由校验修复', model.__name__)
+        else:
+            connection.on_commit(functools.partial(_mirror, _copy_rows, model, target, connection.alias, pks))
+    else:
+        connection.on_commit(functools.partial(_mirror, _replay, model, target, sql, params, many))
+    return result
+
+
+def install_wrapper(sender, connection, **kwargs):
+    if mirror_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(mirror_writes)
@@ -0,0 +1,37 @@
+import logging
+from django.apps import AppConfig
+from django.core.signals import request_started
+from django.db import DatabaseError
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger('django')
+
+
+def recover_writes(sender, **kwargs):
+    # 进程启动后只在第一个请求前执行一次
+    request_started.disconnect(dispatch_uid='proj_recover_writes')
+    from proj import coordinator
+    try:
+        coordinator.recover()
+    except DatabaseError:
+        logger.exception('恢复跨数据库写入组失败')
+
+
+class ProjConfig(AppConfig):
+    name = 'proj'
+
+    def ready(self):
+        # 在所有 model 加载完成后生成 DatabaseAppsRouter 的路由表
+        from proj import database_router
+        database_router.build()
+        request_started.connect(database_router.start_health_checks, dispatch_uid='proj_replica_health_checks')
+        request_started.connect(database_router.start_mapping_watcher, dispatch_uid='proj_mapping_watcher')
+        # move_app 迁移App期间的双写和冻结
+        from proj import app_move
+        connection_created.connect(app_move.install_wrapper)
+        # 恢复上次进程退出时没有完成的跨数据库写入组
+        request_started.connect(recover_writes, dispatch_uid='proj_recover_writes')
+        # 统计每个数据库、每个 model 的查询
+        from proj import instrumentation
+        connection_created.connect(instrumentation.install_wrapper)
+        request_started.connect(instrumentation.start_saver, dispatch_uid='proj_query_stats')
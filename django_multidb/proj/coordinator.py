@@ -0,0 +1,256 @@
+import sys
+import json
+import uuid
+import logging
+from datetime import timedelta
+from django.apps import apps
+from django.apps.registry import Apps
+from django.core import serializers
+from django.db import models, connections, router, transaction, DatabaseError
+from django.utils import timezone
+
+"""
+跨数据库写入
+Boss 和 Driver 在不同的数据库中，分别提交时后一个失败会留下写了一半的数据
+
+with coordinated() as group:
+    group.save(Boss(name='jack', age=47))
+    group.save(Driver(name='Ace', age=43))
+
+离开 with 时才真正写入，过程类似两阶段提交：
+1. 准备：在每个数据库上开启事务，执行写入，并在每个数据库的 WriteMarker 表中记录写入组的 gid
+2. 决定：写入全部成功后，把写入组的所有操作（包括自增的主键）保存到意图日志 WriteIntent，提交意图日志所在的数据库
+   意图日志所在的数据库同时也参与写入时，它的写入和意图日志一起提交
+3. 提交：按顺序提交其他数据库，全部提交后删除意图日志
+
+第 1 步失败时所有数据库回滚，第 3 步中途失败（进程退出、数据库不可用）时意图日志仍在，
+recover() 在 WriteMarker 中没有 gid 的数据库上重新执行写入，进程启动后处理第一个请求前会自动执行一次
+"""
+
+logger = logging.getLogger('django')
+
+# 意图日志保存超过多少秒仍未删除时，认为写入组没有完成，recover() 重新执行
+RECOVER_AFTER = 60
+# WriteMarker 保留的天数
+MARKER_DAYS = 7
+
+MARKER_TABLE = 'WriteMarker'
+
+
+class InDoubtError(Exception):
+    """
+    意图日志已提交，但部分数据库提交失败，等待 recover() 重新执行
+    """
+
+    def __init__(self, gid, aliases):
+        super().__init__('写入组 {} 在 {} 上提交失败，等待恢复'.format(gid, ', '.join(aliases)))
+        self.gid = gid
+        self.aliases = aliases
+
+
+class WriteMarker(models.Model):
+    """
+    写入组在每个数据库上的提交记录
+    WriteMarker 不属于任何 App，没有迁移，和 django_migrations 一样在独立的 Apps 中定义，第一次写入时创建
+    """
+
+    class Meta:
+        apps = Apps()
+        app_label = 'proj'
+        db_table = MARKER_TABLE
+
+    gid = models.CharField(max_length=32, primary_key=True)
+    created = models.DateTimeField()
+
+
+# 已经创建了 WriteMarker 的数据库
+_marker_tables = set()
+
+
+def _has_marker(alias):
+    with connections[alias].cursor() as cursor:
+        return MARKER_TABLE in connections[alias].introspection.table_names(cursor)
+
+
+def _ensure_marker(alias):
+    wrapper = connections[alias]
+    key = (alias, wrapper.settings_dict['NAME'])
+    if key in _marker_tables:
+        return
+    if not _has_marker(alias):
+        try:
+            with wrapper.schema_editor() as editor:
+                editor.create_model(WriteMarker)
+        except DatabaseError:
+            # 其他进程同时创建了 WriteMarker
+            if not _has_marker(alias):
+                raise
+    # 在事务中创建的表可能被回滚
+    if not wrapper.in_atomic_block:
+        _marker_tables.add(key)
+
+
+def _mark(alias, gid):
+    WriteMarker.objects.using(alias).create(gid=gid, created=timezone.now())
+
+
+def _marked(alias, gid):
+    return WriteMarker.objects.using(alias).filter(gid=gid).exists()
+
+
+def _apply(alias, operation):
+    if operation['action'] == 'save':
+        for obj in serializers.deserialize('json', operation['object']):
+            obj.save(using=alias)
+    else:
+        apps.get_model(operation['model'])._base_manager.using(alias).filter(pk=operation['pk']).delete()
+
+
+class WriteGroup:
+
+    def __init__(self):
+        self.gid = uuid.uuid4().hex
+        # [(数据库, 'save' 或 'delete', 实例)]
+        self._operations = []
+
+    def aliases(self):
+        """
+        参与写入的数据库，按第一次写入的顺序
+        """
+        return list(dict.fromkeys(alias for alias, _, _ in self._operations))
+
+    def save(self, instance, using=None):
+        self._operations.append((using or router.db_for_write(type(instance), instance=instance), 'save', instance))
+        return instance
+
+    def delete(self, instance, using=None):
+        self._operations.append((using or router.db_for_write(type(instance), instance=instance), 'delete', instance))
+
+    def _execute(self):
+        operations = []
+        for alias, action, instance in self._operations:
+            if action == 'save':
+                instance.save(using=alias)
+                operations.append({'alias': alias, 'action': 'save',
+                                   'object': serializers.serialize('json', [instance])})
+            else:
+                operations.append({'alias': alias, 'action': 'delete', 'model': instance._meta.label,
+                                   'pk': instance.pk})
+                instance.delete(using=alias)
+        return operations
+
+    def commit(self):
+        """
+        :return: 参与写入的数据库
+        """
+        from .models import WriteIntent
+        aliases = self.aliases()
+        if not aliases:
+            return aliases
+        log_alias = router.db_for_write(WriteIntent)
+        # 意图日志所在的数据库最先提交
+        for alias in aliases:
+            _ensure_marker(alias)
+        blocks = {alias: transaction.atomic(using=alias) for alias in [log_alias] + aliases}
+        entered = []
+        try:
+            for alias, block in blocks.items():
+                block.__enter__()
+                entered.append(block)
+            for alias in aliases:
+                _mark(alias, self.gid)
+            operations = self._execute()
+            WriteIntent.objects.using(log_alias).create(gid=self.gid, operations=json.dumps(operations))
+        except BaseException:
+            exc_info = sys.exc_info()
+            for block in reversed(entered):
+                block.__exit__(*exc_info)
+            raise
+        try:
+            blocks.pop(log_alias).__exit__(None, None, None)
+        except BaseException:
+            # 意图日志没有提交，其他数据库全部回滚
+            exc_info = sys.exc_info()
+            for alias, block in blocks.items():
+                try:
+                    block.__exit__(*exc_info)
+                except Exception:
+                    logger.exception('写入组 %s 在 %s 上回滚失败', self.gid, alias)
+            raise
+        # 意图日志提交之后，写入组一定会完成
+        failed = []
+        for alias, block in blocks.items():
+            try:
+                block.__exit__(None, None, None)
+            except Exception:
+                logger.exception('写入组 %s 在 %s 上提交失败', self.gid, alias)
+                failed.append(alias)
+        if failed:
+            try:
+                recover(self.gid)
+            except Exception:
+                raise InDoubtError(self.gid, failed)
+        else:
+            WriteIntent.objects.using(log_alias).filter(gid=self.gid).delete()
+        return aliases
+
+
+class coordinated:
+    """
+    离开 with 时提交写入组，with 中抛出异常时不写入
+    """
+
+    def __enter__(self):
+        self.group = WriteGroup()
+        return self.group
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.group.commit()
+
+
+def recover(gid=None, older_than=RECOVER_AFTER):
+    """
+    重新执行没有完成的写入组
+    :param gid: 只恢复指定的写入组，此时不检查 older_than
+    :param older_than: 只恢复意图日志保存超过多少秒的写入组，避免与正在提交的写入组冲突
+    :return: 恢复的写入组数量
+    """
+    from .models import WriteIntent
+    log_alias = router.db_for_write(WriteIntent)
+    intents = WriteIntent.objects.using(log_alias).order_by('created')
+    if gid is not None:
+        intents = intents.filter(gid=gid)
+    else:
+        intents = intents.filter(created__lte=timezone.now() - timedelta(seconds=older_than))
+    recovered = 0
+    for intent in intents:
+        grouped = {}
+        for operation in json.loads(intent.operations):
+            grouped.setdefault(operation['alias'], []).append(operation)
+        for alias, operations in grouped.items():
+            _ensure_marker(alias)
+            with transaction.atomic(using=alias):
+                if _marked(alias, intent.gid):
+                    continue
+                for operation in operations:
+                    _apply(alias, operation)
+                _mark(alias, intent.gid)
+        intent.delete()
+        logger.warning('写入组 %s 已恢复', intent.gid)
+        recovered += 1
+    if gid is None:
+        purge_markers()
+    return recovered
+
+
+def purge_markers(days=MARKER_DAYS):
+    """
+    删除超过 days 天的 WriteMarker
+    """
+    before = timezone.now() - timedelta(days=days)
+    for alias in connections:
+        if connections[alias].settings_dict.get('TEST', {}).get('MIRROR'):
+            continue
+        if _has_marker(alias):
+            WriteMarker.objects.using(alias).filter(created__lt=before).delete()
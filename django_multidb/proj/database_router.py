@@ -7,9 +7,354 @@
 # @Software: PyCharm
 
 # -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+from collections import namedtuple
+from django.apps import apps
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections, router, InterfaceError, OperationalError
+from django.db.backends.signals import connection_created
+from . import app_move, sharding
 
-DATABASE_MAPPING = settings.DATABASE_APPS_MAPPING
+logger = logging.getLogger('django')
+
+# settings 中的配置与 move_app 修改的配置合并后的结果，见 proj.app_move
+DATABASE_MAPPING = app_move.effective_mapping()
+
+# 每个App的只读副本及权重，如 {'boss': {'boss_replica1': 2, 'boss_replica2': 1}}
+DATABASE_REPLICAS = getattr(settings, 'DATABASE_APPS_REPLICAS', {})
+
+DEFAULT_ROUTER_OPTIONS = {
+    # 读请求的负载均衡方式，weighted：加权轮询，least_outstanding：正在执行的查询最少的副本
+    'BALANCE': 'weighted',
+    # 写入之后多少秒内，同一线程对这个App的读请求仍然发往主库
+    'STICKY_SECONDS': 5,
+    # 后台健康检查的间隔（秒），检查失败的副本在下一次检查通过之前不再接收读请求
+    'HEALTH_CHECK_INTERVAL': 5,
+}
+ROUTER_OPTIONS = dict(DEFAULT_ROUTER_OPTIONS, **getattr(settings, 'DATABASE_ROUTER_OPTIONS', {}))
+
+# 修改这些配置时重新生成路由表
+ROUTING_SETTINGS = {'DATABASE_APPS_MAPPING', 'DATABASE_APPS_REPLICAS', 'DATABASE_APPS_SHARDS',
+                    'DATABASE_ROUTER_OPTIONS', 'DATABASE_ROUTERS', 'DATABASE_MAPPING_FILE'}
+
+_local = threading.local()
+
+# 每个数据库正在执行的查询数，least_outstanding 使用
+_outstanding = {}
+_outstanding_lock = threading.Lock()
+
+# MySQL 客户端连接错误：无法连接、连接断开、服务器已关闭等
+MYSQL_CONNECTION_ERRORS = {1040, 1042, 1043, 1047, 1053, 1077, 1152, 1153, 1158, 1159, 1160, 1161,
+                           2001, 2002, 2003, 2004, 2005, 2006, 2013, 2026, 2055}
+# PostgreSQL 中 08 类（连接异常）以外，表示服务器关闭或正在启动的错误码
+PG_CONNECTION_ERRORS = {'57P01', '57P02', '57P03'}
+# SQLite 没有错误码，以错误信息判断数据库文件不可用
+SQLITE_CONNECTION_ERRORS = ('unable to open database', 'disk i/o error', 'database disk image is malformed',
+                            'file is not a database')
+
+
+def _pins():
+    if not hasattr(_local, 'pins'):
+        _local.pins = {}
+    return _local.pins
+
+
+def pin(app_label):
+    """Send reads of the app to its primary for STICKY_SECONDS (read-your-writes)."""
+    _pins()[app_label] = time.monotonic() + ROUTER_OPTIONS['STICKY_SECONDS']
+
+
+def pinned(app_label):
+    expires = _pins().get(app_label)
+    return expires is not None and expires > time.monotonic()
+
+
+def clear_pins():
+    _pins().clear()
+
+
+def outstanding(alias):
+    return _outstanding.get(alias, 0)
+
+
+class ReplicaSet:
+    """
+    The read replicas of an app, with load balancing and health checks.
+
+    Replicas that fail a health check, or raise a connection error while
+    executing a query, are ejected until a later health check passes.
+    Health checks run in a background thread, see start_health_checks().
+    When no replica is healthy, reads fall back to the primary.
+    """
+
+    def __init__(self, primary, weights, balance='weighted'):
+        self.primary = primary
+        self.weights = dict(weights)
+        self.balance = balance
+        self.ejected = set()
+        self._current = {alias: 0 for alias in self.weights}
+        self._lock = threading.Lock()
+
+    def __contains__(self, alias):
+        return alias in self.weights
+
+    def healthy(self):
+        return [alias for alias in self.weights if alias not in self.ejected]
+
+    def check_all(self):
+        """Health check every replica, called by the health check thread."""
+        for alias in self.weights:
+            if self.check(alias):
+                with self._lock:
+                    self.ejected.discard(alias)
+            else:
+                self.eject(alias)
+
+    @staticmethod
+    def check(alias):
+        """Run a trivial query on the replica, return False if it fails."""
+        connection = connections[alias]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.fetchone()
+            return True
+        except (InterfaceError, OperationalError):
+            connection.close()
+            return False
+
+    def eject(self, alias):
+        with self._lock:
+            self.ejected.add(alias)
+
+    def choose(self):
+        candidates = self.healthy()
+        if not candidates:
+            return self.primary
+        if self.balance == 'least_outstanding':
+            return min(candidates, key=lambda alias: (outstanding(alias), -self.weights[alias]))
+        # smooth weighted round-robin，权重为 2:1 时依次返回 a b a，请求不会连续集中在同一个副本
+        with self._lock:
+            total = 0
+            for alias in candidates:
+                self._current[alias] += self.weights[alias]
+                total += self.weights[alias]
+            chosen = max(candidates, key=lambda alias: self._current[alias])
+            self._current[chosen] -= total
+        return chosen
+
+
+def is_connection_error(connection, error):
+    """
+    Whether the error means the database can not be reached, as opposed to an
+    error in the query itself (missing table, syntax error, lock timeout).
+    """
+    if isinstance(error, InterfaceError):
+        return True
+    if not isinstance(error, OperationalError):
+        return False
+    # Django 把驱动的异常包装为 django.db 的异常，原来的异常在 __cause__
+    cause = error.__cause__ or error
+    if connection.vendor == 'postgresql':
+        pgcode = getattr(cause, 'pgcode', None)
+        return pgcode is None or pgcode.startswith('08') or pgcode in PG_CONNECTION_ERRORS
+    if connection.vendor == 'mysql':
+        return bool(cause.args) and cause.args[0] in MYSQL_CONNECTION_ERRORS
+    if connection.vendor == 'sqlite':
+        message = str(cause).lower()
+        return any(text in message for text in SQLITE_CONNECTION_ERRORS)
+    return True
+
+
+def track_queries(execute, sql, params, many, context):
+    """
+    execute_wrapper: count outstanding queries per alias, and eject a replica
+    as soon as it raises a connection error.
+    """
+    connection = context['connection']
+    alias = connection.alias
+    with _outstanding_lock:
+        _outstanding[alias] = _outstanding.get(alias, 0) + 1
+    try:
+        return execute(sql, params, many, context)
+    except (InterfaceError, OperationalError) as e:
+        if is_connection_error(connection, e):
+            for replica_set in REPLICA_SETS.values():
+                if alias in replica_set:
+                    replica_set.eject(alias)
+        raise
+    finally:
+        with _outstanding_lock:
+            _outstanding[alias] -= 1
+
+
+def install_wrapper(sender, connection, **kwargs):
+    if track_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(track_queries)
+
+
+def _replica_sets():
+    # 没有配置主库的App不使用副本，迁移到其他数据库的App，原来的副本不再可用
+    return {app_label: ReplicaSet(DATABASE_MAPPING[app_label], weights, ROUTER_OPTIONS['BALANCE'])
+            for app_label, weights in DATABASE_REPLICAS.items()
+            if DATABASE_MAPPING.get(app_label) is not None
+            and DATABASE_MAPPING[app_label] == getattr(settings, 'DATABASE_APPS_MAPPING', {}).get(app_label)}
+
+
+REPLICA_SETS = _replica_sets()
+
+_health_checker = None
+_health_checker_lock = threading.Lock()
+
+
+def _check_forever():
+    while True:
+        # reload() 会替换 REPLICA_SETS 和 ROUTER_OPTIONS，每一轮重新读取
+        for replica_set in list(REPLICA_SETS.values()):
+            try:
+                replica_set.check_all()
+            except Exception:
+                logger.exception('副本健康检查失败')
+        time.sleep(ROUTER_OPTIONS['HEALTH_CHECK_INTERVAL'])
+
+
+def start_health_checks(**kwargs):
+    """
+    request_started: health check the replicas in a background thread, so
+    that reads never wait for a check.
+    """
+    global _health_checker
+    with _health_checker_lock:
+        if _health_checker is not None or not REPLICA_SETS:
+            return
+        _health_checker = threading.Thread(target=_check_forever, name='replica-health-check', daemon=True)
+        _health_checker.start()
+
+
+connection_created.connect(install_wrapper)
+
+# 一个 model 的路由：所属App、主库、只读副本（没有时为 None）、是否分片
+Route = namedtuple('Route', 'app_label primary replicas sharded')
+
+# 每个 model 的路由表，{model: Route}，不由 DatabaseAppsRouter 路由的 model 为 None
+ROUTES = {}
+# 没有只读副本、没有分片的 model，读写固定使用同一个数据库，{model: alias}
+STATIC_ROUTES = {}
+
+
+def _route(model):
+    app_label = model._meta.app_label
+    if app_label not in DATABASE_MAPPING:
+        return None
+    return Route(app_label, DATABASE_MAPPING[app_label], REPLICA_SETS.get(app_label), sharding.is_sharded(model))
+
+
+def route(model):
+    """The compiled route of the model, compiled on first use for models created later."""
+    try:
+        return ROUTES[model]
+    except KeyError:
+        ROUTES[model] = result = _route(model)
+        return result
+
+
+def build():
+    """Compile the routing table for every installed model."""
+    ROUTES.clear()
+    STATIC_ROUTES.clear()
+    for model in apps.get_models(include_auto_created=True):
+        ROUTES[model] = model_route = _route(model)
+        if model_route is not None and model_route.replicas is None and not model_route.sharded:
+            STATIC_ROUTES[model] = model_route.primary
+
+
+def reload(**kwargs):
+    """
+    Re-read the routing settings and rebuild the routing table, connected to
+    setting_changed, call it directly after changing settings at runtime.
+    """
+    global DATABASE_MAPPING, DATABASE_REPLICAS, ROUTER_OPTIONS, REPLICA_SETS
+    app_move.reload()
+    DATABASE_MAPPING = app_move.effective_mapping()
+    DATABASE_REPLICAS = getattr(settings, 'DATABASE_APPS_REPLICAS', {})
+    ROUTER_OPTIONS = dict(DEFAULT_ROUTER_OPTIONS, **getattr(settings, 'DATABASE_ROUTER_OPTIONS', {}))
+    REPLICA_SETS = _replica_sets()
+    sharding.reload()
+    if apps.ready:
+        build()
+    else:
+        ROUTES.clear()
+
+
+def check_mapping():
+    """Rebuild the routing table when move_app changed DATABASE_MAPPING_FILE."""
+    if app_move.OVERLAY.changed():
+        reload()
+
+
+_mapping_watcher = None
+_mapping_watcher_lock = threading.Lock()
+
+
+def _watch_mapping():
+    while True:
+        time.sleep(app_move.RELOAD_INTERVAL)
+        try:
+            check_mapping()
+        except Exception:
+            logger.exception('重新加载 DATABASE_MAPPING_FILE 失败')
+
+
+def start_mapping_watcher(**kwargs):
+    """
+    request_started: check DATABASE_MAPPING_FILE in a background thread,
+    routing itself never touches the file.
+    """
+    global _mapping_watcher
+    with _mapping_watcher_lock:
+        if _mapping_watcher is not None or app_move.OVERLAY.path is None:
+            return
+        _mapping_watcher = threading.Thread(target=_watch_mapping, name='database-mapping-watcher', daemon=True)
+        _mapping_watcher.start()
+
+
+def _setting_changed(setting, **kwargs):
+    if setting in ROUTING_SETTINGS:
+        if setting == 'DATABASE_ROUTERS':
+            # 与 Django 自身的 setting_changed 处理相同，重新读取 DATABASE_ROUTERS
+            router.__dict__.pop('routers', None)
+        reload()
+
+
+setting_changed.connect(_setting_changed)
+
+
+def sharded_instance(model, hints):
+    """
+    The instance hint of a sharded model; without it the shard is unknown,
+    and falling back to one database would miss the rows on other shards.
+    """
+    if 'instance' not in hints:
+        raise sharding.ShardKeyRequired('{} is sharded, query it through shard(value) or all_shards()'
+                                        .format(model._meta.label))
+    return hints['instance']
+
+
+class RouterMiddleware:
+    """Read-your-writes stickiness is scoped to a request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        clear_pins()
+        try:
+            return self.get_response(request)
+        finally:
+            clear_pins()
 
 
 class DatabaseAppsRouter:
@@ -20,24 +365,63 @@ class DatabaseAppsRouter:
     In case an app is not set in settings.DATABASE_APPS_MAPPING, the router
     will fallback to the `default` database.
 
+    Reads of an app listed in settings.DATABASE_APPS_REPLICAS are balanced
+    across its replicas, except right after a write to the app in the same
+    thread, when they go to the primary.
+
+    Models with a `shard_key` in an app listed in settings.DATABASE_APPS_SHARDS
+    are routed to the shard that owns the key, see proj.sharding.
+
+    Routes are compiled per model when the app registry is ready, see
+    proj.apps, and rebuilt by reload() when the routing settings change.
+    Each call is a lookup in the compiled table; place the router first in
+    DATABASE_ROUTERS so that Django stops at it for the models it routes.
+
+    While move_app copies an app to another database, writes are mirrored
+    to the target, and the mapping is flipped through
+    settings.DATABASE_MAPPING_FILE, which a background thread polls, see
+    proj.app_move and start_mapping_watcher().
+
     Settings example:
 
     DATABASE_APPS_MAPPING = {'app1': 'db1', 'app2': 'db2'}
+    DATABASE_APPS_REPLICAS = {'app1': {'db1_replica1': 2, 'db1_replica2': 1}}
+    DATABASE_APPS_SHARDS = {'app2': {'databases': ['db2', 'db2_shard1'],
+                                     'ranges': [(0, 512, 'db2'), (512, 1024, 'db2_shard1')]}}
     """
 
     @staticmethod
     def db_for_read(model, **hints):
         """"Point all read operations to the specific database."""
-        if model._meta.app_label in DATABASE_MAPPING:
-            return DATABASE_MAPPING[model._meta.app_label]
-        return None
+        # 没有副本、没有分片的 model 直接查表
+        static = STATIC_ROUTES.get(model)
+        if static is not None:
+            return static
+        model_route = route(model)
+        if model_route is None:
+            return None
+        if model_route.sharded:
+            # 访问关联对象时，使用实例所在的分片
+            instance = sharded_instance(model, hints)
+            return instance._state.db or sharding.shard_for_instance(instance)
+        if model_route.replicas is not None and not pinned(model_route.app_label):
+            return model_route.replicas.choose()
+        return model_route.primary
 
     @staticmethod
     def db_for_write(model, **hints):
         """Point all write operations to the specific database."""
-        if model._meta.app_label in DATABASE_MAPPING:
-            return DATABASE_MAPPING[model._meta.app_label]
-        return None
+        static = STATIC_ROUTES.get(model)
+        if static is not None:
+            return static
+        model_route = route(model)
+        if model_route is None:
+            return None
+        if model_route.sharded:
+            return sharding.shard_for_instance(sharded_instance(model, hints), write=True)
+        if model_route.replicas is not None:
+            pin(model_route.app_label)
+        return model_route.primary
 
     @staticmethod
     def allow_relation(obj1, obj2, **hints):
@@ -65,6 +449,16 @@ class DatabaseAppsRouter:
     # Django 1.7 - Django 1.11
     @staticmethod
     def allow_migrate(db, app_label, model_name=None, **hints):
+        # move_app 迁移App前在目标数据库上创建表
+        if db == app_move.dual_write_target(app_label):
+            return True
+        # 副本、分片与主库的表结构相同
+        for shard_app_label in sharding.SHARD_MAP.apps():
+            if db in sharding.SHARD_MAP.databases(shard_app_label):
+                return app_label == shard_app_label
+        for replica_app_label, replica_set in REPLICA_SETS.items():
+            if db in replica_set:
+                return app_label == replica_app_label
         if db in DATABASE_MAPPING.values():
             return DATABASE_MAPPING.get(app_label) == db
         elif app_label in DATABASE_MAPPING:
@@ -0,0 +1,155 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from itertools import chain
+from django.db import connections
+
+"""
+跨数据库并行查询
+boss、client、driver 各自在独立的数据库中，统计报表需要依次查询每个数据库
+fan_out 通过线程池在多个数据库上同时执行查询，每个线程使用自己的数据库连接，执行完毕后关闭
+
+result = fan_out([Boss.objects.all(), Client.objects.using('client'), Driver.objects.all()],
+                 func=lambda queryset: queryset.count(), timeout=2)
+result.results  # {'boss': 10, 'client': 20}
+result.errors   # {'driver': FanOutTimeout(...)}
+result.merge()  # 30
+
+timeout 可以是秒数，也可以是 {alias: 秒数}，超时的查询会被中断（SQLite 的 interrupt，PostgreSQL 的 cancel）
+某个数据库失败或超时不会抛出异常，而是记录在 errors 中，其他数据库的结果照常返回
+当前线程在某个数据库的事务中时，其他线程看不到未提交的数据，这个数据库的查询改为在当前线程执行，不受 timeout 限制
+"""
+
+
+class FanOutTimeout(Exception):
+    pass
+
+
+class FanOutResult:
+
+    def __init__(self):
+        # 成功的结果 {key: 结果}
+        self.results = {}
+        # 失败的查询 {key: 异常}
+        self.errors = {}
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def raise_for_errors(self):
+        for error in self.errors.values():
+            raise error
+
+    def merge(self):
+        """
+        合并所有成功的结果：数字相加，列表依次拼接，dict 按 key 相加
+        """
+        values = list(self.results.values())
+        if not values:
+            return None
+        if all(isinstance(value, dict) for value in values):
+            merged = Counter()
+            for value in values:
+                merged.update(value)
+            return dict(merged)
+        if all(isinstance(value, (int, float)) for value in values):
+            return sum(values)
+        return list(chain.from_iterable(values))
+
+
+def _interrupt(wrapper):
+    """
+    中断其他线程中正在执行的查询
+    """
+    raw = getattr(wrapper, 'connection', None)
+    for name in ('interrupt', 'cancel'):
+        if hasattr(raw, name):
+            try:
+                getattr(raw, name)()
+            except Exception:
+                pass
+            return
+
+
+def _limit(timeout, alias):
+    if isinstance(timeout, dict):
+        return timeout.get(alias)
+    return timeout
+
+
+def run(tasks, timeout=None, max_workers=None):
+    """
+    在线程池中执行 tasks
+    :param tasks: {key: (alias, 不接收参数的函数)}
+    :param timeout: 秒数或 {alias: 秒数}，None 为不限制
+    :param max_workers: 最大线程数，默认每个任务一个线程
+    :return: FanOutResult
+    """
+    result = FanOutResult()
+    outcome = {}
+    parallel = {}
+    for key, (alias, func) in tasks.items():
+        if connections[alias].in_atomic_block:
+            try:
+                outcome[key] = (True, func())
+            except Exception as e:
+                outcome[key] = (False, e)
+        else:
+            parallel[key] = (alias, func)
+
+    if parallel:
+        running = {}
+
+        def task(key, alias, func):
+            wrapper = connections[alias]
+            running[key] = wrapper
+            try:
+                return func()
+            finally:
+                running.pop(key, None)
+                wrapper.close()
+
+        executor = ThreadPoolExecutor(max_workers=max_workers or len(parallel))
+        start = time.monotonic()
+        futures = {key: executor.submit(task, key, alias, func) for key, (alias, func) in parallel.items()}
+        for key, future in futures.items():
+            alias = parallel[key][0]
+            limit = _limit(timeout, alias)
+            try:
+                remaining = None if limit is None else max(0, start + limit - time.monotonic())
+                outcome[key] = (True, future.result(remaining))
+            except FutureTimeoutError:
+                # 还在排队的任务直接取消，已经开始的中断查询
+                if not future.cancel():
+                    _interrupt(running.get(key))
+                outcome[key] = (False, FanOutTimeout('{} 的查询超过 {} 秒'.format(alias, limit)))
+            except Exception as e:
+                outcome[key] = (False, e)
+        # 与 shutdown(cancel_futures=True) 相同，取消所有没有开始的任务，超时的线程在查询被中断后自行结束，不在这里等待
+        for future in futures.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    for key in tasks:
+        succeeded, value = outcome[key]
+        if succeeded:
+            result.results[key] = value
+        else:
+            result.errors[key] = value
+    return result
+
+
+def fan_out(querysets, func=list, timeout=None, max_workers=None):
+    """
+    在多个数据库上并行执行查询
+    :param querysets: queryset 的列表，以 queryset.db 作为 key，或者 {key: queryset}
+    :param func: 在工作线程中对每个 queryset 执行的函数，默认为 list
+    :param timeout: 秒数或 {alias: 秒数}
+    :param max_workers: 最大线程数
+    :return: FanOutResult
+    """
+    if not isinstance(querysets, dict):
+        querysets = {queryset.db: queryset for queryset in querysets}
+    return run({key: (queryset.db, lambda queryset=queryset: func(queryset)) for key, queryset in querysets.items()},
+               timeout, max_workers)
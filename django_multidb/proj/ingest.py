@@ -0,0 +1,249 @@
+import csv
+import json
+import math
+import time
+import threading
+from itertools import islice
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import router, DatabaseError
+from django.http import JsonResponse
+from . import app_move, sharding
+
+"""
+批量写入
+add_boss 等接口每个请求写入一行，批量导入时每一行都要付出一次请求、一次连接和一次事务的代价
+bulk_add_boss 等接口接收 NDJSON（每行一个 JSON 对象）或 CSV（第一行为字段名）的请求体，
+边读取边解析，每 BATCH_SIZE 行通过 bulk_create 写入 DatabaseAppsRouter 路由的数据库
+
+curl -X POST -H 'Content-Type: application/x-ndjson' --data-binary @boss.ndjson http://127.0.0.1:8000/bulk_add_boss/
+curl -X POST -H 'Content-Type: text/csv' --data-binary @boss.csv http://127.0.0.1:8000/bulk_add_boss/?batch_size=1000
+
+返回每一批的结果：
+{
+    "created": 998,
+    "batches": [{"batch": 0, "first_row": 0, "rows": 500, "created": 499, "seconds": 0.012,
+                 "errors": [{"row": 17, "error": {"age": ["“abc” value must be an integer."]}}]}, ...],
+    "next_row": null
+}
+
+背压：每个数据库同时写入的批次不超过 MAX_INFLIGHT，等待超过 ACQUIRE_TIMEOUT 秒，
+或者最近几批写入的平均耗时超过 MAX_BATCH_SECONDS 秒时，停止读取请求体，返回 503 和 Retry-After，
+next_row 为第一个没有处理的行号，客户端稍后从这一行开始重新提交
+reshard、move_app 切换期间禁止写入时同样返回 503，next_row 为没有写入的这一批的第一行
+
+?batch_size= 需要大于 0，超过 MAX_BATCH_SIZE 时按 MAX_BATCH_SIZE 分批
+"""
+
+DEFAULT_OPTIONS = {
+    'BATCH_SIZE': 500,
+    'MAX_BATCH_SIZE': 5000,
+    'MAX_INFLIGHT': 2,
+    'ACQUIRE_TIMEOUT': 5,
+    'MAX_BATCH_SECONDS': 1.0,
+}
+
+# 批次耗时的指数移动平均的权重
+EWMA_WEIGHT = 0.3
+
+# reshard、move_app 切换期间禁止写入，客户端稍后重新提交
+MOVING = (sharding.ReshardInProgress, app_move.AppMoveInProgress)
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+
+
+def get_options():
+    return dict(DEFAULT_OPTIONS, **getattr(settings, 'INGEST', {}))
+
+
+class Gate:
+    """
+    限制每个数据库同时写入的批次，并记录批次耗时
+    """
+
+    def __init__(self, max_inflight):
+        self.semaphore = threading.BoundedSemaphore(max_inflight)
+        self.max_inflight = max_inflight
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        return self.semaphore.acquire(timeout=timeout)
+
+    def release(self, seconds):
+        with self._lock:
+            self.latency += (seconds - self.latency) * EWMA_WEIGHT
+        self.semaphore.release()
+
+
+# {数据库: Gate}
+GATES = {}
+_gates_lock = threading.Lock()
+
+
+def gate_key(model):
+    """
+    背压按数据库计算，分片的 model 一批数据会写入多个分片，所有分片共用一个以App命名的闸门
+    """
+    if sharding.is_sharded(model):
+        return model._meta.app_label
+    return router.db_for_write(model)
+
+
+def get_gate(alias, max_inflight):
+    with _gates_lock:
+        gate = GATES.get(alias)
+        if gate is None or gate.max_inflight != max_inflight:
+            gate = GATES[alias] = Gate(max_inflight)
+        return gate
+
+
+def _lines(stream):
+    for line in stream:
+        yield line.decode('utf-8') if isinstance(line, bytes) else line
+
+
+def parse_ndjson(stream):
+    """
+    逐行解析 NDJSON，跳过空行
+    :return: 生成 (行号, dict 或 异常)
+    """
+    for number, line in enumerate(_lines(stream)):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError('每一行需要是 JSON 对象')
+        except ValueError as e:
+            yield number, e
+        else:
+            yield number, row
+
+
+def parse_csv(stream):
+    """
+    逐行解析 CSV，第一行为字段名，行号从第一行数据开始
+    """
+    for number, row in enumerate(csv.DictReader(_lines(stream))):
+        yield number, row
+
+
+def get_format(request):
+    fmt = request.GET.get('format')
+    if fmt:
+        return fmt
+    return CSV if request.content_type in ('text/csv', 'application/csv') else NDJSON
+
+
+class RowConverter:
+    """
+    把解析后的一行转换为 model 实例，字段值经过 field.clean 校验
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = {field.name: field for field in model._meta.concrete_fields if not field.auto_created}
+        self.required = [name for name, field in self.fields.items()
+                         if not field.blank and not field.has_default() and not field.null]
+
+    def __call__(self, row):
+        errors = {}
+        values = {}
+        for name, value in row.items():
+            field = self.fields.get(name)
+            if field is None:
+                errors[name] = ['未知的字段']
+                continue
+            try:
+                values[field.attname] = field.clean(value, None)
+            except ValidationError as e:
+                errors[name] = e.messages
+        for name in self.required:
+            if name not in row:
+                errors[name] = ['缺少字段']
+        if errors:
+            raise ValidationError(errors)
+        return self.model(**values)
+
+
+def ingest(model, rows, batch_size=None, options=None):
+    """
+    分批写入 rows
+    :param rows: 生成 (行号, dict 或 异常) 的迭代器，见 parse_ndjson、parse_csv
+    :return: (每一批的结果, 第一个没有处理的行号)，没有因为背压停止时行号为 None
+    """
+    options = options or get_options()
+    batch_size = min(batch_size or options['BATCH_SIZE'], options['MAX_BATCH_SIZE'])
+    gate = get_gate(gate_key(model), options['MAX_INFLIGHT'])
+    convert = RowConverter(model)
+    rows = iter(rows)
+    results = []
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            return results, None
+        first_row = chunk[0][0]
+        if not gate.acquire(options['ACQUIRE_TIMEOUT']):
+            return results, first_row
+        start = time.monotonic()
+        objs, errors = [], []
+        moving = False
+        try:
+            for number, row in chunk:
+                try:
+                    if isinstance(row, Exception):
+                        raise row
+                    objs.append(convert(row))
+                except (ValidationError, ValueError) as e:
+                    errors.append({'row': number, 'error': getattr(e, 'message_dict', None) or str(e)})
+            created = 0
+            if objs:
+                try:
+                    model._default_manager.bulk_create(objs)
+                    created = len(objs)
+                except MOVING:
+                    moving = True
+                except DatabaseError as e:
+                    errors.append({'row': first_row, 'error': str(e)})
+        finally:
+            seconds = time.monotonic() - start
+            gate.release(seconds)
+        if moving:
+            return results, first_row
+        results.append({'batch': len(results), 'first_row': first_row, 'rows': len(chunk), 'created': created,
+                        'seconds': round(seconds, 3), 'errors': errors})
+        if gate.latency > options['MAX_BATCH_SECONDS']:
+            # 数据库跟不上，剩下的行由客户端稍后重新提交
+            following = next(rows, None)
+            return results, None if following is None else following[0]
+
+
+def respond(request, model):
+    """
+    批量写入接口，POST 请求体为 NDJSON 或 CSV，?format= 可以覆盖 Content-Type
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': '只接受 POST 请求'}, status=405)
+    fmt = get_format(request)
+    if fmt not in (NDJSON, CSV):
+        return JsonResponse({'error': '不支持的格式：{}'.format(fmt)}, status=400)
+    try:
+        batch_size = int(request.GET['batch_size']) if 'batch_size' in request.GET else None
+    except ValueError:
+        return JsonResponse({'error': 'batch_size 需要是整数'}, status=400)
+    if batch_size is not None and batch_size < 1:
+        return JsonResponse({'error': 'batch_size 需要大于 0'}, status=400)
+    options = get_options()
+    rows = parse_csv(request) if fmt == CSV else parse_ndjson(request)
+    try:
+        results, next_row = ingest(model, rows, batch_size, options)
+    except UnicodeDecodeError:
+        return JsonResponse({'error': '请求体需要是 UTF-8 编码'}, status=400)
+    response = JsonResponse({'created': sum(result['created'] for result in results), 'batches': results,
+                             'next_row': next_row}, status=200 if next_row is None else 503)
+    if next_row is not None:
+        gate = GATES[gate_key(model)]
+        response['Retry-After'] = max(1, math.ceil(gate.latency))
+    return response
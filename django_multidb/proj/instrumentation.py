@@ -0,0 +1,282 @@
+import os
+import re
+import json
+import time
+import bisect
+import atexit
+import logging
+import threading
+from django.apps import apps
+from django.conf import settings
+from django.core.signals import setting_changed
+
+"""
+查询统计
+通过 execute_wrapper 记录每个数据库、每个 model 的查询次数、耗时分布和行数
+SELECT 的行数在取出结果时累加，INSERT、UPDATE、DELETE 为影响的行数
+耗时超过 SLOW_QUERY_MS 的查询连同执行计划写入 django logger
+
+QUERY_INSTRUMENTATION = {
+    'ENABLED': True,
+    'SLOW_QUERY_MS': 100,
+    'EXPLAIN': True,                                # 慢查询是否执行 EXPLAIN
+    'BUCKETS': (1, 5, 10, 50, 100, 500, 1000),      # 耗时分布的上限（毫秒），超过最后一个的计入 inf
+    'STATS_DIR': os.path.join(BASE_DIR, 'query_stats'),
+    'SAVE_INTERVAL': 10,                            # 每个进程保存统计结果的间隔（秒）
+}
+
+每个进程把统计结果保存到 STATS_DIR/<pid>.json，python manage.py query_stats 汇总所有进程的结果
+"""
+
+logger = logging.getLogger('django')
+
+DEFAULT_OPTIONS = {
+    'ENABLED': True,
+    'SLOW_QUERY_MS': 100,
+    'EXPLAIN': True,
+    'BUCKETS': (1, 5, 10, 50, 100, 500, 1000),
+    'STATS_DIR': None,
+    'SAVE_INTERVAL': 10,
+}
+
+# SQL 中第一个表名
+TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+["`]?(\w+)["`]?', re.IGNORECASE)
+# context['cursor'] 为 Django 的 CursorWrapper，在实例上替换这些方法
+FETCH_METHODS = ('fetchone', 'fetchmany', 'fetchall')
+
+
+_options = None
+
+
+def get_options():
+    """
+    每个查询都会读取配置，合并后的结果缓存到 QUERY_INSTRUMENTATION 修改时
+    """
+    global _options
+    if _options is None:
+        _options = dict(DEFAULT_OPTIONS, **getattr(settings, 'QUERY_INSTRUMENTATION', {}))
+    return _options
+
+
+def _setting_changed(setting, **kwargs):
+    global _options
+    if setting == 'QUERY_INSTRUMENTATION':
+        _options = None
+
+
+setting_changed.connect(_setting_changed)
+
+
+def empty_entry(buckets):
+    return {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0, 'slow': 0, 'histogram': [0] * (len(buckets) + 1)}
+
+
+def merge_entry(entry, other):
+    entry['count'] += other['count']
+    entry['total_ms'] += other['total_ms']
+    entry['max_ms'] = max(entry['max_ms'], other['max_ms'])
+    entry['rows'] += other['rows']
+    entry['slow'] += other['slow']
+    entry['histogram'] = [a + b for a, b in zip(entry['histogram'], other['histogram'])]
+
+
+class QueryStats:
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # {(数据库, model): 统计}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = empty_entry(self.buckets)
+        return entry
+
+    def record(self, alias, model, ms, rows=0, slow=False):
+        with self._lock:
+            entry = self._entry((alias, model))
+            entry['count'] += 1
+            entry['total_ms'] += ms
+            entry['max_ms'] = max(entry['max_ms'], ms)
+            entry['rows'] += rows
+            entry['slow'] += slow
+            entry['histogram'][bisect.bisect_left(self.buckets, ms)] += 1
+
+    def add_rows(self, alias, model, rows):
+        with self._lock:
+            self._entry((alias, model))['rows'] += rows
+
+    def snapshot(self):
+        """
+        :return: 可以序列化为 JSON 的统计结果
+        """
+        with self._lock:
+            return {'buckets': list(self.buckets),
+                    'entries': [dict(entry, alias=alias, model=model, histogram=list(entry['histogram']))
+                                for (alias, model), entry in self._entries.items()]}
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+
+
+STATS = QueryStats(get_options()['BUCKETS'])
+
+_local = threading.local()
+_tables = {}
+
+
+def model_for(sql):
+    """
+    SQL 中第一个表对应的 model，不是 model 的表返回表名，没有表时返回 '-'
+    """
+    match = TABLE.search(sql)
+    if match is None:
+        return '-'
+    table = match.group(1)
+    if not _tables:
+        _tables.update({model._meta.db_table: model._meta.label
+                        for model in apps.get_models(include_auto_created=True)})
+    return _tables.get(table, table)
+
+
+def _count_rows(cursor, alias, model):
+    """
+    取出结果时累加行数，cursor 的 fetch 方法只替换一次，
+    每次执行时更新累加到的数据库和 model，不是 SELECT 时为 None
+    """
+    cursor._count_rows_to = (alias, model) if model is not None else None
+    if getattr(cursor, '_counting_rows', False):
+        return
+    cursor._counting_rows = True
+    for name in FETCH_METHODS:
+
+        def fetch(*args, _method=getattr(cursor, name), _name=name):
+            result = _method(*args)
+            target = cursor._count_rows_to
+            if target is not None:
+                rows = (result is not None) if _name == 'fetchone' else len(result)
+                if rows:
+                    STATS.add_rows(target[0], target[1], rows)
+            return result
+
+        setattr(cursor, name, fetch)
+
+
+def explain(connection, sql, params):
+    _local.explaining = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('{} {}'.format(connection.ops.explain_query_prefix(), sql), params)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+    except Exception as e:
+        return '无法获取执行计划：{}'.format(e)
+    finally:
+        _local.explaining = False
+
+
+def instrument(execute, sql, params, many, context):
+    """
+    execute_wrapper：记录查询的耗时和行数，记录慢查询
+    """
+    if getattr(_local, 'explaining', False):
+        return execute(sql, params, many, context)
+    options = get_options()
+    if not options['ENABLED']:
+        return execute(sql, params, many, context)
+    connection, cursor = context['connection'], context['cursor']
+    alias, model = connection.alias, model_for(sql)
+    is_select = sql.lstrip()[:6].upper() == 'SELECT'
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        ms = (time.perf_counter() - start) * 1000
+        slow = ms >= options['SLOW_QUERY_MS']
+        rows = 0
+        if is_select:
+            _count_rows(cursor, alias, model)
+        else:
+            _count_rows(cursor, alias, None)
+            rows = max(getattr(cursor, 'rowcount', 0) or 0, 0)
+        STATS.record(alias, model, ms, rows, slow)
+        if slow:
+            plan = explain(connection, sql, params) if options['EXPLAIN'] and is_select and not many else ''
+            logger.warning('慢查询 %.1fms [%s] %s %s\n%s', ms, alias, sql, params, plan)
+
+
+def install_wrapper(sender, connection, **kwargs):
+    if instrument not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrument)
+
+
+def stats_path(directory, pid=None):
+    return os.path.join(directory, '{}.json'.format(pid or os.getpid()))
+
+
+def save():
+    """
+    把当前进程的统计结果保存到 STATS_DIR
+    """
+    directory = get_options()['STATS_DIR']
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    path = stats_path(directory)
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(STATS.snapshot(), f)
+    os.replace(tmp, path)
+
+
+def load(directory):
+    """
+    汇总 directory 中所有进程的统计结果
+    :return: {'buckets': [...], 'entries': {(数据库, model): 统计}}
+    """
+    buckets, entries = None, {}
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, name), encoding='utf-8') as f:
+            snapshot = json.load(f)
+        if buckets is None:
+            buckets = snapshot['buckets']
+        elif buckets != snapshot['buckets']:
+            logger.warning('%s 的耗时分布与其他进程不同，跳过', name)
+            continue
+        for item in snapshot['entries']:
+            key = (item['alias'], item['model'])
+            entry = entries.setdefault(key, empty_entry(buckets))
+            merge_entry(entry, item)
+    return {'buckets': buckets or list(get_options()['BUCKETS']), 'entries': entries}
+
+
+_saver = None
+_saver_lock = threading.Lock()
+
+
+def _save_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            save()
+        except OSError:
+            logger.exception('保存查询统计失败')
+
+
+def start_saver(**kwargs):
+    """
+    request_started：处理第一个请求时开始在后台定期保存统计结果，进程退出时再保存一次
+    """
+    global _saver
+    options = get_options()
+    with _saver_lock:
+        if _saver is not None or not options['STATS_DIR']:
+            return
+        _saver = threading.Thread(target=_save_forever, args=(options['SAVE_INTERVAL'],), name='query-stats',
+                                  daemon=True)
+        _saver.start()
+    atexit.register(save)
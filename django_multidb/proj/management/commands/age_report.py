@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from boss.models import Boss
+from client.models import Client
+from driver.models import Driver
+from proj import sharding
+from proj.fanout import fan_out
+
+
+def age_distribution(queryset):
+    return {age: count for age, count in queryset.values_list('age').annotate(count=Count('id')).order_by()}
+
+
+class Command(BaseCommand):
+    """
+    并行统计老板、乘客、司机的人数和年龄分布
+    python manage.py age_report --timeout 2
+    某个数据库失败或超时时，输出其他数据库的结果，并列出失败的数据库
+    """
+
+    help = 'Count Boss, Client and Driver and their age distribution across databases in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=float, default=None, help='每个数据库的超时时间（秒）')
+
+    def handle(self, *args, **options):
+        querysets = {'boss': Boss.objects.all(), 'driver': Driver.objects.all()}
+        # 乘客按分片分别统计
+        for alias in sharding.SHARD_MAP.aliases('client'):
+            querysets['client:{}'.format(alias)] = Client.objects.using(alias)
+        result = fan_out(querysets, func=age_distribution, timeout=options['timeout'])
+        for key, distribution in result.results.items():
+            self.stdout.write('{:<20} {:>8}'.format(key, sum(distribution.values())))
+        for key, error in result.errors.items():
+            self.stdout.write('{:<20} {:>8}  {}'.format(key, 'failed', error))
+        distribution = result.merge() or {}
+        self.stdout.write('total {}'.format(sum(distribution.values())))
+        for age in sorted(distribution):
+            self.stdout.write('{:>5} {:>8}'.format(age, distribution[age]))
@@ -0,0 +1,49 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+from boss.models import Boss
+from driver.models import Driver
+from proj.coordinator import coordinated
+
+
+class Command(BaseCommand):
+    """
+    对比同时写入 Boss 和 Driver 时，分别使用 transaction.atomic(using=...) 与 coordinated() 的吞吐量
+    python manage.py bench_coordinator --number 500
+    测试写入的数据在结束后删除
+    """
+
+    help = 'Benchmark coordinated cross-database writes against separate atomic blocks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=500)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        name = 'bench'
+        boss_db, driver_db = router.db_for_write(Boss), router.db_for_write(Driver)
+
+        def separate():
+            with transaction.atomic(using=boss_db):
+                Boss.objects.create(name=name, age=1)
+            with transaction.atomic(using=driver_db):
+                Driver.objects.create(name=name, age=1)
+
+        def coordinate():
+            with coordinated() as group:
+                group.save(Boss(name=name, age=1))
+                group.save(Driver(name=name, age=1))
+
+        try:
+            # 第一次写入时创建 WriteMarker
+            coordinate()
+            for label, func in (('atomic', separate), ('coordinated', coordinate)):
+                start = time.perf_counter()
+                for _ in range(number):
+                    func()
+                elapsed = time.perf_counter() - start
+                self.stdout.write('{:<12} {:>8.0f} groups/s {:>8.3f} ms/group'.format(
+                    label, number / elapsed, elapsed / number * 1000))
+        finally:
+            Boss.objects.filter(name=name).delete()
+            Driver.objects.filter(name=name).delete()
@@ -0,0 +1,51 @@
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import router
+from django.test.utils import override_settings
+from boss.models import Boss
+from proj.database_router import DatabaseAppsRouter
+
+
+class PassRouter:
+    """不路由任何 model 的 router，用来模拟 DATABASE_ROUTERS 中的其他 router"""
+
+    def db_for_read(self, model, **hints):
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+
+class Command(BaseCommand):
+    """
+    对比 django.db.router 遍历 DATABASE_ROUTERS 与 DatabaseAppsRouter 查询路由表本身的耗时
+    python manage.py bench_router --number 100000
+    Boss 由 DatabaseAppsRouter 路由，User 不在 DATABASE_APPS_MAPPING 中，需要遍历所有 router
+    不配置只读副本，只测量路由本身的开销
+    """
+
+    help = 'Benchmark per-query routing overhead with 1, 5 and 20 routers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        self.stdout.write('{:>8} {:<6} {:>12} {:>12}'.format('routers', 'model', 'chain ns', 'table ns'))
+        for count in (1, 5, 20):
+            routers = ['proj.database_router.DatabaseAppsRouter'] + [
+                'proj.management.commands.bench_router.PassRouter'] * (count - 1)
+            with override_settings(DATABASE_ROUTERS=routers, DATABASE_APPS_REPLICAS={}):
+                for model in (Boss, User):
+                    chain = self.timeit(lambda: router.db_for_read(model), number)
+                    table = self.timeit(lambda: DatabaseAppsRouter.db_for_read(model), number)
+                    self.stdout.write('{:>8} {:<6} {:>12.0f} {:>12.0f}'.format(
+                        count, model.__name__, chain * 1e9, table * 1e9))
+
+    @staticmethod
+    def timeit(func, number):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        return (time.perf_counter() - start) / number
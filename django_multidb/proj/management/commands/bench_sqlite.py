@@ -0,0 +1,100 @@
+import os
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from proj import sqlite_profile
+
+ALIASES = ('boss', 'client', 'driver')
+# 默认的 rollback journal 配置
+STOCK = dict(sqlite_profile.DEFAULT_PROFILE, JOURNAL_MODE='DELETE', SYNCHRONOUS='FULL', BUSY_TIMEOUT=5000)
+
+
+class Command(BaseCommand):
+    """
+    在 boss、client、driver 三个临时数据库上并发读写，对比默认配置与 SQLITE_PROFILE 的吞吐量和延迟
+    python manage.py bench_sqlite --threads 8 --seconds 3 --write-ratio 0.2
+    每个线程为每个数据库建立一个连接，随机选择数据库，按 write-ratio 执行单行写入或按主键读取
+    """
+
+    help = 'Benchmark mixed reads and writes on the boss, client and driver SQLite files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=3)
+        parser.add_argument('--write-ratio', type=float, default=0.2)
+        parser.add_argument('--rows', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        tuned = sqlite_profile.get_profile({})
+        self.stdout.write('{:<8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+            'profile', 'ops/s', 'reads/s', 'writes/s', 'p99 ms', 'locked'))
+        for label, profile in (('stock', STOCK), ('tuned', tuned)):
+            with tempfile.TemporaryDirectory() as directory:
+                result = self.run(directory, profile, options)
+            self.stdout.write('{:<8} {:>10.0f} {:>10.0f} {:>10.0f} {:>10.3f} {:>8}'.format(label, *result))
+        self.stdout.write('tuned = settings.SQLITE_PROFILE: {}'.format(
+            {key: value for key, value in getattr(settings, 'SQLITE_PROFILE', {}).items() if 'INTERVAL' not in key}))
+
+    @staticmethod
+    def connect(path, profile):
+        raw = sqlite3.connect(path, timeout=profile['BUSY_TIMEOUT'] / 1000, isolation_level=None,
+                              check_same_thread=False)
+        sqlite_profile.apply(raw, profile)
+        return raw
+
+    def run(self, directory, profile, options):
+        paths = {alias: os.path.join(directory, '{}.sqlite3'.format(alias)) for alias in ALIASES}
+        for path in paths.values():
+            raw = self.connect(path, profile)
+            raw.execute('CREATE TABLE person (id INTEGER PRIMARY KEY, name varchar(12), age integer)')
+            raw.execute('BEGIN')
+            raw.executemany('INSERT INTO person (name, age) VALUES (?, ?)',
+                            (('name{}'.format(i), i % 80) for i in range(options['rows'])))
+            raw.execute('COMMIT')
+            raw.close()
+
+        deadline = time.monotonic() + options['seconds']
+        lock = threading.Lock()
+        totals = {'reads': 0, 'writes': 0, 'locked': 0, 'latencies': []}
+
+        def worker():
+            connections = {alias: self.connect(path, profile) for alias, path in paths.items()}
+            reads = writes = locked = 0
+            latencies = []
+            while time.monotonic() < deadline:
+                raw = connections[random.choice(ALIASES)]
+                start = time.perf_counter()
+                try:
+                    if random.random() < options['write_ratio']:
+                        raw.execute('INSERT INTO person (name, age) VALUES (?, ?)', ('bench', 1))
+                        writes += 1
+                    else:
+                        raw.execute('SELECT name, age FROM person WHERE id = ?',
+                                    (random.randint(1, options['rows']),)).fetchone()
+                        reads += 1
+                except sqlite3.OperationalError:
+                    locked += 1
+                latencies.append(time.perf_counter() - start)
+            for raw in connections.values():
+                raw.close()
+            with lock:
+                totals['reads'] += reads
+                totals['writes'] += writes
+                totals['locked'] += locked
+                totals['latencies'].extend(latencies)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        latencies = sorted(totals['latencies'])
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+        return ((totals['reads'] + totals['writes']) / elapsed, totals['reads'] / elapsed,
+                totals['writes'] / elapsed, p99, totals['locked'])
@@ -0,0 +1,51 @@
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from driver.models import Driver
+from driver.views import add_driver
+from proj import writebehind
+
+
+class Command(BaseCommand):
+    """
+    多个线程并发请求 add_driver，对比直接写入与延迟写入的请求耗时
+    python manage.py bench_writebehind --number 2000 --threads 8
+    测试写入的数据在结束后删除
+    """
+
+    help = 'Benchmark add_driver latency with and without the write-behind buffer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=2000)
+        parser.add_argument('--threads', type=int, default=8)
+
+    def handle(self, *args, **options):
+        name = 'bench'
+        factory = RequestFactory()
+
+        def request(_):
+            start = time.perf_counter()
+            add_driver(factory.get('/add_driver/', {'name': name, 'age': 1}))
+            elapsed = time.perf_counter() - start
+            connections.close_all()
+            return elapsed
+
+        self.stdout.write('{:<12} {:>10} {:>10} {:>10}'.format('mode', 'req/s', 'p50 ms', 'p99 ms'))
+        try:
+            for mode, enabled in (('sync', False), ('write-behind', True)):
+                with tempfile.TemporaryDirectory() as spill_dir, \
+                        override_settings(WRITE_BEHIND={'ENABLED': enabled, 'SPILL_DIR': spill_dir}):
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(options['threads']) as executor:
+                        latencies = sorted(executor.map(request, range(options['number'])))
+                    writebehind.shutdown()
+                    elapsed = time.perf_counter() - start
+                self.stdout.write('{:<12} {:>10.0f} {:>10.3f} {:>10.3f}'.format(
+                    mode, len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+                    latencies[int(len(latencies) * 0.99)] * 1000))
+        finally:
+            Driver.objects.using('driver').filter(name=name).delete()
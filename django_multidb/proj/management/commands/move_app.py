@@ -0,0 +1,240 @@
+import time
+import hashlib
+import functools
+from django.apps import apps
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from proj import app_move, database_router, fanout, sharding
+
+"""
+在线迁移App到另一个数据库
+python manage.py move_app boss spare
+1. 双写：在 DATABASE_MAPPING_FILE 中记录双写，等待所有进程重新加载，之后写入 boss 的表的 SQL 同时在 spare 上重放
+2. 建表：在 spare 上执行 boss 的迁移，并补建缺少的表
+3. 复制：每个表一个线程，按主键分批（keyset）复制 boss 中的数据，spare 中已有的行是双写的，比复制的新，不覆盖
+4. 校验：比较每个表的行数和每一批主键范围内数据的 md5，不一致时以 boss 为准修复这一批，最多重试 --verify-retries 次
+5. 冻结：禁止写入 boss 的表（抛出 AppMoveInProgress），等待所有进程重新加载，再校验、修复一次
+6. 切换：在 DATABASE_MAPPING_FILE 中把 boss 映射到 spare 并结束双写和冻结，所有进程在 1 秒内切换，boss 中的数据不删除
+切换前的任何一步失败都会结束双写和冻结，boss 照常使用；冻结期间 boss 只能读取，通常只有几秒
+分片的App请使用 reshard 命令
+"""
+
+
+def _dependency_levels(models):
+    """
+    按外键依赖分层，被引用的表在前，同一层的表并行复制
+    """
+    remaining = set(models)
+    levels = []
+    while remaining:
+        level = {model for model in remaining
+                 if not any(field.related_model in remaining - {model}
+                            for field in model._meta.concrete_fields if field.is_relation)}
+        if not level:
+            # 循环引用，剩下的表一起复制
+            level = remaining
+        levels.append(sorted(level, key=lambda model: model._meta.label))
+        remaining -= level
+    return levels
+
+
+def _checksum(rows):
+    digest = hashlib.md5()
+    for row in rows:
+        digest.update(repr(row).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+    help = 'Copy an app to another database online and flip DATABASE_APPS_MAPPING to it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label')
+        parser.add_argument('target', help='目标数据库')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=None, help='并行复制的线程数，默认每个表一个线程')
+        parser.add_argument('--verify-retries', type=int, default=3)
+        parser.add_argument('--no-flip', action='store_true', help='只复制和校验，不切换，结束后停止双写')
+
+    def handle(self, app_label, target, batch_size, workers, verify_retries, no_flip, **options):
+        database_router.check_mapping()
+        source = database_router.DATABASE_MAPPING.get(app_label)
+        if source is None:
+            raise CommandError('{} 不在 DATABASE_APPS_MAPPING 中'.format(app_label))
+        if target not in connections:
+            raise CommandError('{} 不在 DATABASES 中'.format(target))
+        if target == source:
+            raise CommandError('{} 已经在 {} 中'.format(app_label, target))
+        models = list(apps.get_app_config(app_label).get_models(include_auto_created=True))
+        if any(sharding.is_sharded(model) for model in models):
+            raise CommandError('{} 已分片，请使用 reshard 命令'.format(app_label))
+
+        app_move.OVERLAY.start_dual_writes(app_label, target)
+        database_router.reload()
+        try:
+            # 等待其他进程开始双写
+            time.sleep(app_move.RELOAD_INTERVAL)
+            call_command('migrate', app_label, database=target, verbosity=0)
+            self.create_tables(models, target)
+            levels = _dependency_levels(models)
+            for level in levels:
+                copied = self._parallel(level, source, target, functools.partial(
+                    self.copy, source=source, target=target, batch_size=batch_size), workers)
+                for model in level:
+                    self.stdout.write('{} {} -> {}: 复制 {} 行'.format(model._meta.label, source, target,
+                                                                    copied[model]))
+            self.converge(levels, source, target, batch_size, workers, verify_retries)
+            if not no_flip:
+                # 冻结后等待其他进程重新加载、完成进行中的写入，源数据库不再变化，最后一次校验之后的写入不会丢失
+                app_move.OVERLAY.freeze(app_label)
+                database_router.reload()
+                time.sleep(app_move.RELOAD_INTERVAL * 2)
+                self.converge(levels, source, target, batch_size, workers, verify_retries)
+            self.stdout.write('校验通过：{}'.format(', '.join(model._meta.label for model in models)))
+            if no_flip:
+                app_move.OVERLAY.stop_dual_writes(app_label)
+            else:
+                app_move.OVERLAY.flip(app_label, target)
+                self.stdout.write('{} 已切换到 {}'.format(app_label, target))
+        except BaseException:
+            app_move.OVERLAY.stop_dual_writes(app_label)
+            raise
+        finally:
+            database_router.reload()
+
+    def converge(self, levels, source, target, batch_size, workers, verify_retries):
+        """
+        校验所有表，修复不一致的批次后重新校验，直到一致
+        """
+        for attempt in range(verify_retries + 1):
+            mismatched = {}
+            for level in levels:
+                mismatched.update({model: chunks for model, chunks in self._parallel(
+                    level, source, target, functools.partial(
+                        self.verify, source=source, target=target, batch_size=batch_size), workers).items()
+                    if chunks})
+            if not mismatched:
+                return
+            if attempt == verify_retries:
+                raise CommandError('校验 {} 次后仍不一致：{}'.format(
+                    verify_retries + 1, ', '.join(model._meta.label for model in mismatched)))
+            for model, chunks in mismatched.items():
+                repaired = sum(self.repair(model, source, target, chunk) for chunk in chunks)
+                self.stdout.write('{}: {} 批不一致，修复 {} 行'.format(model._meta.label, len(chunks), repaired))
+
+    @staticmethod
+    def create_tables(models, alias):
+        """
+        之前在 alias 上执行 migrate 时 allow_migrate 返回 False，迁移记录为已执行但没有建表，补建缺少的表
+        """
+        connection = connections[alias]
+        tables = set(connection.introspection.table_names())
+        missing = [model for model in models if model._meta.managed and model._meta.db_table not in tables]
+        if missing:
+            with connection.schema_editor() as editor:
+                for model in missing:
+                    editor.create_model(model)
+
+    @staticmethod
+    def _parallel(models, source, target, func, workers):
+        """
+        每个表一个线程，见 fanout.run，工作线程结束时关闭目标数据库的连接
+        """
+        def task(model):
+            try:
+                return func(model)
+            finally:
+                if not connections[target].in_atomic_block:
+                    connections[target].close()
+
+        result = fanout.run({model: (source, functools.partial(task, model)) for model in models},
+                            max_workers=workers)
+        result.raise_for_errors()
+        return result.results
+
+    @staticmethod
+    def _fields(model):
+        return [field.attname for field in model._meta.concrete_fields]
+
+    def _scan(self, model, alias, batch_size):
+        """
+        按主键分批读取，生成 (这一批的主键范围, 行)
+        """
+        queryset = model._base_manager.using(alias).order_by('pk').values_list(*self._fields(model))
+        pk_index = self._fields(model).index(model._meta.pk.attname)
+        last = None
+        while True:
+            rows = list((queryset if last is None else queryset.filter(pk__gt=last))[:batch_size])
+            if not rows:
+                return
+            yield (last, rows[-1][pk_index]), rows
+            last = rows[-1][pk_index]
+
+    def copy(self, model, source, target, batch_size):
+        """
+        复制 source 中 target 没有的行
+        :return: 复制的行数
+        """
+        fields = self._fields(model)
+        pk_index = fields.index(model._meta.pk.attname)
+        manager = model._base_manager.db_manager(target)
+        count = 0
+        for _, rows in self._scan(model, source, batch_size):
+            # 目标数据库中已有的行是双写的，以双写的为准
+            existing = set(manager.filter(pk__in=[row[pk_index] for row in rows]).values_list('pk', flat=True))
+            objs = [model(**dict(zip(fields, row))) for row in rows if row[pk_index] not in existing]
+            manager.bulk_create(objs, ignore_conflicts=True)
+            count += len(objs)
+        return count
+
+    def _range(self, model, alias, pk_range):
+        queryset = model._base_manager.using(alias).order_by('pk').values_list(*self._fields(model))
+        low, high = pk_range
+        if low is not None:
+            queryset = queryset.filter(pk__gt=low)
+        if high is not None:
+            queryset = queryset.filter(pk__lte=high)
+        return queryset
+
+    def verify(self, model, source, target, batch_size):
+        """
+        比较行数和每一批的 md5
+        :return: 不一致的主键范围
+        """
+        mismatched = []
+        last = None
+        for pk_range, rows in self._scan(model, source, batch_size):
+            if _checksum(rows) != _checksum(self._range(model, target, pk_range)):
+                mismatched.append(pk_range)
+            last = pk_range[1]
+        # 源数据库最后一行之后，目标数据库中多出的行
+        if self._range(model, target, (last, None)).exists():
+            mismatched.append((last, None))
+        source_count = model._base_manager.using(source).count()
+        target_count = model._base_manager.using(target).count()
+        if source_count != target_count and not mismatched:
+            mismatched.append((None, None))
+        return mismatched
+
+    def repair(self, model, source, target, pk_range):
+        """
+        以 source 为准修复 target 中主键范围内的数据
+        :return: 新增、更新和删除的行数
+        """
+        fields = self._fields(model)
+        pk_index = fields.index(model._meta.pk.attname)
+        expected = {row[pk_index]: row for row in self._range(model, source, pk_range)}
+        actual = {row[pk_index]: row for row in self._range(model, target, pk_range)}
+        manager = model._base_manager.db_manager(target)
+        created = [model(**dict(zip(fields, row))) for pk, row in expected.items() if pk not in actual]
+        updated = [model(**dict(zip(fields, row))) for pk, row in expected.items()
+                   if pk in actual and actual[pk] != row]
+        deleted = [pk for pk in actual if pk not in expected]
+        with transaction.atomic(using=target):
+            manager.bulk_create(created)
+            if updated:
+                manager.bulk_update(updated, [name for name in fields if name != model._meta.pk.attname])
+            if deleted:
+                manager.filter(pk__in=deleted)._raw_delete(target)
+        return len(created) + len(updated) + len(deleted)
@@ -0,0 +1,91 @@
+import os
+import csv
+import json
+from django.core.management.base import BaseCommand, CommandError
+from proj import instrumentation
+
+COLUMNS = ('alias', 'model', 'count', 'total_ms', 'avg_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'rows', 'slow')
+
+
+def percentile(buckets, histogram, q):
+    """
+    根据耗时分布估算分位数，返回所在区间的上限，超过最后一个上限时返回 inf
+    """
+    total = sum(histogram)
+    if not total:
+        return 0
+    cumulative = 0
+    for bound, count in zip(list(buckets) + [float('inf')], histogram):
+        cumulative += count
+        if cumulative >= total * q:
+            return bound
+    return float('inf')
+
+
+class Command(BaseCommand):
+    """
+    汇总所有进程保存在 QUERY_INSTRUMENTATION['STATS_DIR'] 中的查询统计
+    python manage.py query_stats
+    python manage.py query_stats --format csv --output stats.csv
+    python manage.py query_stats --reset
+    """
+
+    help = 'Print or export per-alias and per-model query statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=('table', 'json', 'csv'), default='table')
+        parser.add_argument('--output', help='写入文件，默认输出到标准输出')
+        parser.add_argument('--alias', help='只显示这个数据库')
+        parser.add_argument('--reset', action='store_true', help='删除已保存的统计结果')
+
+    def handle(self, *args, **options):
+        directory = instrumentation.get_options()['STATS_DIR']
+        if not directory:
+            raise CommandError('没有配置 QUERY_INSTRUMENTATION[\'STATS_DIR\']')
+        if options['reset']:
+            for name in os.listdir(directory) if os.path.isdir(directory) else ():
+                if name.endswith('.json'):
+                    os.remove(os.path.join(directory, name))
+            self.stdout.write('已删除 {} 中的统计结果'.format(directory))
+            return
+        data = instrumentation.load(directory)
+        rows = self.rows(data, options['alias'])
+        output = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else self.stdout
+        try:
+            getattr(self, 'write_{}'.format(options['format']))(output, rows, data['buckets'])
+        finally:
+            if options['output']:
+                output.close()
+
+    @staticmethod
+    def rows(data, alias=None):
+        rows = []
+        for (entry_alias, model), entry in sorted(data['entries'].items()):
+            if alias and entry_alias != alias:
+                continue
+            histogram = entry['histogram']
+            rows.append(dict(entry, alias=entry_alias, model=model,
+                             avg_ms=entry['total_ms'] / entry['count'] if entry['count'] else 0,
+                             p50_ms=percentile(data['buckets'], histogram, 0.5),
+                             p95_ms=percentile(data['buckets'], histogram, 0.95),
+                             p99_ms=percentile(data['buckets'], histogram, 0.99)))
+        return rows
+
+    @staticmethod
+    def write_table(output, rows, buckets):
+        output.write('{:<14} {:<18} {:>8} {:>10} {:>8} {:>7} {:>7} {:>7} {:>9} {:>9} {:>6}\n'.format(*COLUMNS))
+        for row in rows:
+            output.write('{alias:<14} {model:<18} {count:>8} {total_ms:>10.1f} {avg_ms:>8.3f} {p50_ms:>7} '
+                         '{p95_ms:>7} {p99_ms:>7} {max_ms:>9.3f} {rows:>9} {slow:>6}\n'.format(**row))
+        output.write('p50/p95/p99 为所在耗时区间的上限（毫秒），区间：{}\n'.format(buckets))
+
+    @staticmethod
+    def write_json(output, rows, buckets):
+        output.write(json.dumps({'buckets': buckets, 'stats': rows}, indent=4) + '\n')
+
+    @staticmethod
+    def write_csv(output, rows, buckets):
+        writer = csv.DictWriter(output, fieldnames=COLUMNS + ('histogram',), extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, histogram=' '.join(map(str, row['histogram']))))
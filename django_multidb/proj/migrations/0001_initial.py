@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WriteIntent',
+            fields=[
+                ('gid', models.CharField(max_length=32, primary_key=True, serialize=False, verbose_name='写入组')),
+                ('operations', models.TextField(verbose_name='写入操作')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+            ],
+            options={
+                'db_table': 'WriteIntent',
+            },
+        ),
+    ]
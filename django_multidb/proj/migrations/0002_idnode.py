@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proj', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdNode',
+            fields=[
+                ('node', models.PositiveSmallIntegerField(primary_key=True, serialize=False, verbose_name='节点号')),
+                ('owner', models.CharField(max_length=100, verbose_name='持有者')),
+                ('expires', models.DateTimeField(verbose_name='租约到期时间')),
+            ],
+            options={
+                'db_table': 'IdNode',
+            },
+        ),
+    ]
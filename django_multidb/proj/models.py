@@ -0,0 +1,27 @@
+from django.db import models
+
+
+class WriteIntent(models.Model):
+    """
+    跨数据库写入的意图日志，见 proj.coordinator
+    """
+
+    class Meta:
+        db_table = 'WriteIntent'
+
+    gid = models.CharField('写入组', max_length=32, primary_key=True)
+    operations = models.TextField('写入操作')
+    created = models.DateTimeField('创建时间', auto_now_add=True)
+
+
+class IdNode(models.Model):
+    """
+    proj.sharding.next_id() 的节点号租约
+    """
+
+    class Meta:
+        db_table = 'IdNode'
+
+    node = models.PositiveSmallIntegerField('节点号', primary_key=True)
+    owner = models.CharField('持有者', max_length=100)
+    expires = models.DateTimeField('租约到期时间')
@@ -0,0 +1,304 @@
+import time
+import threading
+from collections import deque
+
+"""
+数据库连接池
+默认每个请求结束时关闭数据库连接，下一个请求重新连接，使用 MySQL、PostgreSQL 时每个请求都要付出建立连接的代价
+将 ENGINE 替换为 proj.pool.sqlite3 或 proj.pool.postgresql，Django 关闭连接时把连接放回连接池，
+下次需要连接时从连接池中取出，连接池由同一个进程的所有线程共享
+
+'boss': {
+    'ENGINE': 'proj.pool.sqlite3',
+    'NAME': os.path.join(BASE_DIR, 'boss.sqlite3'),
+    'POOL': {
+        'MIN_SIZE': 1,          # 至少保留的空闲连接数
+        'MAX_SIZE': 10,         # 最多同时存在的连接数，包括空闲和正在使用的
+        'MAX_IDLE': 300,        # 空闲超过多少秒的连接被关闭，保留 MIN_SIZE 个
+        'TIMEOUT': 5,           # 连接数达到 MAX_SIZE 时，等待空闲连接的秒数，超时抛出 OperationalError
+        'HEALTH_CHECK': True,   # 取出连接时执行 SELECT 1，失败则丢弃并重新连接
+    },
+},
+
+通过 proj.pool.stats() 查看每个连接池的指标
+"""
+
+DEFAULT_OPTIONS = {
+    'MIN_SIZE': 0,
+    'MAX_SIZE': 10,
+    'MAX_IDLE': 300,
+    'TIMEOUT': 5,
+    'HEALTH_CHECK': True,
+}
+
+# {(alias, 数据库名): ConnectionPool}
+POOLS = {}
+_pools_lock = threading.Lock()
+
+
+def ping(raw):
+    """
+    连接的健康检查
+    """
+    try:
+        cursor = raw.cursor()
+        try:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+        finally:
+            cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+class ConnectionPool:
+
+    def __init__(self, connect, close, check=None, min_size=0, max_size=10, max_idle=300, timeout=5,
+                 error_class=Exception, name=None):
+        """
+        :param connect: 建立新连接的函数
+        :param close: 关闭连接的函数
+        :param check: 健康检查的函数，返回 False 时丢弃连接
+        :param error_class: 等待连接超时时抛出的异常
+        """
+        self.connect = connect
+        self.close = close
+        self.check = check
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.error_class = error_class
+        self.name = name
+        # 空闲连接，(连接, 放回的时间)，右侧为最近放回的
+        self._idle = deque()
+        # 已取出和正在建立的连接数
+        self._busy = 0
+        self._cond = threading.Condition()
+        self._metrics = dict.fromkeys(('created', 'closed', 'checkouts', 'checkins', 'waits', 'timeouts',
+                                       'health_check_failures', 'reaped'), 0)
+        self._wait_seconds = 0.0
+        self._reaper = None
+        self._filling = False
+
+    def _incr(self, key, value=1):
+        # 调用方持有 self._cond
+        self._metrics[key] += value
+
+    def checkout(self):
+        """
+        取出一个连接，优先使用最近放回的空闲连接
+        """
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        start = time.monotonic()
+        waited = False
+        with self._cond:
+            while not self._idle and self._busy >= self.max_size:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._incr('timeouts')
+                    raise self.error_class('连接池 {} 已满，等待 {} 秒后仍没有空闲连接'.format(self.name, self.timeout))
+                waited = True
+                self._cond.wait(remaining)
+            if waited:
+                self._incr('waits')
+                self._wait_seconds += time.monotonic() - start
+            raw = self._idle.pop()[0] if self._idle else None
+            self._busy += 1
+            self._incr('checkouts')
+        try:
+            if raw is not None and self.check is not None and not self.check(raw):
+                with self._cond:
+                    self._incr('health_check_failures')
+                self._discard(raw)
+                raw = None
+            if raw is None:
+                raw = self.connect()
+                with self._cond:
+                    self._incr('created')
+        except BaseException:
+            with self._cond:
+                self._busy -= 1
+                self._cond.notify()
+            raise
+        self._start_reaper()
+        return raw
+
+    def checkin(self, raw, discard=False):
+        """
+        放回连接
+        :param discard: 连接状态未知时（如在事务中关闭）直接关闭，不放回连接池
+        """
+        with self._cond:
+            self._busy -= 1
+            self._incr('checkins')
+            if not discard:
+                self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+        if discard:
+            self._discard(raw)
+
+    def _discard(self, raw):
+        try:
+            self.close(raw)
+        except Exception:
+            pass
+        with self._cond:
+            self._incr('closed')
+
+    def reap(self):
+        """
+        关闭空闲超过 max_idle 秒的连接，保留 min_size 个
+        :return: 关闭的连接数
+        """
+        expired = []
+        with self._cond:
+            now = time.monotonic()
+            while len(self._idle) > self.min_size and now - self._idle[0][1] > self.max_idle:
+                expired.append(self._idle.popleft()[0])
+            self._incr('reaped', len(expired))
+        for raw in expired:
+            self._discard(raw)
+        return len(expired)
+
+    def _start_reaper(self):
+        if self._reaper is not None or not self.max_idle:
+            return
+        with self._cond:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap_forever, name='pool-reaper-{}'.format(self.name),
+                                            daemon=True)
+        self._reaper.start()
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(max(self.max_idle / 2, 1))
+            self.reap()
+
+    def fill(self):
+        """
+        建立连接直到空闲连接数达到 min_size
+        """
+        while True:
+            with self._cond:
+                if len(self._idle) >= self.min_size or len(self._idle) + self._busy >= self.max_size:
+                    return
+                self._busy += 1
+            try:
+                raw = self.connect()
+            except BaseException:
+                with self._cond:
+                    self._busy -= 1
+                raise
+            with self._cond:
+                self._incr('created')
+            self.checkin(raw)
+            with self._cond:
+                # fill 放回的连接不计入 checkins
+                self._metrics['checkins'] -= 1
+
+    def fill_async(self):
+        """
+        在后台线程中执行 fill，取出连接的线程不等待新连接建立
+        :return: 执行 fill 的线程，已经在执行或不需要时为 None
+        """
+        with self._cond:
+            if self._filling or len(self._idle) >= self.min_size:
+                return None
+            self._filling = True
+        thread = threading.Thread(target=self._fill_in_background, name='pool-filler-{}'.format(self.name),
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _fill_in_background(self):
+        try:
+            self.fill()
+        except Exception:
+            # 无法建立连接时，下一次取出连接会自行连接并抛出异常
+            pass
+        finally:
+            with self._cond:
+                self._filling = False
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for raw, _ in idle:
+            self._discard(raw)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._metrics)
+            stats.update(idle=len(self._idle), in_use=self._busy, max_size=self.max_size,
+                         avg_wait_ms=self._wait_seconds / stats['waits'] * 1000 if stats['waits'] else 0)
+        return stats
+
+
+def get_pool(wrapper, connect, close):
+    """
+    数据库连接对应的连接池，同一个 alias 和数据库名的连接共享一个连接池
+    """
+    key = (wrapper.alias, wrapper.settings_dict['NAME'])
+    pool = POOLS.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = POOLS.get(key)
+            if pool is None:
+                options = dict(DEFAULT_OPTIONS, **wrapper.settings_dict.get('POOL', {}))
+                pool = ConnectionPool(connect, close, ping if options['HEALTH_CHECK'] else None,
+                                      options['MIN_SIZE'], options['MAX_SIZE'], options['MAX_IDLE'],
+                                      options['TIMEOUT'], wrapper.Database.OperationalError, wrapper.alias)
+                POOLS[key] = pool
+    return pool
+
+
+def stats():
+    """
+    :return: {alias: 指标}
+    """
+    return {alias: pool.stats() for (alias, _), pool in POOLS.items()}
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    DatabaseWrapper 的 mixin，通过连接池建立和关闭连接
+    """
+
+    pooled = True
+
+    def new_connection(self, conn_params):
+        """
+        真正建立连接，子类可以在这里初始化新的连接
+        """
+        return super(PooledDatabaseWrapperMixin, self).get_new_connection(conn_params)
+
+    def _pool(self, conn_params):
+        return get_pool(self, lambda: self.new_connection(conn_params), lambda raw: raw.close())
+
+    def get_new_connection(self, conn_params):
+        if not self.pooled:
+            return self.new_connection(conn_params)
+        pool = self._pool(conn_params)
+        raw = pool.checkout()
+        if pool.min_size:
+            pool.fill_async()
+        return raw
+
+    def _close(self):
+        if not self.pooled or self.connection is None:
+            return super()._close()
+        pool = self._pool(self.get_connection_params())
+        raw = self.connection
+        # 在事务中关闭，或者执行时出现过错误（close_if_unusable_or_obsolete 因此关闭）的连接状态未知，不放回连接池
+        discard = self.in_atomic_block or self.errors_occurred
+        if not discard:
+            try:
+                # 放回连接池前结束未提交的事务
+                with self.wrap_database_errors:
+                    raw.rollback()
+            except Exception:
+                discard = True
+        pool.checkin(raw, discard)
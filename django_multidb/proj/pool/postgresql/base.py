@@ -0,0 +1,6 @@
+from django.db.backends.postgresql import base
+from proj.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    pass
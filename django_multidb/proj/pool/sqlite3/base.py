@@ -0,0 +1,17 @@
+from django.db.backends.sqlite3 import base
+from proj import sqlite_profile
+from proj.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+
+    @property
+    def pooled(self):
+        # 内存数据库（包括测试数据库）关闭连接即销毁数据，不使用连接池
+        return not self.is_in_memory_db()
+
+    def new_connection(self, conn_params):
+        raw = super().new_connection(conn_params)
+        # 按 SQLITE_PROFILE 初始化新连接，从连接池取出的连接不再重复执行
+        sqlite_profile.init_connection(self, raw)
+        return raw
@@ -39,7 +39,9 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'boss',
     'client',
-    'driver'
+    'driver',
+    # 生成数据库路由表，见 proj.database_router
+    'proj.apps.ProjConfig',
 ]
 
 MIDDLEWARE = [
@@ -50,6 +52,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # 同一个请求中写入后的读请求发往主库
+    'proj.database_router.RouterMiddleware',
 ]
 
 ROOT_URLCONF = 'proj.urls'
@@ -76,23 +80,90 @@ WSGI_APPLICATION = 'proj.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
+# 连接池，见 proj.pool，每个数据库可以通过 POOL 单独设置
+DATABASE_POOL = {
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 10,
+    'MAX_IDLE': 300,
+    'TIMEOUT': 5,
+    'HEALTH_CHECK': True,
+}
+
+# 所有 SQLite 数据库新连接的 PRAGMA 和后台维护，见 proj.sqlite_profile，每个数据库可以通过 SQLITE 单独设置
+SQLITE_PROFILE = {
+    'JOURNAL_MODE': 'WAL',
+    'SYNCHRONOUS': 'NORMAL',
+    'CACHE_SIZE': -16000,
+    'MMAP_SIZE': 128 * 1024 * 1024,
+    'BUSY_TIMEOUT': 5000,
+    'CHECKPOINT_INTERVAL': 60,
+    'CHECKPOINT_MODE': 'PASSIVE',
+    'ANALYZE_INTERVAL': 3600,
+}
+
+# 仓库中提交的数据库文件保持 rollback journal 模式，切换到 WAL 会改写文件头并在旁边留下 -wal、-shm 文件
+# 部署时去掉这些数据库的 'SQLITE' 即按 SQLITE_PROFILE 使用 WAL
+ROLLBACK_JOURNAL = {'JOURNAL_MODE': 'DELETE', 'SYNCHRONOUS': 'FULL', 'CHECKPOINT_INTERVAL': 0}
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'proj.pool.sqlite3',
+        'POOL': DATABASE_POOL,
         'NAME': os.path.join(BASE_DIR, 'proj.sqlite3'),
+        'SQLITE': ROLLBACK_JOURNAL,
     },
     'client': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'proj.pool.sqlite3',
+        'POOL': DATABASE_POOL,
         'NAME': os.path.join(BASE_DIR, 'client.sqlite3'),
+        'SQLITE': ROLLBACK_JOURNAL,
     },
     'driver': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'proj.pool.sqlite3',
+        'POOL': DATABASE_POOL,
         'NAME': os.path.join(BASE_DIR, 'driver.sqlite3'),
+        'SQLITE': ROLLBACK_JOURNAL,
     },
     'boss': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'proj.pool.sqlite3',
+        'POOL': DATABASE_POOL,
+        'NAME': os.path.join(BASE_DIR, 'boss.sqlite3'),
+        'SQLITE': ROLLBACK_JOURNAL,
+    },
+    # 只读副本，本地使用指向同一个SQLite文件的连接代替真正的复制
+    'client_replica': {
+        'ENGINE': 'proj.pool.sqlite3',
+        'POOL': DATABASE_POOL,
+        'NAME': os.path.join(BASE_DIR, 'client.sqlite3'),
+        'SQLITE': ROLLBACK_JOURNAL,
+        'TEST': {'MIRROR': 'client'},
+    },
+    'driver_replica': {
+        'ENGINE': 'proj.pool.sqlite3',
+        'POOL': DATABASE_POOL,
+        'NAME': os.path.join(BASE_DIR, 'driver.sqlite3'),
+        'SQLITE': ROLLBACK_JOURNAL,
+        'TEST': {'MIRROR': 'driver'},
+    },
+    # Client 的第二个分片
+    'client_shard1': {
+        'ENGINE': 'proj.pool.sqlite3',
+        'POOL': DATABASE_POOL,
+        'NAME': os.path.join(BASE_DIR, 'client_shard1.sqlite3'),
+    },
+    'boss_replica': {
+        'ENGINE': 'proj.pool.sqlite3',
+        'POOL': DATABASE_POOL,
         'NAME': os.path.join(BASE_DIR, 'boss.sqlite3'),
-    }
+        'SQLITE': ROLLBACK_JOURNAL,
+        'TEST': {'MIRROR': 'boss'},
+    },
+    # 备用的空数据库，通过 move_app 命令把App迁移到这里
+    'spare': {
+        'ENGINE': 'proj.pool.sqlite3',
+        'POOL': DATABASE_POOL,
+        'NAME': os.path.join(BASE_DIR, 'spare.sqlite3'),
+    },
 }
 
 DATABASE_ROUTERS = ['proj.database_router.DatabaseAppsRouter']
@@ -103,6 +174,67 @@ DATABASE_APPS_MAPPING = {
     'driver': 'driver'
 }
 
+# 每个App的只读副本及权重，读请求在副本间负载均衡，主库也可以作为副本之一
+DATABASE_APPS_REPLICAS = {
+    'boss': {'boss_replica': 1},
+    'client': {'client_replica': 1},
+    'driver': {'driver_replica': 1},
+}
+
+# 分片，声明了 shard_key 的 model 按分片键的 crc32 对 SHARD_BUCKETS 取模，每一段桶属于一个数据库
+# 通过 reshard 命令移动桶之后，新的分片表保存在 SHARD_MAP_FILE 中
+DATABASE_APPS_SHARDS = {
+    'client': {
+        'databases': ['client', 'client_shard1'],
+        'ranges': [(0, 1024, 'client')],
+    },
+}
+
+SHARD_BUCKETS = 1024
+
+SHARD_MAP_FILE = os.path.join(BASE_DIR, 'shard_map.json')
+
+# 分片主键 next_id() 的节点号（0-1023），每个写入分片数据的进程需要不同，不设置时每个进程在 IdNode 表中租用一个
+# SHARD_NODE_ID = 0
+
+# move_app 修改的 DATABASE_APPS_MAPPING，见 proj.app_move
+DATABASE_MAPPING_FILE = os.path.join(BASE_DIR, 'database_mapping.json')
+
+DATABASE_ROUTER_OPTIONS = {
+    'BALANCE': 'weighted',
+    'STICKY_SECONDS': 5,
+    'HEALTH_CHECK_INTERVAL': 5,
+}
+
+# 批量写入接口，见 proj.ingest
+INGEST = {
+    'BATCH_SIZE': 500,
+    'MAX_BATCH_SIZE': 5000,
+    'MAX_INFLIGHT': 2,
+    'ACQUIRE_TIMEOUT': 5,
+    'MAX_BATCH_SECONDS': 1.0,
+}
+
+# 单行写入接口的延迟写入，见 proj.writebehind
+WRITE_BEHIND = {
+    'ENABLED': False,
+    'MAX_QUEUE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 0.05,
+    'SPILL_DIR': os.path.join(BASE_DIR, 'spill'),
+    'FSYNC': False,
+}
+
+# 查询统计和慢查询日志，见 proj.instrumentation
+QUERY_INSTRUMENTATION = {
+    'ENABLED': True,
+    'SLOW_QUERY_MS': 100,
+    'EXPLAIN': True,
+    'BUCKETS': (1, 5, 10, 50, 100, 500, 1000),
+    'STATS_DIR': os.path.join(BASE_DIR, 'query_stats'),
+    'SAVE_INTERVAL': 10,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -0,0 +1,568 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import heapq
+import random
+import socket
+import functools
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter, itemgetter
+from itertools import chain, islice
+from django.conf import settings
+from django.db import connections, models, router, transaction, IntegrityError
+from django.db.models.signals import pre_save
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.query import FlatValuesListIterable, ValuesIterable, ModelIterable
+from django.utils import timezone
+from . import fanout
+
+"""
+水平分片
+model 通过 shard_key 声明分片键，如 Client.shard_key = 'name'
+分片键的 crc32 对 SHARD_BUCKETS 取模得到桶，每一段连续的桶属于一个数据库：
+
+DATABASE_APPS_SHARDS = {
+    'client': {
+        # 所有分片数据库，可以暂时不分配桶，用于 reshard 扩容
+        'databases': ['client', 'client_shard1'],
+        'ranges': [(0, 512, 'client'), (512, 1024, 'client_shard1')],
+    },
+}
+
+保存实例时，DatabaseAppsRouter 根据分片键选择数据库
+查询时通过 Client.objects.shard('Park') 指定分片键，
+或者通过 Client.objects.all_shards() 在所有分片上并行查询，合并结果，支持 order_by、切片、count、aggregate(Sum/Count/Max/Min)
+没有指定分片键的 Client.objects.filter(...) 同样在所有分片上查询，
+不经过 ShardedQuerySet 的查询（如 _base_manager）没有指定数据库时，DatabaseAppsRouter 抛出 ShardKeyRequired
+reshard 命令在线移动一段桶之后，新的分片表保存在 SHARD_MAP_FILE 中，所有进程在 1 秒内重新加载，
+移动的最后阶段这段桶禁止写入，写入时抛出 ReshardInProgress
+分片的 model 继承 ShardedModelMixin，使用 BigAutoField 作为主键，新增时由 next_id() 分配全局唯一的主键，分片键保存后不能修改
+next_id() 的节点号由 settings.SHARD_NODE_ID 指定，或者由每个进程在 IdNode 表中租用
+"""
+
+SHARD_BUCKETS = getattr(settings, 'SHARD_BUCKETS', 1024)
+# next_id() 的起始时间，2018-01-01
+ID_EPOCH = 1514764800000
+# 检查 SHARD_MAP_FILE 是否修改的间隔（秒）
+RELOAD_INTERVAL = 1
+
+
+class ShardMap:
+
+    def __init__(self, shards, path=None):
+        self._ranges = {app_label: sorted(tuple(item) for item in config['ranges'])
+                        for app_label, config in shards.items()}
+        self._databases = {app_label: set(config.get('databases', ())) for app_label, config in shards.items()}
+        # reshard 最后一次追赶和切换期间禁止写入的桶，{app_label: [(start, end)]}
+        self._frozen = {}
+        self.path = path
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        if self.path is None or time.monotonic() - self._checked < RELOAD_INTERVAL:
+            return
+        self._checked = time.monotonic()
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            # 兼容只保存了分片表的旧文件
+            ranges, frozen = (data['ranges'], data.get('frozen', {})) if 'ranges' in data else (data, {})
+            with self._lock:
+                self._ranges = {app_label: sorted(tuple(item) for item in items)
+                                for app_label, items in ranges.items()}
+                self._frozen = {app_label: [tuple(item) for item in items] for app_label, items in frozen.items()}
+                self._mtime = mtime
+
+    def _save(self):
+        if self.path is not None:
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'ranges': self._ranges, 'frozen': self._frozen}, f, indent=4)
+            os.replace(tmp, self.path)
+            self._mtime = os.path.getmtime(self.path)
+
+    def ranges(self, app_label):
+        self._reload()
+        return self._ranges.get(app_label, [])
+
+    def apps(self):
+        self._reload()
+        return list(self._ranges)
+
+    def aliases(self, app_label):
+        """
+        分配了桶的数据库
+        """
+        return sorted({alias for _, _, alias in self.ranges(app_label)})
+
+    def databases(self, app_label):
+        """
+        所有分片数据库，包括还没有分配桶的
+        """
+        return self._databases.get(app_label, set()) | set(self.aliases(app_label))
+
+    def alias_for_bucket(self, app_label, value):
+        for start, end, alias in self.ranges(app_label):
+            if start <= value < end:
+                return alias
+        raise ValueError('桶 {} 不属于 {} 的任何分片'.format(value, app_label))
+
+    def frozen(self, app_label):
+        self._reload()
+        return self._frozen.get(app_label, [])
+
+    def is_frozen(self, app_label, value):
+        return any(start <= value < end for start, end in self.frozen(app_label))
+
+    def frozen_aliases(self, app_label):
+        """
+        拥有被冻结的桶的数据库
+        """
+        return {alias for start, end in self.frozen(app_label) for range_start, range_end, alias in
+                self.ranges(app_label) if range_start < end and range_end > start}
+
+    def freeze(self, app_label, start, end):
+        """
+        禁止写入 [start, end) 的桶，并写入 SHARD_MAP_FILE，move() 时解除
+        """
+        with self._lock:
+            self._frozen[app_label] = sorted(set(self._frozen.get(app_label, [])) | {(start, end)})
+            self._save()
+
+    def move(self, app_label, start, end, alias):
+        """
+        将 [start, end) 的桶分配给 alias，解除冻结，并写入 SHARD_MAP_FILE
+        """
+        with self._lock:
+            ranges = []
+            for range_start, range_end, range_alias in self._ranges[app_label]:
+                if range_start < start:
+                    ranges.append((range_start, min(range_end, start), range_alias))
+                if range_end > end:
+                    ranges.append((max(range_start, end), range_end, range_alias))
+            ranges.append((start, end, alias))
+            # 合并相邻的、属于同一个数据库的桶
+            merged = []
+            for item in sorted(ranges):
+                if merged and merged[-1][1] == item[0] and merged[-1][2] == item[2]:
+                    merged[-1] = (merged[-1][0], item[1], item[2])
+                else:
+                    merged.append(item)
+            self._ranges[app_label] = merged
+            self._thaw(app_label, start, end)
+            self._save()
+
+    def _thaw(self, app_label, start, end):
+        frozen = [item for item in self._frozen.get(app_label, []) if item != (start, end)]
+        if frozen:
+            self._frozen[app_label] = frozen
+        else:
+            self._frozen.pop(app_label, None)
+
+    def thaw(self, app_label, start, end):
+        """
+        不移动桶，解除 [start, end) 的冻结，reshard 失败时使用
+        """
+        with self._lock:
+            self._thaw(app_label, start, end)
+            self._save()
+
+
+SHARD_MAP = ShardMap(getattr(settings, 'DATABASE_APPS_SHARDS', {}), getattr(settings, 'SHARD_MAP_FILE', None))
+
+
+def reload():
+    """
+    修改 DATABASE_APPS_SHARDS 后重新创建分片表
+    """
+    global SHARD_MAP, SHARD_BUCKETS
+    SHARD_BUCKETS = getattr(settings, 'SHARD_BUCKETS', 1024)
+    SHARD_MAP = ShardMap(getattr(settings, 'DATABASE_APPS_SHARDS', {}), getattr(settings, 'SHARD_MAP_FILE', None))
+
+
+def bucket(value):
+    return zlib.crc32(str(value).encode('utf-8')) % SHARD_BUCKETS
+
+
+def is_sharded(model):
+    return getattr(model, 'shard_key', None) is not None and model._meta.app_label in SHARD_MAP.apps()
+
+
+class ShardKeyRequired(ValueError):
+    """
+    分片的 model 没有指定分片键，不能确定使用哪个分片
+    """
+
+
+class ReshardInProgress(Exception):
+    """
+    写入的桶正在被 reshard 移动，稍后重试
+    """
+
+
+def shard_for(model, value, write=False):
+    """
+    分片键为 value 的数据所在的数据库
+    :param write: 为 True 时，桶正在被 reshard 移动则抛出 ReshardInProgress
+    """
+    app_label, value_bucket = model._meta.app_label, bucket(value)
+    if write and SHARD_MAP.is_frozen(app_label, value_bucket):
+        raise ReshardInProgress('{} 的桶 {} 正在移动'.format(app_label, value_bucket))
+    return SHARD_MAP.alias_for_bucket(app_label, value_bucket)
+
+
+def shard_for_instance(instance, write=False):
+    return shard_for(type(instance), getattr(instance, instance.shard_key), write)
+
+
+def check_writable(model, alias):
+    """
+    不知道分片键的写入（QuerySet.update、delete），在 alias 有桶正在被 reshard 移动时抛出 ReshardInProgress
+    """
+    if alias in SHARD_MAP.frozen_aliases(model._meta.app_label):
+        raise ReshardInProgress('{} 在 {} 上的桶正在移动'.format(model._meta.label, alias))
+
+
+# next_id() 的节点号为10位，最多 1024 个进程同时分配主键
+ID_NODES = 1024
+# 节点号租约的时长（秒），过了一半时续约，到期没有续约的节点号可以被其他进程取得
+NODE_LEASE_SECONDS = 300
+
+_id_lock = threading.Lock()
+_id_state = {'ms': 0, 'seq': 0}
+# 当前进程租用的节点号，fork 出的子进程需要重新租用
+_node = {'node': None, 'pid': None, 'expires': 0}
+_owner_token = uuid.uuid4().hex
+
+
+def _lease(node):
+    """
+    续约 node，node 为 None 或已经被其他进程取得时，租用一个新的节点号
+    :return: 节点号
+    """
+    from proj.models import IdNode
+    alias = router.db_for_write(IdNode)
+    manager = IdNode.objects.using(alias)
+    owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), _owner_token)
+    now = timezone.now()
+    expires = now + timedelta(seconds=NODE_LEASE_SECONDS)
+    if node is not None and manager.filter(node=node, owner=owner).update(expires=expires):
+        return node
+    taken = set(manager.filter(expires__gte=now).values_list('node', flat=True))
+    for candidate in random.sample(range(ID_NODES), ID_NODES):
+        if candidate in taken:
+            continue
+        # 到期的租约直接取得，没有租约时新增，两个进程同时新增时只有一个成功
+        if manager.filter(node=candidate, expires__lt=now).update(owner=owner, expires=expires):
+            return candidate
+        try:
+            with transaction.atomic(using=alias):
+                manager.create(node=candidate, owner=owner, expires=expires)
+            return candidate
+        except IntegrityError:
+            continue
+    raise RuntimeError('{} 个节点号都已被租用'.format(ID_NODES))
+
+
+def _lease_in_thread(node):
+    """
+    在单独的线程中使用独立的数据库连接租用节点号，租约不会随当前线程的事务回滚
+    """
+
+    def lease():
+        try:
+            return _lease(node)
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(lease).result()
+
+
+def node_id():
+    """
+    next_id() 的节点号，优先使用 settings.SHARD_NODE_ID，没有设置时在 IdNode 表中租用
+    """
+    configured = getattr(settings, 'SHARD_NODE_ID', None)
+    if configured is not None:
+        return configured
+    now = time.monotonic()
+    if _node['pid'] != os.getpid() or now >= _node['expires'] - NODE_LEASE_SECONDS / 2:
+        node = _node['node'] if _node['pid'] == os.getpid() and now < _node['expires'] else None
+        # 以续约之前的时间计算到期时间，本进程认为的到期时间不会晚于数据库中的
+        _node.update(node=_lease_in_thread(node), pid=os.getpid(), expires=now + NODE_LEASE_SECONDS)
+    return _node['node']
+
+
+def next_id():
+    """
+    全局唯一的主键：41位毫秒时间戳、10位节点号、12位序号，每个节点每毫秒最多分配4096个
+    """
+    with _id_lock:
+        node = node_id()
+        ms = int(time.time() * 1000) - ID_EPOCH
+        if ms <= _id_state['ms']:
+            ms = _id_state['ms']
+            _id_state['seq'] += 1
+            if _id_state['seq'] >= 4096:
+                # 序号用完时借用下一毫秒
+                ms += 1
+                _id_state['seq'] = 0
+        else:
+            _id_state['seq'] = 0
+        _id_state['ms'] = ms
+        return ms << 22 | node << 12 | _id_state['seq']
+
+
+class ShardedModelMixin:
+    """
+    分片的 model 新增时由 next_id() 分配主键，并强制 INSERT，
+    不能依赖各个分片各自的自增主键，也不需要先执行一次 UPDATE
+    """
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if self.pk is None and is_sharded(type(self)):
+            self.pk = next_id()
+            force_insert = True
+        super().save(force_insert=force_insert, force_update=force_update, using=using,
+                     update_fields=update_fields)
+
+    save.alters_data = True
+
+
+def check_id(sender, instance, raw=False, **kwargs):
+    """
+    pre_save：分片的 model 没有继承 ShardedModelMixin 时，主键会由各个分片自增，在分片之间重复
+    """
+    if not raw and instance.pk is None and is_sharded(sender):
+        raise ValueError('{} 已分片，需要继承 ShardedModelMixin'.format(sender._meta.label))
+
+
+pre_save.connect(check_id, dispatch_uid='sharding_check_id')
+
+
+def run_on_shards(aliases, func):
+    """
+    通过线程池在每个数据库上并行执行 func(alias)，见 fanout
+    :return: {alias: 结果}
+    """
+    result = fanout.run({alias: (alias, functools.partial(func, alias)) for alias in aliases})
+    result.raise_for_errors()
+    return result.results
+
+
+def _compare(keys, nulls_largest, a, b):
+    for getter, descending in keys:
+        x, y = getter(a), getter(b)
+        if x == y:
+            continue
+        # 与分片的数据库相同，PostgreSQL 中 NULL 大于任何值，SQLite、MySQL 中小于任何值
+        if x is None:
+            result = 1 if nulls_largest else -1
+        elif y is None:
+            result = -1 if nulls_largest else 1
+        else:
+            result = -1 if x < y else 1
+        return -result if descending else result
+    return 0
+
+
+def _merge_aggregate(expression, values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    if isinstance(expression, Count) and not expression.distinct or isinstance(expression, Sum):
+        return sum(values)
+    if isinstance(expression, Max):
+        return max(values)
+    if isinstance(expression, Min):
+        return min(values)
+    raise ValueError('无法合并多个分片的 {}'.format(expression))
+
+
+class ShardedQuerySet(models.QuerySet):
+
+    _all_shards = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._all_shards = self._all_shards
+        return clone
+
+    def shard(self, value):
+        """
+        在分片键为 value 的分片上查询
+        """
+        return self.using(shard_for(self.model, value))
+
+    def all_shards(self):
+        """
+        在所有分片上查询
+        """
+        clone = self._chain()
+        clone._all_shards = True
+        return clone
+
+    def _fans_out(self):
+        # 没有通过 shard()、using() 指定分片，也不是关联对象的查询时，同样在所有分片上查询
+        return self._all_shards or self._db is None and not self._hints and is_sharded(self.model)
+
+    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False):
+        """
+        分片的数据分配主键后，按分片键分组写入各自的分片
+        """
+        if not is_sharded(self.model):
+            return super().bulk_create(objs, batch_size, ignore_conflicts)
+        objs = list(objs)
+        groups = {}
+        for obj in objs:
+            if obj.pk is None:
+                obj.pk = next_id()
+            groups.setdefault(shard_for_instance(obj, write=True), []).append(obj)
+        for alias, group in groups.items():
+            self._on_shard(alias).bulk_create(group, batch_size, ignore_conflicts)
+        return objs
+
+    def _on_shard(self, alias):
+        clone = self._chain()
+        clone._all_shards = False
+        clone._db = alias
+        return clone
+
+    def _run(self, func):
+        return run_on_shards(SHARD_MAP.aliases(self.model._meta.app_label),
+                             lambda alias: func(self._on_shard(alias)))
+
+    def _merge(self, results):
+        """
+        合并各个分片已经排好序的结果
+        """
+        keys = self._ordering_keys()
+        if not keys:
+            return chain(*results)
+        aliases = SHARD_MAP.aliases(self.model._meta.app_label)
+        nulls_largest = connections[aliases[0]].features.nulls_order_largest
+        return heapq.merge(*results, key=functools.cmp_to_key(functools.partial(_compare, keys, nulls_largest)))
+
+    def _ordering_keys(self):
+        query = self.query
+        ordering = query.order_by or (query.default_ordering and self.model._meta.ordering) or ()
+        keys = []
+        for name in ordering:
+            if not isinstance(name, str) or '__' in name or name == '?':
+                raise ValueError('多个分片的结果只能按本表字段排序：{}'.format(name))
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name == 'pk':
+                name = self.model._meta.pk.attname
+            if self._iterable_class is not ModelIterable and name not in (self._fields or ()):
+                raise ValueError('多个分片的 values() 结果需要包含排序字段：{}'.format(name))
+            if self._iterable_class is ModelIterable:
+                getter = attrgetter(name)
+            elif self._iterable_class is ValuesIterable:
+                getter = itemgetter(name)
+            elif self._iterable_class is FlatValuesListIterable:
+                getter = lambda value: value
+            else:
+                getter = itemgetter(self._fields.index(name))
+            keys.append((getter, descending))
+        return keys
+
+    def _fetch_all(self):
+        if self._result_cache is None and self._fans_out():
+            low, high = self.query.low_mark, self.query.high_mark
+
+            def fetch(queryset):
+                return list(self._unsliced(queryset, high))
+
+            self._result_cache = list(self._merge(self._run(fetch).values()))[low:high]
+        super()._fetch_all()
+
+    @staticmethod
+    def _unsliced(queryset, high):
+        # 每个分片都需要取出前 high 条，合并后再切片
+        queryset.query.clear_limits()
+        if high is not None:
+            queryset.query.set_limits(0, high)
+        return queryset
+
+    def iterator(self, chunk_size=2000):
+        """
+        在所有分片上查询时，依次从每个分片的 iterator() 中读取并有序合并，内存占用与单个分片的 iterator() 相同
+        """
+        if not self._fans_out():
+            return super().iterator(chunk_size)
+        low, high = self.query.low_mark, self.query.high_mark
+        iterators = [self._unsliced(self._on_shard(alias), high).iterator(chunk_size)
+                     for alias in SHARD_MAP.aliases(self.model._meta.app_label)]
+        return islice(self._merge(iterators), low, high)
+
+    def in_bulk(self, id_list=None, *, field_name='pk'):
+        if not self._fans_out():
+            return super().in_bulk(id_list, field_name=field_name)
+        if id_list is not None:
+            id_list = list(id_list)
+        found = {}
+        for result in self._run(lambda queryset: queryset.in_bulk(id_list, field_name=field_name)).values():
+            found.update(result)
+        return found
+
+    def count(self):
+        if not self._fans_out():
+            return super().count()
+        if self._result_cache is not None or self.query.low_mark or self.query.high_mark is not None:
+            return len(self)
+        return sum(self._run(lambda queryset: queryset.count()).values())
+
+    def exists(self):
+        if not self._fans_out():
+            return super().exists()
+        return any(self._run(lambda queryset: queryset.exists()).values())
+
+    def aggregate(self, *args, **kwargs):
+        if not self._fans_out():
+            return super().aggregate(*args, **kwargs)
+        expressions = dict(kwargs, **{arg.default_alias: arg for arg in args})
+        results = self._run(lambda queryset: queryset.aggregate(**expressions)).values()
+        return {name: _merge_aggregate(expression, [result[name] for result in results])
+                for name, expression in expressions.items()}
+
+    def update(self, **kwargs):
+        if not self._fans_out():
+            if is_sharded(self.model):
+                check_writable(self.model, self.db)
+            return super().update(**kwargs)
+        for alias in SHARD_MAP.aliases(self.model._meta.app_label):
+            check_writable(self.model, alias)
+        return sum(self._run(lambda queryset: queryset.update(**kwargs)).values())
+    update.alters_data = True
+
+    def delete(self):
+        if not self._fans_out():
+            if is_sharded(self.model):
+                check_writable(self.model, self.db)
+            return super().delete()
+        for alias in SHARD_MAP.aliases(self.model._meta.app_label):
+            check_writable(self.model, alias)
+        total, rows = 0, {}
+        for deleted, per_model in self._run(lambda queryset: queryset.delete()).values():
+            total += deleted
+            for label, count in per_model.items():
+                rows[label] = rows.get(label, 0) + count
+        return total, rows
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class ShardedManager(models.Manager.from_queryset(ShardedQuerySet)):
+    pass
@@ -0,0 +1,147 @@
+import time
+import sqlite3
+import logging
+import threading
+from django.conf import settings
+
+"""
+SQLite 性能配置
+默认的 rollback journal 模式下，写入时锁住整个数据库，读写互相阻塞
+proj.pool.sqlite3 建立新连接时按 SQLITE_PROFILE 执行 PRAGMA，每个数据库可以通过 'SQLITE' 覆盖：
+
+SQLITE_PROFILE = {
+    'JOURNAL_MODE': 'WAL',          # WAL 模式下读不阻塞写，写不阻塞读
+    'SYNCHRONOUS': 'NORMAL',        # WAL 模式下 NORMAL 只在 checkpoint 时 fsync，断电可能丢失最后的事务，但数据库不会损坏
+    'CACHE_SIZE': -16000,           # 负数为 KiB
+    'MMAP_SIZE': 128 * 1024 * 1024,
+    'BUSY_TIMEOUT': 5000,           # 等待锁的毫秒数
+    'CHECKPOINT_INTERVAL': 60,      # 后台线程执行 wal_checkpoint 的间隔（秒），0 为不执行
+    'CHECKPOINT_MODE': 'PASSIVE',
+    'ANALYZE_INTERVAL': 3600,       # 后台线程执行 ANALYZE 的间隔（秒），0 为不执行
+}
+
+'boss': {
+    'ENGINE': 'proj.pool.sqlite3',
+    'NAME': os.path.join(BASE_DIR, 'boss.sqlite3'),
+    'SQLITE': {'SYNCHRONOUS': 'FULL'},
+},
+
+值为 None 的配置不执行，内存数据库不修改 JOURNAL_MODE、MMAP_SIZE，也不执行 checkpoint 和 ANALYZE
+"""
+
+logger = logging.getLogger('django')
+
+DEFAULT_PROFILE = {
+    'JOURNAL_MODE': None,
+    'SYNCHRONOUS': None,
+    'CACHE_SIZE': None,
+    'MMAP_SIZE': None,
+    'BUSY_TIMEOUT': None,
+    'CHECKPOINT_INTERVAL': 0,
+    'CHECKPOINT_MODE': 'PASSIVE',
+    'ANALYZE_INTERVAL': 0,
+}
+
+# 每个新连接执行的 PRAGMA
+PRAGMAS = (('journal_mode', 'JOURNAL_MODE'), ('synchronous', 'SYNCHRONOUS'), ('cache_size', 'CACHE_SIZE'),
+           ('mmap_size', 'MMAP_SIZE'), ('busy_timeout', 'BUSY_TIMEOUT'))
+# 内存数据库不支持的 PRAGMA
+FILE_ONLY = ('journal_mode', 'mmap_size')
+
+
+def get_profile(settings_dict):
+    profile = dict(DEFAULT_PROFILE, **getattr(settings, 'SQLITE_PROFILE', {}))
+    profile.update(settings_dict.get('SQLITE', {}))
+    return profile
+
+
+def apply(raw, profile, in_memory=False):
+    """
+    在新连接上执行 PRAGMA
+    """
+    for pragma, key in PRAGMAS:
+        value = profile[key]
+        if value is None or in_memory and pragma in FILE_ONLY:
+            continue
+        try:
+            raw.execute('PRAGMA {} = {}'.format(pragma, value))
+        except sqlite3.OperationalError as e:
+            # 其他连接正在写入时可能无法切换 journal_mode，下一个连接再试
+            logger.warning('PRAGMA %s = %s 执行失败：%s', pragma, value, e)
+
+
+class Maintenance:
+    """
+    定期对数据库文件执行 checkpoint 和 ANALYZE，使用独立的连接
+    """
+
+    def __init__(self, path, profile):
+        self.path = path
+        self.checkpoint_interval = profile['CHECKPOINT_INTERVAL']
+        self.checkpoint_mode = profile['CHECKPOINT_MODE']
+        self.analyze_interval = profile['ANALYZE_INTERVAL']
+        self.busy_timeout = profile['BUSY_TIMEOUT'] or 5000
+        self.stats = {'checkpoints': 0, 'analyzes': 0, 'last_checkpoint': None, 'errors': 0}
+        self._thread = threading.Thread(target=self._run, name='sqlite-maintenance', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, isolation_level=None)
+
+    def checkpoint(self, raw):
+        # 返回 (是否因为锁而没有完成, WAL 中的页数, 写回数据库文件的页数)
+        self.stats['last_checkpoint'] = raw.execute(
+            'PRAGMA wal_checkpoint({})'.format(self.checkpoint_mode)).fetchone()
+        self.stats['checkpoints'] += 1
+
+    def analyze(self, raw):
+        raw.execute('ANALYZE')
+        self.stats['analyzes'] += 1
+
+    def _run(self):
+        now = time.monotonic()
+        due = {}
+        if self.checkpoint_interval:
+            due[self.checkpoint] = (self.checkpoint_interval, now + self.checkpoint_interval)
+        if self.analyze_interval:
+            due[self.analyze] = (self.analyze_interval, now + self.analyze_interval)
+        while due:
+            task, (interval, at) = min(due.items(), key=lambda item: item[1][1])
+            time.sleep(max(0, at - time.monotonic()))
+            raw = self._connect()
+            try:
+                task(raw)
+            except sqlite3.Error:
+                self.stats['errors'] += 1
+                logger.exception('%s 的维护任务执行失败', self.path)
+            finally:
+                raw.close()
+            due[task] = (interval, time.monotonic() + interval)
+
+
+# {数据库文件: Maintenance}
+MAINTENANCE = {}
+_maintenance_lock = threading.Lock()
+
+
+def init_connection(wrapper, raw):
+    """
+    proj.pool.sqlite3 建立新连接时调用
+    """
+    profile = get_profile(wrapper.settings_dict)
+    in_memory = wrapper.is_in_memory_db()
+    apply(raw, profile, in_memory)
+    if in_memory or not (profile['CHECKPOINT_INTERVAL'] or profile['ANALYZE_INTERVAL']):
+        return
+    path = wrapper.settings_dict['NAME']
+    if path not in MAINTENANCE:
+        with _maintenance_lock:
+            if path not in MAINTENANCE:
+                MAINTENANCE[path] = Maintenance(path, profile)
+                MAINTENANCE[path].start()
+
+
+def stats():
+    return {path: dict(maintenance.stats) for path, maintenance in MAINTENANCE.items()}
@@ -14,9 +14,9 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.urls import path
-from boss.views import add_boss
-from client.views import add_client
-from driver.views import add_driver
+from boss.views import add_boss, bulk_add_boss
+from client.views import add_client, bulk_add_client
+from driver.views import add_driver, bulk_add_driver
 from django.contrib import admin
 
 urlpatterns = [
@@ -24,4 +24,7 @@ urlpatterns = [
     path('add_boss/', add_boss),
     path('add_driver/', add_driver),
     path('add_client/', add_client),
+    path('bulk_add_boss/', bulk_add_boss),
+    path('bulk_add_driver/', bulk_add_driver),
+    path('bulk_add_client/', bulk_add_client),
 ]
@@ -0,0 +1,367 @@
+import os
+import time
+import uuid
+import atexit
+import logging
+import threading
+from collections import deque
+from django.conf import settings
+from django.core import serializers
+from django.db import router, transaction, connections, DatabaseError, DataError, IntegrityError
+from django.shortcuts import HttpResponse
+from . import app_move, sharding
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，溢出文件不加锁，同一个 SPILL_DIR 只能由一个进程使用
+    fcntl = None
+
+"""
+延迟写入
+add_boss 等接口每个请求写入一行，并发写入时 SQLite 的写锁成为瓶颈
+开启 WRITE_BEHIND['ENABLED'] 后，请求中的实例写入所在数据库的队列即返回 202，
+每个数据库一个后台线程，队列中积累 BATCH_SIZE 条或者等待 FLUSH_INTERVAL 秒后通过 bulk_create 写入
+实例所在的数据库由 DatabaseAppsRouter.db_for_write 决定
+
+WRITE_BEHIND = {
+    'ENABLED': True,
+    'MAX_QUEUE': 10000,         # 每个数据库的队列长度，队列满时返回 503
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 0.05,
+    'SPILL_DIR': os.path.join(BASE_DIR, 'spill'),
+    'FSYNC': False,             # 每次写入溢出文件后 fsync，断电时也不丢失数据，但每个请求的耗时会增加
+}
+
+进入队列前，实例先追加到 SPILL_DIR 中这个进程、这个数据库的溢出文件 <数据库>.<pid>-<uuid>.ndjson，
+写入数据库后记录已写入的位置，进程持有溢出文件的锁，正常停止时删除自己的溢出文件
+进程退出时没有写入的数据，由之后创建同一数据库缓冲区的进程恢复并重新写入，写入数据库与记录位置之间进程退出时可能重复写入
+"""
+
+logger = logging.getLogger('django')
+
+DEFAULT_OPTIONS = {
+    'ENABLED': False,
+    'MAX_QUEUE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 0.05,
+    'SPILL_DIR': None,
+    'FSYNC': False,
+}
+
+# 写入失败后重试的间隔（秒）
+RETRY_INTERVAL = 1
+# 只与某一行的数据有关的错误，丢弃这一行，其他错误重试
+DATA_ERRORS = (IntegrityError, DataError, ValueError, TypeError)
+# reshard、move_app 切换期间禁止写入，稍后重试
+MOVING = (sharding.ReshardInProgress, app_move.AppMoveInProgress)
+
+
+def get_options():
+    return dict(DEFAULT_OPTIONS, **getattr(settings, 'WRITE_BEHIND', {}))
+
+
+def enabled():
+    return get_options()['ENABLED']
+
+
+class QueueFull(Exception):
+    pass
+
+
+def spill_paths(directory, alias, token):
+    """
+    :return: (溢出文件, 已写入位置的文件)
+    """
+    name = '{}.{}'.format(alias, token)
+    return os.path.join(directory, '{}.ndjson'.format(name)), os.path.join(directory, '{}.offset'.format(name))
+
+
+def orphans(directory, alias):
+    """
+    directory 中 alias 的所有溢出文件，包括旧版本以 alias 命名的文件，是否仍被其他进程使用由文件锁判断
+    :return: [(溢出文件, 已写入位置的文件)]
+    """
+    result = []
+    for name in sorted(os.listdir(directory)):
+        if name == '{}.ndjson'.format(alias):
+            result.append((os.path.join(directory, name), os.path.join(directory, '{}.offset'.format(alias))))
+        elif name.startswith('{}.'.format(alias)) and name.endswith('.ndjson') and name.count('.') == 2:
+            result.append(spill_paths(directory, alias, name.split('.')[1]))
+    return result
+
+
+def _lock(f, blocking=True):
+    """
+    对打开的文件加排他锁，进程退出时由操作系统释放
+    :return: 是否取得锁
+    """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+
+class WriteBehindBuffer:
+
+    def __init__(self, alias, options, autostart=True):
+        self.alias = alias
+        self.max_queue = options['MAX_QUEUE']
+        self.batch_size = options['BATCH_SIZE']
+        self.flush_interval = options['FLUSH_INTERVAL']
+        self.fsync = options['FSYNC']
+        # [(实例, 在溢出文件中的结束位置)]
+        self._queue = deque()
+        self._cond = threading.Condition()
+        # 正在写入数据库的条数
+        self._flushing = 0
+        self._stopped = False
+        self._metrics = dict.fromkeys(('queued', 'flushed', 'batches', 'rejected', 'errors', 'recovered'), 0)
+        self._spill = None
+        if options['SPILL_DIR']:
+            self._spill_dir = options['SPILL_DIR']
+            os.makedirs(self._spill_dir, exist_ok=True)
+            # 每个进程、每个缓冲区使用自己的溢出文件，持有文件锁直到停止
+            self._spill_path, self._offset_path = spill_paths(self._spill_dir, alias,
+                                                              '{}-{}'.format(os.getpid(), uuid.uuid4().hex))
+            self._spill = open(self._spill_path, 'ab')
+            _lock(self._spill)
+            self._recover()
+        self._worker = threading.Thread(target=self._run, name='write-behind-{}'.format(alias), daemon=True)
+        if autostart:
+            self._worker.start()
+
+    def _recover(self):
+        """
+        把已经退出的进程留下的溢出文件中没有写入数据库的实例追加到自己的溢出文件，放回队列，再删除这些文件
+        """
+        for spill_path, offset_path in orphans(self._spill_dir, self.alias):
+            if spill_path == self._spill_path:
+                continue
+            try:
+                f = open(spill_path, 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                # 其他进程仍在使用，或者在取得锁之前已经被其他进程恢复并删除
+                if not _lock(f, blocking=False) or not os.path.exists(spill_path):
+                    continue
+                try:
+                    with open(offset_path) as offset_file:
+                        offset = int(offset_file.read() or 0)
+                except FileNotFoundError:
+                    offset = 0
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # 写入一半时进程退出，这一行没有返回给客户端
+                        break
+                    self._spill.write(line)
+                    for obj in serializers.deserialize('json', line.decode('utf-8')):
+                        self._queue.append((obj.object, self._spill.tell()))
+                        self._metrics['recovered'] += 1
+                self._spill.flush()
+                os.fsync(self._spill.fileno())
+                # 删除之前进程退出时，这些实例在下次恢复时会再写入一次
+                for path in (offset_path, spill_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def put(self, instance):
+        with self._cond:
+            if self._stopped:
+                raise QueueFull('{} 的延迟写入已停止'.format(self.alias))
+            if len(self._queue) >= self.max_queue:
+                self._metrics['rejected'] += 1
+                raise QueueFull('{} 的延迟写入队列已满'.format(self.alias))
+            offset = None
+            if self._spill is not None:
+                self._spill.write(serializers.serialize('json', [instance]).encode('utf-8') + b'\n')
+                self._spill.flush()
+                if self.fsync:
+                    os.fsync(self._spill.fileno())
+                offset = self._spill.tell()
+            self._queue.append((instance, offset))
+            self._metrics['queued'] += 1
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _take(self):
+        """
+        等待一批数据：达到 batch_size 或者第一条数据等待超过 flush_interval
+        """
+        with self._cond:
+            while not self._queue and not self._stopped:
+                self._cond.wait()
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._queue) < self.batch_size and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            self._flushing = len(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if not batch:
+                break
+            while True:
+                try:
+                    self._write([instance for instance, _ in batch])
+                    break
+                except MOVING as e:
+                    logger.warning('延迟写入 %s 暂停，%s 秒后重试：%s', self.alias, RETRY_INTERVAL, e)
+                    time.sleep(RETRY_INTERVAL)
+                except DatabaseError:
+                    # 数据库不可用时保留这一批，稍后重试
+                    logger.exception('延迟写入 %s 失败，%s 秒后重试', self.alias, RETRY_INTERVAL)
+                    connections[self.alias].close()
+                    time.sleep(RETRY_INTERVAL)
+            self._committed(batch[-1][1])
+            with self._cond:
+                self._flushing = 0
+                self._metrics['flushed'] += len(batch)
+                self._metrics['batches'] += 1
+                self._cond.notify_all()
+        connections[self.alias].close()
+
+    def _write(self, instances):
+        groups = {}
+        for instance in instances:
+            groups.setdefault(type(instance), []).append(instance)
+        try:
+            with transaction.atomic(using=self.alias):
+                for model, objs in groups.items():
+                    model._default_manager.using(self.alias).bulk_create(objs)
+            return
+        except DATA_ERRORS as e:
+            logger.warning('延迟写入 %s 的批量写入失败，逐行写入：%s', self.alias, e)
+        # 某一行的数据有误，逐行写入，跳过有误的行，其他错误时整批回滚后重试
+        with transaction.atomic(using=self.alias):
+            for instance in instances:
+                try:
+                    with transaction.atomic(using=self.alias):
+                        instance.save(using=self.alias, force_insert=True)
+                except DATA_ERRORS:
+                    logger.exception('延迟写入 %s 丢弃 %r', self.alias, instance)
+                    with self._cond:
+                        self._metrics['errors'] += 1
+
+    def _committed(self, offset):
+        """
+        记录溢出文件中已写入数据库的位置，队列为空时清空溢出文件
+        """
+        if offset is None:
+            return
+        with self._cond:
+            empty = not self._queue
+            # 先记录位置再清空，两步之间进程退出时只会重复写入，不会跳过没有写入的实例
+            tmp = '{}.tmp'.format(self._offset_path)
+            with open(tmp, 'w') as f:
+                f.write('0' if empty else str(offset))
+            os.replace(tmp, self._offset_path)
+            if empty:
+                self._spill.truncate(0)
+                self._spill.seek(0)
+
+    def flush(self, timeout=None):
+        """
+        等待队列中的数据全部写入数据库
+        :return: 是否全部写入
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._queue or self._flushing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """
+        写入队列中剩余的数据后停止后台线程
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._worker.is_alive():
+            self._worker.join(timeout)
+        if self._spill is not None:
+            with self._cond:
+                done = not self._queue and not self._flushing
+            # 全部写入后删除溢出文件，否则留给之后启动的进程恢复
+            if done:
+                for path in (self._offset_path, self._spill_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self._spill.close()
+
+    def stats(self):
+        with self._cond:
+            return dict(self._metrics, pending=len(self._queue) + self._flushing)
+
+
+# {数据库: WriteBehindBuffer}
+BUFFERS = {}
+_buffers_lock = threading.Lock()
+
+
+def get_buffer(alias):
+    buffer = BUFFERS.get(alias)
+    if buffer is None:
+        with _buffers_lock:
+            buffer = BUFFERS.get(alias)
+            if buffer is None:
+                buffer = BUFFERS[alias] = WriteBehindBuffer(alias, get_options())
+    return buffer
+
+
+def save(instance):
+    """
+    把实例放入 db_for_write 返回的数据库的队列
+    :raise QueueFull: 队列已满
+    """
+    get_buffer(router.db_for_write(type(instance), instance=instance)).put(instance)
+
+
+def respond(instance):
+    """
+    延迟写入实例，返回 202，队列已满或者 reshard、move_app 切换期间禁止写入时返回 503
+    """
+    try:
+        save(instance)
+    except (QueueFull,) + MOVING as e:
+        response = HttpResponse(str(e), status=503)
+        response['Retry-After'] = 1
+        return response
+    return HttpResponse('success', status=202)
+
+
+def flush(timeout=None):
+    return all(buffer.flush(timeout) for buffer in list(BUFFERS.values()))
+
+
+def shutdown(timeout=None):
+    """
+    写入所有队列中的数据并停止后台线程
+    """
+    with _buffers_lock:
+        buffers = list(BUFFERS.values())
+        BUFFERS.clear()
+    for buffer in buffers:
+        buffer.stop(timeout)
+
+
+def stats():
+    return {alias: buffer.stats() for alias, buffer in BUFFERS.items()}
+
+
+atexit.register(shutdown, 10)